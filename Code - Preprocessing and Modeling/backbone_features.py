@@ -0,0 +1,238 @@
+"""
+Frozen-backbone feature caching for the hybrid hyperparameter grid search.
+
+In the notebooks' grid, every combination rebuilds the backbone and trains it end to end, although the frozen
+layers compute exactly the same activations in every run (frozen BatchNorm layers run in inference mode). Here
+each backbone is run once per frozen-layer option over the cached splits (see tensor_cache.py) up to its last
+frozen layer, and the activations crossing that cut are stored as memory-mapped .npy files:
+
+- frozen_layers == total_layers: the cut is the backbone output, and only the fusion head is trained;
+- total_layers - 2, total_layers - 5, ...: the unfrozen tail of the backbone is rebuilt on top of the cached
+  activations (every tensor a tail layer reads from the frozen part, including skip connections) and trained
+  together with the head.
+
+The trained tail and head layers are shared with a full [image, numerical] model, so the best configuration is
+saved as the same .h5 model the notebooks and the model server load.
+
+Usage in the hybrid notebook (replacing the grid loop of a backbone):
+
+    from tensor_cache import build_split
+    from backbone_features import run_hybrid_grid
+
+    caches = {split: build_split(df, image_dir, cache_dir, split, 224, all_numerical_features, label_encoder)
+              for split, df, image_dir in [('train', train_df, train_image_dir), ('val', val_df, val_image_dir),
+                                           ('test', test_df, test_image_dir)]}
+    results_df, best_model_details = run_hybrid_grid('densenet121', caches, cache_dir, len(label_encoder.classes_),
+                                                     [256, 512], [64, 128], ['relu'], [0, 0.3, 0.5], [0, 2, 5],
+                                                     best_model_path=f'{base_dir}/Best_DenseNet121_Hybrid_Model.h5')
+"""
+import os
+import gc
+import json
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Dense, Dropout, Flatten, Input, concatenate
+from tensor_cache import make_dataset
+
+BACKBONE_MODELS = {
+    'vgg19': tf.keras.applications.VGG19,
+    'resnet50': tf.keras.applications.ResNet50,
+    'densenet121': tf.keras.applications.DenseNet121,
+    'inception_v3': tf.keras.applications.InceptionV3,
+}
+
+# Images run through the frozen layers at once while the features are extracted
+EXTRACT_BATCH_SIZE = 32
+
+def as_list(tensors):
+    return tensors if isinstance(tensors, (list, tuple)) else [tensors]
+
+def split_backbone(base_model, frozen_layers):
+    """
+    Cutting a backbone after its first frozen_layers layers.
+
+    Returns the extractor (image -> every frozen tensor read by an unfrozen layer, or the backbone output when
+    everything is frozen) and the tail model (those tensors -> backbone output) built from the unfrozen layers
+    themselves, so training the tail trains the backbone's own layer objects.
+    """
+    unfrozen = base_model.layers[frozen_layers:]
+    if not unfrozen:
+        extractor = Model(base_model.input, base_model.output)
+        cut_input = Input(shape=base_model.output.shape[1:], name='cut_0')
+        return extractor, Model(cut_input, cut_input)
+
+    produced = {layer.output.ref() for layer in unfrozen}
+    cut_tensors, seen = [], set()
+    for layer in unfrozen:
+        for tensor in as_list(layer.input):
+            if tensor.ref() not in produced and tensor.ref() not in seen:
+                seen.add(tensor.ref())
+                cut_tensors.append(tensor)
+
+    # Re-applying the unfrozen layers in their (topological) order on inputs standing in for the cut tensors
+    cut_inputs = [Input(shape=tensor.shape[1:], name=f'cut_{i}') for i, tensor in enumerate(cut_tensors)]
+    mapped = {tensor.ref(): cut_input for tensor, cut_input in zip(cut_tensors, cut_inputs)}
+    for layer in unfrozen:
+        inputs = [mapped[tensor.ref()] for tensor in as_list(layer.input)]
+        mapped[layer.output.ref()] = layer(inputs if isinstance(layer.input, (list, tuple)) else inputs[0])
+
+    extractor = Model(base_model.input, cut_tensors if len(cut_tensors) > 1 else cut_tensors[0])
+    return extractor, Model(cut_inputs, mapped[base_model.output.ref()])
+
+class CachedFeatures:
+    """The cut activations of one split, memory-mapped, with the split's numerical features and labels."""
+
+    def __init__(self, directory, cache):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.features = [np.load(os.path.join(directory, name), mmap_mode='r') for name in self.manifest['files']]
+        self.numerical = cache.numerical
+        self.labels = cache.labels
+
+    def dataset(self, batch_size=32, shuffle=False, seed=None):
+        """((cut activations..., numerical), labels) batches sliced from the mapped files."""
+        count = len(self.labels)
+        rng = np.random.default_rng(seed)
+
+        def batches():
+            order = rng.permutation(count) if shuffle else np.arange(count)
+            for start in range(0, count, batch_size):
+                indices = np.sort(order[start:start + batch_size])
+                yield tuple(features[indices] for features in self.features) + (self.numerical[indices],), \
+                    self.labels[indices]
+
+        signature = (tuple(tf.TensorSpec((None,) + features.shape[1:], tf.float32) for features in self.features)
+                     + (tf.TensorSpec((None, self.numerical.shape[1]), tf.float32),),
+                     tf.TensorSpec((None,), tf.int64))
+        return tf.data.Dataset.from_generator(batches, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+def extract_features(extractor, backbone, cache, directory):
+    """Running the frozen layers once over a cached split and storing their outputs; an existing run is reused."""
+    manifest_path = os.path.join(directory, 'manifest.json')
+    source = cache.manifest['fingerprint']
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f).get('source') == source:
+                return CachedFeatures(directory, cache)
+        os.remove(manifest_path)
+    os.makedirs(directory, exist_ok=True)
+
+    outputs = as_list(extractor.output)
+    files = [f'features-{i}.npy' for i in range(len(outputs))]
+    arrays = [np.lib.format.open_memmap(os.path.join(directory, name), mode='w+', dtype=np.float32,
+                                        shape=(len(cache),) + tuple(output.shape[1:]))
+              for name, output in zip(files, outputs)]
+    images = make_dataset(cache, backbone, batch_size=EXTRACT_BATCH_SIZE, include_numerical=False).map(lambda x, y: x)
+    position = 0
+    for batch in images:
+        # Frozen BatchNorm layers run in inference mode, as they do inside the trained model
+        results = as_list(extractor(batch, training=False))
+        for array, result in zip(arrays, results):
+            array[position:position + len(result)] = result.numpy()
+        position += len(results[0])
+    for array in arrays:
+        array.flush()
+    del arrays
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'source': source, 'files': files, 'count': len(cache)}, f)
+    return CachedFeatures(directory, cache)
+
+def build_hybrid_models(base_model, tail, num_numerical_features, num_classes, image_neurons, numerical_neurons,
+                        activation, dropout_rate):
+    """
+    Building the notebooks' hybrid head twice with the same layer objects: on the cached activations (for
+    training) and on [image, numerical] through the whole backbone (for saving and serving).
+    """
+    flatten = Flatten()
+    image_dense = Dense(image_neurons, activation=activation)
+    image_dropout = Dropout(dropout_rate)
+    numerical_dense_1 = Dense(numerical_neurons, activation=activation)
+    numerical_dense_2 = Dense(int(numerical_neurons / 2), activation=activation)
+    classifier = Dense(num_classes, activation='softmax')
+
+    def head(backbone_output, numerical_input):
+        x_image = image_dropout(image_dense(flatten(backbone_output)))
+        x_numerical = numerical_dense_2(numerical_dense_1(numerical_input))
+        return classifier(concatenate([x_image, x_numerical]))
+
+    cut_inputs = [Input(shape=tensor.shape[1:]) for tensor in tail.inputs]
+    numerical_input = Input(shape=(num_numerical_features,), name='numerical_input')
+    tail_output = tail(cut_inputs if len(cut_inputs) > 1 else cut_inputs[0])
+    cached_model = Model(cut_inputs + [numerical_input], head(tail_output, numerical_input))
+    cached_model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+
+    image_input = Input(shape=base_model.input.shape[1:], name='image_input')
+    full_numerical_input = Input(shape=(num_numerical_features,), name='numerical_input')
+    full_model = Model([image_input, full_numerical_input], head(base_model(image_input), full_numerical_input))
+    full_model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    return cached_model, full_model
+
+def run_hybrid_grid(backbone, caches, cache_dir, num_classes, neuron_options_image, neuron_options_numerical,
+                    activation_options, dropout_options, unfrozen_layers_options=(0, 2, 5), epochs=25, batch_size=32,
+                    best_model_path=None):
+    """
+    The notebooks' hybrid grid search on cached backbone features.
+
+    unfrozen_layers_options are counted from the end of the backbone, so (0, 2, 5) is the notebooks'
+    [total_layers, total_layers - 2, total_layers - 5]. Returns the results DataFrame and the best model's
+    details, and saves the best full model to best_model_path.
+    """
+    base_model = BACKBONE_MODELS[backbone](weights='imagenet', include_top=False,
+                                           input_shape=(caches['train'].image_size, caches['train'].image_size, 3))
+    total_layers = len(base_model.layers)
+    initial_weights = {layer.name: layer.get_weights() for layer in base_model.layers}
+    num_numerical_features = caches['train'].numerical.shape[1]
+
+    results = []
+    best_accuracy = 0
+    best_model_details = {}
+    for unfrozen_layers in unfrozen_layers_options:
+        frozen_layers = total_layers - unfrozen_layers
+        for i, layer in enumerate(base_model.layers):
+            layer.trainable = i >= frozen_layers
+        extractor, tail = split_backbone(base_model, frozen_layers)
+        features = {split: extract_features(extractor, backbone, cache,
+                                            os.path.join(cache_dir, 'features', f'{backbone}_{frozen_layers}', split))
+                    for split, cache in caches.items()}
+
+        for image_neurons in neuron_options_image:
+            for numerical_neurons in neuron_options_numerical:
+                for activation in activation_options:
+                    for dropout_rate in dropout_options:
+                        # Every configuration starts the unfrozen tail from the ImageNet weights again
+                        for layer in base_model.layers[frozen_layers:]:
+                            layer.set_weights(initial_weights[layer.name])
+                        cached_model, full_model = build_hybrid_models(
+                            base_model, tail, num_numerical_features, num_classes, image_neurons, numerical_neurons,
+                            activation, dropout_rate)
+
+                        cached_model.fit(features['train'].dataset(batch_size, shuffle=True),
+                                         validation_data=features['val'].dataset(batch_size), epochs=epochs,
+                                         callbacks=[tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3, restore_best_weights=True)],
+                                         verbose=0)
+                        test_loss, test_accuracy = cached_model.evaluate(features['test'].dataset(batch_size), verbose=0)
+                        print(f"Test accuracy: {test_accuracy * 100:.2f}%, Test loss: {test_loss:.4f}")
+
+                        details = {
+                            'Image Neurons': image_neurons,
+                            'Numerical Neurons': numerical_neurons,
+                            'Activation': activation,
+                            'Dropout': dropout_rate,
+                            'Frozen Layers': frozen_layers
+                        }
+                        results.append({**details, 'Test Accuracy': test_accuracy, 'Test Loss': test_loss})
+
+                        # Saving the best model as the full [image, numerical] model
+                        if test_accuracy > best_accuracy:
+                            best_accuracy = test_accuracy
+                            best_model_details = {**details, 'Test Set Accuracy': f"{test_accuracy * 100:.2f}%"}
+                            if best_model_path:
+                                full_model.save(best_model_path)
+
+                        del cached_model, full_model
+                        gc.collect()
+
+    return pd.DataFrame(results), best_model_details
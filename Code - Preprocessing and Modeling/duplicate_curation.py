@@ -0,0 +1,180 @@
+"""
+Near-duplicate detection for dataset curation.
+
+A faster, near-duplicate-aware version of find_and_delete_duplicates from the Taiwan-filtering notebook:
+
+- images are hashed with imagehash.average_hash in a process pool, and JPEGs are decoded at reduced size
+  (draft mode), since the 8x8 hash never needs the full-resolution image;
+- the hashes go into a BK-tree, so every image is compared only with the images that can be within the
+  Hamming radius instead of with all of them, and near-duplicates are found as well as exact collisions;
+- images linked through matches within the radius are grouped, and each group is split into clusters around
+  the image kept: as in the notebook, the file with the shortest filename is kept (the first one found on
+  ties), and only images within the radius of it are marked as its duplicates. The rest of the group (images
+  reached only through a chain of near neighbours) forms further clusters the same way, so no image is ever
+  marked as a duplicate of one it is farther than the radius from.
+
+A CSV report lists every cluster. Nothing is deleted unless delete=True (--delete) is given.
+
+Usage in a notebook:
+
+    from duplicate_curation import curate
+    report = curate(folder_path_taiwan, f"{new_path_taiwan}/duplicate_report.csv", radius=4)
+
+or from a shell: python duplicate_curation.py <folder> <report.csv> [--radius 4] [--workers 8] [--delete]
+"""
+import os
+import argparse
+import pandas as pd
+import imagehash
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+HASH_SIZE = 8
+
+def hash_image(file_path):
+    """Average hash of an image as an int, or None if it cannot be read."""
+    try:
+        with Image.open(file_path) as img:
+            # JPEG decoding can scale by 1/2 to 1/8 on the fly; the hash only needs 8x8 pixels
+            img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            return int(str(imagehash.average_hash(img, hash_size=HASH_SIZE)), 16)
+    except Exception as e:
+        print(f"Could not hash {file_path}: {e}")
+        return None
+
+class BKTree:
+    """BK-tree over integer hashes with the Hamming distance, for radius queries."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        # A node is [value, items, children by distance]
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(value ^ node[0]).count('1')
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """Every (distance, item) within radius of value."""
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = bin(value ^ node[0]).count('1')
+            if distance <= radius:
+                matches.extend((distance, item) for item in node[1])
+            # By the triangle inequality only children at distance - radius .. distance + radius can match
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return matches
+
+def list_images(root_folder):
+    """Image files under a folder, in the same os.walk order the notebook used."""
+    paths = []
+    for subdir, dirs, files in os.walk(root_folder):
+        for filename in files:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(subdir, filename))
+    return paths
+
+def find_duplicate_clusters(paths, hashes, radius):
+    """
+    Grouping images within radius of each other (transitively), then splitting each group into clusters of
+    the image to keep and the images within radius of it.
+
+    Returns a list of clusters of two or more images, each as (kept index, [member indices]).
+    """
+    tree = BKTree()
+    parent = list(range(len(paths)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, value in enumerate(hashes):
+        if value is None:
+            continue
+        # Matching against the images indexed so far, then indexing this one
+        for _, j in tree.search(value, radius):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+        tree.add(value, i)
+
+    groups = {}
+    for i, value in enumerate(hashes):
+        if value is not None:
+            groups.setdefault(find(i), []).append(i)
+    clusters = []
+    for members in groups.values():
+        # Keeping the shortest filename, and the first image found when lengths tie
+        remaining = sorted(members, key=lambda i: (len(os.path.basename(paths[i])), i))
+        while len(remaining) > 1:
+            kept = remaining[0]
+            cluster = [i for i in remaining if bin(hashes[i] ^ hashes[kept]).count('1') <= radius]
+            if len(cluster) > 1:
+                clusters.append((kept, sorted(cluster)))
+            assigned = set(cluster)
+            remaining = [i for i in remaining if i not in assigned]
+    return sorted(clusters)
+
+def curate(root_folder, report_path, radius=4, workers=None, delete=False):
+    """
+    Hashing every image under root_folder, writing a duplicate-cluster report and returning it as a DataFrame.
+
+    Only with delete=True are the images marked as duplicates removed.
+    """
+    paths = list_images(root_folder)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashes = list(pool.map(hash_image, paths, chunksize=64))
+
+    clusters = find_duplicate_clusters(paths, hashes, radius)
+    rows = []
+    for cluster_id, (kept, members) in enumerate(clusters):
+        for i in members:
+            rows.append({
+                'Cluster': cluster_id,
+                'Path': paths[i],
+                'Filename': os.path.basename(paths[i]),
+                'Hash': f"{hashes[i]:016x}",
+                'Distance to Kept': bin(hashes[i] ^ hashes[kept]).count('1'),
+                'Action': 'keep' if i == kept else 'duplicate'
+            })
+    report = pd.DataFrame(rows, columns=['Cluster', 'Path', 'Filename', 'Hash', 'Distance to Kept', 'Action'])
+    report.to_csv(report_path, index=False)
+
+    duplicates = report[report['Action'] == 'duplicate']
+    print(f"Hashed {len(paths)} images: {len(clusters)} clusters, {len(duplicates)} duplicates "
+          f"(radius {radius}). Report written to {report_path}.")
+    if delete:
+        for file_path in duplicates['Path']:
+            os.remove(file_path)
+        print(f"Deleted {len(duplicates)} duplicates.")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find near-duplicate images and write a cluster report.')
+    parser.add_argument('root_folder')
+    parser.add_argument('report_path')
+    parser.add_argument('--radius', type=int, default=4, help='Hamming radius of the 64-bit average hash (0 = exact)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--delete', action='store_true', help='Delete the images marked as duplicates')
+    args = parser.parse_args()
+    curate(args.root_folder, args.report_path, args.radius, args.workers, args.delete)
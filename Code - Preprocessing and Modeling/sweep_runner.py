@@ -0,0 +1,225 @@
+"""
+Parallel, resumable hyperparameter sweeps for the modeling notebooks.
+
+The notebooks run their grids one configuration after another in the kernel, keep the results in an in-memory
+results_df and call gc.collect()/clear_session() between runs. Here every configuration runs in its own worker
+process (a fresh process per configuration, so its memory is returned to the system when it ends) with a fixed
+thread budget, and each result is appended to a JSON Lines file as soon as it completes. Running the same sweep
+again skips the configurations already in that file, so a disconnected Colab session resumes where it stopped.
+
+The best model is tracked as in the notebooks: whenever a configuration beats the best test accuracy so far it
+saves its model to best_model_path, with best.json next to the results recording which configuration it was.
+
+Usage in a notebook:
+
+    from sweep_runner import run_sweep, load_results
+
+    grid = {'Image Neurons': [256, 512], 'Numerical Neurons': [64, 128], 'Activation': ['relu'],
+            'Dropout': [0, 0.3, 0.5], 'Unfrozen Layers': [0, 2, 5]}
+    context = {'backbone': 'densenet121', 'cache_dirs': {'train': ..., 'val': ..., 'test': ...},
+               'num_classes': len(label_encoder.classes_)}
+    run_sweep('sweep_runner:train_hybrid_config', grid, context, f'{base_dir}/sweeps/densenet121',
+              best_model_path=f'{base_dir}/Best_DenseNet121_Hybrid_Model.h5', workers=2, threads_per_worker=4)
+    results_df = load_results(f'{base_dir}/sweeps/densenet121')
+"""
+import os
+import json
+import time
+import fcntl
+import hashlib
+import importlib
+import itertools
+import traceback
+import multiprocessing
+import pandas as pd
+
+RESULTS_FILE = 'results.jsonl'
+BEST_FILE = 'best.json'
+
+def grid_configurations(grid):
+    """Every combination of a grid, in the nesting order of the notebooks' loops (first key outermost)."""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+def config_key(config):
+    """A stable identifier of a configuration, used to skip it when the sweep is resumed."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+def load_results(results_dir, include_failed=False):
+    """The results recorded so far, one row per configuration, as a DataFrame like the notebooks' results_df."""
+    path = os.path.join(results_dir, RESULTS_FILE)
+    rows = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash is ignored; its configuration simply runs again
+                    continue
+                if include_failed or 'error' not in record:
+                    rows[record['key']] = {**record['config'], **record.get('metrics', {}), 'Key': record['key'],
+                                           'Seconds': record.get('seconds'), 'Error': record.get('error')}
+    return pd.DataFrame(list(rows.values()))
+
+def completed_keys(results_dir):
+    path = os.path.join(results_dir, RESULTS_FILE)
+    keys = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'error' not in record:
+                    keys.add(record['key'])
+    return keys
+
+def append_result(results_dir, record):
+    """Appending one result and forcing it to disk before the next configuration is reported."""
+    path = os.path.join(results_dir, RESULTS_FILE)
+    # A line left unfinished by a crash is closed first, so it cannot swallow the new record
+    separator = ''
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            separator = '' if f.read(1) == b'\n' else '\n'
+    with open(path, 'a') as f:
+        f.write(separator + json.dumps(record, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def init_worker(threads_per_worker):
+    """Limiting a worker's thread pools before TensorFlow starts, and letting workers share a GPU."""
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[variable] = str(threads_per_worker)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    for gpu in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+def save_if_best(results_dir, best_model_path, key, config, metrics, model, metric='Test Accuracy'):
+    """Saving the model when it beats the best one recorded so far; the lock keeps concurrent workers in turn."""
+    best_path = os.path.join(results_dir, BEST_FILE)
+    with open(os.path.join(results_dir, 'best.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        best = {}
+        if os.path.exists(best_path):
+            with open(best_path) as f:
+                best = json.load(f)
+        if metrics[metric] <= best.get('metrics', {}).get(metric, float('-inf')):
+            return False
+        # Saving next to the target and renaming, so an interrupted save never replaces the best model
+        directory, filename = os.path.split(best_model_path)
+        temporary_path = os.path.join(directory, f'.{key}-{filename}')
+        model.save(temporary_path)
+        os.replace(temporary_path, best_model_path)
+        with open(best_path + '.tmp', 'w') as f:
+            json.dump({'key': key, 'config': config, 'metrics': metrics, 'model_path': best_model_path}, f)
+        os.replace(best_path + '.tmp', best_path)
+        return True
+
+def run_configuration(task):
+    """Worker entry point: training one configuration and returning its result record."""
+    train_path, key, config, context, results_dir, best_model_path = task
+    start = time.time()
+    try:
+        module_name, function_name = train_path.split(':')
+        train = getattr(importlib.import_module(module_name), function_name)
+        metrics, model = train(config, context)
+        metrics = {name: float(value) for name, value in metrics.items()}
+        best = bool(best_model_path) and save_if_best(results_dir, best_model_path, key, config, metrics, model)
+        return {'key': key, 'config': config, 'metrics': metrics, 'best': best,
+                'seconds': round(time.time() - start, 1), 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    except Exception:
+        return {'key': key, 'config': config, 'error': traceback.format_exc(),
+                'seconds': round(time.time() - start, 1), 'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def run_sweep(train_path, grid, context, results_dir, best_model_path=None, workers=1, threads_per_worker=None):
+    """
+    Running every configuration of a grid that has no result yet, `workers` at a time.
+
+    train_path names the training function as 'module:function' (importable by the worker processes);
+    it is called as train(config, context) and returns (metrics, model), with metrics including
+    'Test Accuracy'. Failed configurations are recorded with their traceback and run again on the next
+    call. Returns the results recorded so far.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    done = completed_keys(results_dir)
+    configurations = grid_configurations(grid)
+    tasks = [(train_path, config_key(config), config, context, results_dir, best_model_path)
+             for config in configurations if config_key(config) not in done]
+    print(f"{len(configurations) - len(tasks)} of {len(configurations)} configurations already done, "
+          f"running {len(tasks)} with {workers} worker(s).")
+    if not tasks:
+        return load_results(results_dir)
+
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    # Spawned rather than forked workers, since TensorFlow is not fork-safe; one configuration per process
+    pool = multiprocessing.get_context('spawn').Pool(processes=workers, maxtasksperchild=1,
+                                                     initializer=init_worker, initargs=(threads_per_worker,))
+    try:
+        for finished, record in enumerate(pool.imap_unordered(run_configuration, tasks), start=1):
+            append_result(results_dir, record)
+            if 'error' in record:
+                print(f"[{finished}/{len(tasks)}] {record['config']} failed:\n{record['error']}")
+            else:
+                accuracy = record['metrics'].get('Test Accuracy')
+                accuracy = f"{accuracy * 100:.2f}%" if accuracy is not None else 'n/a'
+                print(f"[{finished}/{len(tasks)}] {record['config']} test accuracy {accuracy} "
+                      f"in {record['seconds']}s{' (new best)' if record.get('best') else ''}")
+    finally:
+        pool.close()
+        pool.join()
+    return load_results(results_dir)
+
+def train_hybrid_config(config, context):
+    """
+    Training one configuration of the notebooks' hybrid grid on the preprocessed-tensor cache.
+
+    config holds 'Image Neurons', 'Numerical Neurons', 'Activation', 'Dropout' and 'Unfrozen Layers';
+    context holds 'backbone', 'cache_dirs' ({'train', 'val', 'test'} -> built split directories) and
+    'num_classes', plus optionally 'epochs' and 'batch_size'.
+    """
+    import tensorflow as tf
+    from tensorflow.keras.models import Model
+    from tensorflow.keras.layers import Dense, Dropout, Flatten, Input, concatenate
+    from tensor_cache import TensorCache, make_dataset
+    from backbone_features import BACKBONE_MODELS
+
+    caches = {split: TensorCache(directory) for split, directory in context['cache_dirs'].items()}
+    backbone = context['backbone']
+    batch_size = context.get('batch_size', 32)
+    image_size = caches['train'].image_size
+    activation = config['Activation']
+
+    base_model = BACKBONE_MODELS[backbone](weights='imagenet', include_top=False, input_shape=(image_size, image_size, 3))
+    frozen_layers = len(base_model.layers) - config['Unfrozen Layers']
+    for layer in base_model.layers[:frozen_layers]:
+        layer.trainable = False
+
+    # Building the hybrid model
+    image_input = Input(shape=(image_size, image_size, 3), name='image_input')
+    x_image = Flatten()(base_model(image_input))
+    x_image = Dense(config['Image Neurons'], activation=activation)(x_image)
+    x_image = Dropout(config['Dropout'])(x_image)
+
+    numerical_input = Input(shape=(caches['train'].numerical.shape[1],), name='numerical_input')
+    x_numerical = Dense(config['Numerical Neurons'], activation=activation)(numerical_input)
+    x_numerical = Dense(int(config['Numerical Neurons'] / 2), activation=activation)(x_numerical)
+
+    concatenated = concatenate([x_image, x_numerical])
+    predictions = Dense(context['num_classes'], activation='softmax')(concatenated)
+
+    model = Model(inputs=[image_input, numerical_input], outputs=predictions)
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+
+    model.fit(make_dataset(caches['train'], backbone, batch_size, shuffle=True),
+              validation_data=make_dataset(caches['val'], backbone, batch_size), epochs=context.get('epochs', 25),
+              callbacks=[tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3, restore_best_weights=True)],
+              verbose=0)
+    test_loss, test_accuracy = model.evaluate(make_dataset(caches['test'], backbone, batch_size), verbose=0)
+    return {'Test Accuracy': test_accuracy, 'Test Loss': test_loss, 'Frozen Layers': frozen_layers}, model
@@ -0,0 +1,193 @@
+"""
+Preprocessed-tensor cache for the modeling notebooks.
+
+Each split (train, validation, test) is decoded and resized once per backbone input size (224 or 299) into
+sharded .npy files that are memory-mapped when read back, next to the split's numerical features and labels:
+
+    {cache_dir}/{split}_{size}/images-00000.npy ...   (N, size, size, 3) resized images, float32 by default
+    {cache_dir}/{split}_{size}/numerical.npy          (N, F) float32 numerical features
+    {cache_dir}/{split}_{size}/labels.npy             (N,) int64 encoded labels
+    {cache_dir}/{split}_{size}/manifest.json          written last; describes the cache and its inputs
+
+The cache holds the images after tf.image.resize_with_pad and before the backbone's preprocess_input, so VGG19,
+ResNet50 and DenseNet121 share the 224 cache and only InceptionV3 needs the 299 one; preprocess_input is applied
+per batch in the tf.data pipeline. Training and evaluation then read pages of the mapped files instead of
+re-reading and re-decoding every JPEG, and never hold the whole dataset in memory.
+
+The default float32 cache feeds the models the same values as the notebooks' pipeline. dtype='uint8' is a quarter
+of the size but lossy: the antialiased resize produces fractional values, which it rounds to whole levels.
+
+Usage in a notebook (replacing prepare_dataset):
+
+    import sys; sys.path.append('/content/drive/MyDrive/.../Code - Preprocessing and Modeling')
+    from tensor_cache import build_split, make_dataset
+
+    train_cache = build_split(train_df, train_image_dir, cache_dir, 'train', 224, all_numerical_features, label_encoder)
+    train_dataset = make_dataset(train_cache, 'densenet121', batch_size=32, shuffle=True)
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+
+# Input size and preprocess_input of each backbone used in the notebooks
+BACKBONES = {
+    'vgg19': (224, tf.keras.applications.vgg19.preprocess_input),
+    'resnet50': (224, tf.keras.applications.resnet50.preprocess_input),
+    'densenet121': (224, tf.keras.applications.densenet.preprocess_input),
+    'inception_v3': (299, tf.keras.applications.inception_v3.preprocess_input),
+}
+
+# Images per shard file; 1024 images at 224x224 make shards of about 600 MB in float32 (150 MB in uint8)
+SHARD_SIZE = 1024
+# Images decoded at once while the cache is built
+DECODE_BATCH_SIZE = 64
+CACHE_FORMAT = 1
+
+def load_resized_image(image_path, image_size):
+    """Decoding and resizing an image like the notebooks' preprocess_image does, before preprocess_input (float32)."""
+    image = tf.io.read_file(image_path)
+    image = tf.image.decode_jpeg(image, channels=3)
+    return tf.image.resize_with_pad(image, image_size, image_size, antialias=True)
+
+def split_fingerprint(image_paths, image_size, dtype, numerical, labels):
+    """Fingerprinting a split's inputs (image files, numerical features, labels), so a stale cache is rebuilt."""
+    digest = hashlib.sha256(f"{CACHE_FORMAT}|{image_size}|{dtype}".encode('utf-8'))
+    for path in image_paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+    digest.update(np.ascontiguousarray(numerical).tobytes())
+    digest.update(np.ascontiguousarray(labels).tobytes())
+    return digest.hexdigest()
+
+class TensorCache:
+    """A built split, with its image shards, numerical features and labels memory-mapped read-only."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.image_size = self.manifest['image_size']
+        self.shard_size = self.manifest['shard_size']
+        self.shards = [np.load(os.path.join(directory, name), mmap_mode='r') for name in self.manifest['shards']]
+        self.numerical = np.load(os.path.join(directory, 'numerical.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(directory, 'labels.npy'), mmap_mode='r')
+        self.ids = self.manifest['ids']
+
+    def __len__(self):
+        return len(self.labels)
+
+    def read_images(self, indices):
+        """Gathering the images at the given (sorted) indices, reading only the shard pages they fall on."""
+        indices = np.asarray(indices)
+        shard_of, offset = np.divmod(indices, self.shard_size)
+        if len(indices) and shard_of[0] == shard_of[-1]:
+            # A contiguous range inside one shard is a plain slice of the mapped file
+            if offset[-1] - offset[0] + 1 == len(indices):
+                return self.shards[shard_of[0]][offset[0]:offset[-1] + 1]
+        return np.concatenate([self.shards[shard][offset[shard_of == shard]] for shard in np.unique(shard_of)])
+
+def build_split(df, image_dir, cache_dir, split, image_size, numerical_features=None, label_encoder=None,
+                dtype='float32', shard_size=SHARD_SIZE, id_column='Id', label_column='Class'):
+    """
+    Preprocessing a split into the cache once and returning it memory-mapped; an up-to-date cache is reused.
+
+    dtype 'float32' stores the resized values exactly, so the cached inputs match the notebooks' pipeline;
+    'uint8' rounds each resized pixel to the nearest level (lossy, a quarter of the size).
+    """
+    image_paths = [os.path.join(image_dir, f"{image_id}") for image_id in df[id_column].values]
+    numerical = (df[numerical_features].to_numpy(dtype=np.float32) if numerical_features
+                 else np.zeros((len(df), 0), dtype=np.float32))
+    labels = (label_encoder.transform(df[label_column].values) if label_encoder is not None
+              else df[label_column].to_numpy()).astype(np.int64)
+
+    directory = os.path.join(cache_dir, f"{split}_{image_size}")
+    fingerprint = split_fingerprint(image_paths, image_size, dtype, numerical, labels)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return TensorCache(directory)
+        # The inputs changed; the manifest goes first so a half-rebuilt cache is never taken for a valid one
+        os.remove(manifest_path)
+    os.makedirs(directory, exist_ok=True)
+
+    # Decoding in parallel with tf.data and writing each batch straight into the mapped shard files
+    decoded = tf.data.Dataset.from_tensor_slices(image_paths) \
+        .map(lambda path: load_resized_image(path, image_size), num_parallel_calls=tf.data.AUTOTUNE) \
+        .batch(DECODE_BATCH_SIZE).prefetch(tf.data.AUTOTUNE)
+    shard_names, shard, position = [], None, 0
+    for batch in decoded.as_numpy_iterator():
+        if dtype == 'uint8':
+            batch = np.clip(np.rint(batch), 0, 255).astype(np.uint8)
+        start = 0
+        while start < len(batch):
+            if shard is None or position % shard_size == 0:
+                if shard is not None:
+                    shard.flush()
+                name = f"images-{len(shard_names):05d}.npy"
+                rows = min(shard_size, len(image_paths) - position)
+                shard = np.lib.format.open_memmap(os.path.join(directory, name), mode='w+', dtype=dtype,
+                                                  shape=(rows, image_size, image_size, 3))
+                shard_names.append(name)
+            offset = position % shard_size
+            count = min(len(batch) - start, len(shard) - offset)
+            shard[offset:offset + count] = batch[start:start + count]
+            start += count
+            position += count
+    if shard is not None:
+        shard.flush()
+        del shard
+
+    np.save(os.path.join(directory, 'numerical.npy'), numerical)
+    np.save(os.path.join(directory, 'labels.npy'), labels)
+    manifest = {'format': CACHE_FORMAT, 'fingerprint': fingerprint, 'image_size': image_size, 'dtype': dtype,
+                'count': len(image_paths), 'shard_size': shard_size, 'shards': shard_names,
+                'numerical_features': list(numerical_features or []), 'ids': [str(i) for i in df[id_column].values]}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return TensorCache(directory)
+
+def make_dataset(cache, backbone, batch_size=32, shuffle=False, include_numerical=True, seed=None):
+    """
+    A tf.data pipeline over a cached split, yielding ((images, numerical), labels) for the hybrid models or
+    (images, labels) for the visual-only ones, with the backbone's preprocess_input applied per batch.
+
+    Batches are sliced from the mapped shards, so no JPEG is decoded and only the pages of the current batch
+    are read. With shuffle, the order is reshuffled every epoch and each batch is read in index order.
+    """
+    image_size, preprocess_input = BACKBONES[backbone]
+    if image_size != cache.image_size:
+        raise ValueError(f"{backbone} expects {image_size}x{image_size} images, the cache holds {cache.image_size}.")
+    count = len(cache)
+    image_dtype = np.dtype(cache.manifest['dtype'])
+    rng = np.random.default_rng(seed)
+
+    def batches():
+        order = rng.permutation(count) if shuffle else np.arange(count)
+        for start in range(0, count, batch_size):
+            indices = np.sort(order[start:start + batch_size])
+            images = cache.read_images(indices)
+            if include_numerical:
+                yield (images, cache.numerical[indices]), cache.labels[indices]
+            else:
+                yield images, cache.labels[indices]
+
+    image_spec = tf.TensorSpec((None, image_size, image_size, 3), tf.as_dtype(image_dtype))
+    label_spec = tf.TensorSpec((None,), tf.int64)
+    if include_numerical:
+        signature = ((image_spec, tf.TensorSpec((None, cache.numerical.shape[1]), tf.float32)), label_spec)
+    else:
+        signature = (image_spec, label_spec)
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+
+    def preprocess(images):
+        return preprocess_input(tf.cast(images, tf.float32))
+
+    if include_numerical:
+        dataset = dataset.map(lambda inputs, labels: ((preprocess(inputs[0]), inputs[1]), labels),
+                              num_parallel_calls=tf.data.AUTOTUNE)
+    else:
+        dataset = dataset.map(lambda images, labels: (preprocess(images), labels), num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
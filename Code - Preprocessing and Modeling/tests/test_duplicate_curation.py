@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from duplicate_curation import find_duplicate_clusters
+
+def test_chain_beyond_radius_is_not_a_duplicate_of_the_kept_image():
+    # A-B and B-C are within the radius, A-C is not
+    paths = ['a.jpg', 'b_1.jpg', 'c_12.jpg']
+    hashes = [0b0, 0b111, 0b111111]
+    clusters = find_duplicate_clusters(paths, hashes, radius=4)
+    assert clusters == [(0, [0, 1])]
+
+def test_every_member_is_within_radius_of_the_kept_image():
+    paths = [f'{"x" * (i + 1)}.jpg' for i in range(6)]
+    hashes = [0b0, 0b11, 0b1111, 0b111111, 0b11111111, 0b1]
+    for kept, members in find_duplicate_clusters(paths, hashes, radius=2):
+        assert all(bin(hashes[i] ^ hashes[kept]).count('1') <= 2 for i in members)
+
+def test_exact_duplicates_keep_the_shortest_filename():
+    paths = ['img_copy.jpg', 'img.jpg', 'other.jpg']
+    hashes = [0xabc, 0xabc, 0xfff000]
+    assert find_duplicate_clusters(paths, hashes, radius=0) == [(1, [0, 1])]
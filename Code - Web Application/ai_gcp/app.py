@@ -6,34 +6,64 @@ import joblib
 import tensorflow as tf
 from tensorflow.keras.applications.densenet import preprocess_input as preprocess_input_densenet
 from tensorflow.keras.models import load_model
-from google.cloud import storage, pubsub_v1
+from google.cloud import pubsub_v1
+import io
 import json
 import shutil
+import time
+import hashlib
+from dedup import average_hash, context_key, load_index, save_index
+from common.features import build_feature_matrix
+from common.storage import GCSStorage
 
 app = Flask(__name__)
 
+# Images within this many bits of an earlier image of the field, with the same date and location, reuse its
+# prediction instead of running the model; -1 turns the duplicate check off
+DEDUP_MAX_DISTANCE = int(os.getenv('DEDUP_MAX_DISTANCE', 4))
+
+# Only rows whose inputs changed since the batch's existing predictions are run through the model; 0 predicts every row
+INCREMENTAL_PREDICTIONS = os.getenv('INCREMENTAL_PREDICTIONS', '1') != '0'
+
+# Model artifacts, whose generations are part of every row's input hash
+MODEL_ARTIFACTS = ["label_encoder_v2_hybrid_model.joblib", "scaler.joblib", "Best_DenseNet121_Hybrid_Model.h5"]
+
+# Columns carried over from the existing predictions for rows whose inputs did not change
+PREDICTION_COLUMNS = ['Class Confidence Levels', 'Class Prediction', 'Perceptual Hash', 'Duplicate Of']
+
+def input_hash(model_version, image_checksum, features):
+    """Content hash of one row's model inputs: the model artifacts, the image content and the numerical features."""
+    digest = hashlib.sha256(f"{model_version}|{image_checksum}|".encode('utf-8'))
+    digest.update(np.ascontiguousarray(features, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def load_existing_predictions(storage, image_folder):
+    """The batch's existing predictions by image path, or an empty dict when it has none."""
+    data = storage.read_if_exists(f"{image_folder}/predictions_with_confidences.json")
+    if data is None:
+        return {}
+    return {prediction['Id']: prediction for prediction in json.loads(data)}
+
 # Function to run the model with field_id and batch_id
-def run_hybrid_model(field_id, batch_id, bucket_name):
-    
+def run_hybrid_model(field_id, batch_id, bucket_name, trace=None):
+    stage_start = time.time()
     gcs_base_path = f"gs://{bucket_name}"
     
-    # Initialize Google Cloud Storage client
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    # Storage backend shared with the pipeline functions
+    storage = GCSStorage(bucket_name)
 
-    # Set up directories
+    # Set up the directory the model loaders read from
     model_dir = "/tmp/model_artifacts"
     os.makedirs(model_dir, exist_ok=True)
-    local_tmp_dir = f"/tmp/userdata/{field_id}/{batch_id}"  # Local directory for temporary files
-    os.makedirs(local_tmp_dir, exist_ok=True)
     
-    # Downloading model artifacts from GCS
-    blob = bucket.blob("model_artifacts/label_encoder_v2_hybrid_model.joblib")
-    blob.download_to_filename(os.path.join(model_dir, "label_encoder_v2_hybrid_model.joblib"))
-    blob = bucket.blob("model_artifacts/scaler.joblib")
-    blob.download_to_filename(os.path.join(model_dir, "scaler.joblib"))
-    blob = bucket.blob("model_artifacts/Best_DenseNet121_Hybrid_Model.h5")
-    blob.download_to_filename(os.path.join(model_dir, "Best_DenseNet121_Hybrid_Model.h5"))
+    # Downloading model artifacts from GCS, noting their generations so a new model invalidates every row
+    generations = []
+    for artifact in MODEL_ARTIFACTS:
+        data, generation = storage.read_with_generation(f"model_artifacts/{artifact}")
+        with open(os.path.join(model_dir, artifact), 'wb') as f:
+            f.write(data)
+        generations.append(str(generation))
+    model_version = "-".join(generations)
 
     # Loading model components
     label_encoder = joblib.load(os.path.join(model_dir, 'label_encoder_v2_hybrid_model.joblib'))
@@ -43,25 +73,17 @@ def run_hybrid_model(field_id, batch_id, bucket_name):
     # Construct paths
     image_folder = f"userdata/{field_id}/{batch_id}"
     combined_data_file = f"{image_folder}/combined_data.csv"
-    local_csv_path = os.path.join(local_tmp_dir, "combined_data.csv")
-
-    # Download the CSV file
-    blob = bucket.blob(combined_data_file)
-    blob.download_to_filename(local_csv_path)
 
     # Read numerical data
-    numerical_df = pd.read_csv(local_csv_path)
-    features_to_standardize = ['Avg Temp 14d', 'Avg Humidity 14d', 'Total Precipitation 14d', 'Avg Wind Speed 14d']
-    all_numerical_features = ['Avg Temp 14d', 'Avg Humidity 14d', 'Total Precipitation 14d', 'Avg Wind Speed 14d', 'NDVI MODIS', 'NDVI - 1 MODIS', 'NDVI - 2 MODIS',
-       'EVI MODIS', 'EVI - 1 MODIS', 'EVI - 2 MODIS', 'NDVI 1 Decrease',
-       'NDVI 2 Decrease', 'EVI 1 Decrease', 'EVI 2 Decrease']
-    
-    numerical_df[features_to_standardize] = scaler.transform(numerical_df[features_to_standardize])
+    numerical_df = pd.read_csv(io.BytesIO(storage.read(combined_data_file)))
+
+    # Standardized numerical input of every row at once, built by the shared feature library
+    numerical_features = build_feature_matrix(numerical_df, scaler)
+    raw_features = build_feature_matrix(numerical_df, dtype=np.float64)
 
     # Function to preprocess images
-    def preprocess_image_densenet121(image_path):
-        image = tf.io.read_file(image_path)
-        image = tf.image.decode_jpeg(image, channels=3)
+    def preprocess_image_densenet121(image_bytes):
+        image = tf.image.decode_jpeg(image_bytes, channels=3)
         image = tf.image.resize_with_pad(image, 224, 224, antialias=True)
         image = preprocess_input_densenet(image)
         image = np.expand_dims(image, axis=0)
@@ -70,15 +92,55 @@ def run_hybrid_model(field_id, batch_id, bucket_name):
     # Preparing columns in the dataframe for predictions
     numerical_df['Class Confidence Levels'] = np.nan
     numerical_df['Class Prediction'] = np.nan
+    numerical_df['Perceptual Hash'] = None
+    numerical_df['Duplicate Of'] = None
+    numerical_df['Input Hash'] = None
 
     # Adjust 'Id' column to include the full GCS path for images
     numerical_df['Id'] = numerical_df['Id'].apply(lambda x: f"{gcs_base_path}/{image_folder}/{x}")
 
+    # Content checksums of the batch's images from one listing, so unchanged images are never downloaded
+    entries, _ = storage.list(f"{image_folder}/")
+    image_checksums = {f"{gcs_base_path}/{entry.name}": entry.checksum for entry in entries}
+    existing_predictions = load_existing_predictions(storage, image_folder) if INCREMENTAL_PREDICTIONS else {}
+    reused = 0
+
+    # Earlier images of the field predicted by the same model, so duplicates (also within this batch) reuse their
+    # prediction; an image re-predicted after a model change replaces its own entry and never matches it
+    dedup_index, dedup_generation = load_index(storage, field_id, DEDUP_MAX_DISTANCE) if DEDUP_MAX_DISTANCE >= 0 else (None, 0)
+    duplicates = 0
+
     # Predicting and filling the dataframe with the predicted class and confidence levels
-    for index, row in numerical_df.iterrows():
-        img_array = preprocess_image_densenet121(row['Id'])
-        num_data = row[all_numerical_features].to_numpy().reshape(1, -1)
-        num_data = np.array(num_data, dtype=np.float32)
+    for position, (index, row) in enumerate(numerical_df.iterrows()):
+        image_checksum = image_checksums.get(row['Id'])
+        row_hash = input_hash(model_version, image_checksum, raw_features[position]) if image_checksum else None
+        numerical_df.at[index, 'Input Hash'] = row_hash
+
+        # Keeping the existing prediction of a row whose image and numerical inputs are unchanged
+        existing = existing_predictions.get(row['Id'])
+        if row_hash is not None and existing is not None and existing.get('Input Hash') == row_hash:
+            for column in PREDICTION_COLUMNS:
+                numerical_df.at[index, column] = existing.get(column)
+            reused += 1
+            continue
+
+        image_bytes = storage.read(row['Id'][len(gcs_base_path) + 1:])
+
+        if dedup_index is not None:
+            phash = average_hash(image_bytes)
+            context = context_key(row['Date'], row['Latitude'], row['Longitude'])
+            numerical_df.at[index, 'Perceptual Hash'] = f"{phash:016x}"
+            match = dedup_index.find(phash, context, model_version, exclude_id=row['Id'])
+            if match is not None:
+                earlier, distance = match
+                numerical_df.at[index, 'Class Confidence Levels'] = earlier['confidences']
+                numerical_df.at[index, 'Class Prediction'] = earlier['prediction']
+                numerical_df.at[index, 'Duplicate Of'] = earlier['id']
+                duplicates += 1
+                continue
+
+        img_array = preprocess_image_densenet121(image_bytes)
+        num_data = numerical_features[position:position + 1]
 
         # Generating class probability predictions
         prediction = model.predict([img_array, num_data])[0]
@@ -95,33 +157,39 @@ def run_hybrid_model(field_id, batch_id, bucket_name):
         # Updating the dataframe with the prediction and confidence levels
         numerical_df.at[index, 'Class Confidence Levels'] = str(sorted_confidences)
         numerical_df.at[index, 'Class Prediction'] = predicted_class
+        if dedup_index is not None and context is not None:
+            dedup_index.add(phash, context, {'id': row['Id'], 'prediction': predicted_class,
+                                             'confidences': str(sorted_confidences), 'model_version': model_version})
+
+    if dedup_index is not None and dedup_index.added:
+        save_index(storage, field_id, dedup_index, dedup_generation)
+    print(f"Kept the existing predictions of {reused} unchanged images and reused earlier predictions for "
+          f"{duplicates} duplicates, of {len(numerical_df)} images of batch {batch_id}.")
 
     # Selecting specific columns to save
-    columns_to_save = ['Id', 'Latitude', 'Longitude', 'Date', 'Class Confidence Levels', 'Class Prediction']
+    columns_to_save = ['Id', 'Latitude', 'Longitude', 'Date', 'Class Confidence Levels', 'Class Prediction',
+                       'Perceptual Hash', 'Duplicate Of', 'Input Hash']
     export_df = numerical_df[columns_to_save]
 
-    # Save predictions locally
-    local_csv_output = os.path.join(local_tmp_dir, "predictions_with_confidences.csv")
-    local_json_output = os.path.join(local_tmp_dir, "predictions_with_confidences.json")
-    export_df.to_csv(local_csv_output, index=False)
-    export_df.to_json(local_json_output, orient='records')
-
     # Upload prediction files to GCS
-    blob_csv = bucket.blob(f"{image_folder}/predictions_with_confidences.csv")
-    blob_csv.upload_from_filename(local_csv_output)
-    blob_json = bucket.blob(f"{image_folder}/predictions_with_confidences.json")
-    blob_json.upload_from_filename(local_json_output)
+    storage.write(f"{image_folder}/predictions_with_confidences.csv", export_df.to_csv(index=False).encode('utf-8'),
+                  content_type='text/csv')
+    storage.write(f"{image_folder}/predictions_with_confidences.json",
+                  export_df.to_json(orient='records').encode('utf-8'), content_type='application/json')
 
     # Cleanup local temporary files
     shutil.rmtree(model_dir)
-    shutil.rmtree(local_tmp_dir)
+
+    # Append this stage's timings to the batch trace
+    trace = trace or {}
+    trace.setdefault("stages", []).append({"stage": "predict", "start": stage_start, "end": time.time()})
 
     # Publish a message to the topic predictions_made
     publisher = pubsub_v1.PublisherClient()
     project_id = "tidy-nomad-415320"
     topic_name = "predictions_made"
     topic_path = publisher.topic_path(project_id, topic_name)
-    data = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id}
+    data = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id, "trace": trace}
     message = json.dumps(data).encode("utf-8")
     future = publisher.publish(topic_path, data=message)
     future.result()
@@ -137,7 +205,7 @@ def predict():
     batch_id = instance['batch_id']
     bucket_name = instance['bucket']
 
-    result = run_hybrid_model(field_id, batch_id, bucket_name)
+    result = run_hybrid_model(field_id, batch_id, bucket_name, instance.get('trace'))
     return jsonify(result)
 
 # Health Check Route
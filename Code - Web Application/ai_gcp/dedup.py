@@ -0,0 +1,139 @@
+import io
+import json
+import numpy as np
+from PIL import Image
+from collections import defaultdict
+from common.storage import GenerationMismatch
+
+# Near-duplicate index of the images a field has already been predicted on. Re-flown grids and
+# accidental re-uploads produce images whose perceptual hashes differ in only a few bits; when such an
+# image also has the same date and location as an earlier one, the earlier prediction is reused instead
+# of running the model again. The index of each field is a JSON file next to the field's batches.
+
+HASH_BITS = 64
+# Location is compared at 4 decimal places (about 11 m), so GPS jitter between re-uploads still matches
+LOCATION_DECIMALS = 4
+
+def average_hash(image_bytes, hash_size=8):
+    """Perceptual hash of an image, computed like imagehash.average_hash and returned as an int."""
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG decoding can scale down on the fly, so the full-size image is never decoded just to be hashed
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    pixels = np.asarray(image.convert('L').resize((hash_size, hash_size), Image.LANCZOS), dtype=np.float32)
+    bits = (pixels > pixels.mean()).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def context_key(date, latitude, longitude):
+    """The numeric context an earlier prediction is only reused under: flight date and rounded location."""
+    if latitude is None or longitude is None or latitude != latitude or longitude != longitude:
+        return None
+    return f"{date}|{round(float(latitude), LOCATION_DECIMALS)}|{round(float(longitude), LOCATION_DECIMALS)}"
+
+class DuplicateIndex:
+    """
+    Multi-index hashing over 64-bit perceptual hashes.
+
+    Each hash is split into max_distance + 1 bands and every entry is filed under each of its band values.
+    Two hashes within max_distance bits of each other must agree exactly on at least one band, so a lookup
+    only compares the entries sharing a band with the query instead of scanning the whole field.
+    """
+
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        widths = [HASH_BITS // bands + (1 if i < HASH_BITS % bands else 0) for i in range(bands)]
+        self._bands = []
+        shift = HASH_BITS
+        for width in widths:
+            shift -= width
+            self._bands.append((shift, (1 << width) - 1))
+        self._tables = [defaultdict(list) for _ in self._bands]
+        self._by_id = {}
+        self.entries = []
+        self.added = 0
+
+    def add(self, phash, context, record):
+        """File an entry under its hash, replacing the earlier entry of the same image id."""
+        previous = self._by_id.get(record.get('id'))
+        if previous is not None:
+            self._remove(previous)
+        entry = dict(record, hash=f"{phash:016x}", context=context)
+        self.entries.append(entry)
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table[(phash >> shift) & mask].append(entry)
+        if entry.get('id') is not None:
+            self._by_id[entry['id']] = entry
+        self.added += 1
+        return entry
+
+    def _remove(self, entry):
+        phash = int(entry['hash'], 16)
+        self.entries = [other for other in self.entries if other is not entry]
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table[(phash >> shift) & mask] = [other for other in table[(phash >> shift) & mask] if other is not entry]
+        del self._by_id[entry['id']]
+
+    def find(self, phash, context, model_version=None, exclude_id=None):
+        """
+        Return the closest entry with the same context within max_distance bits and its distance, or None.
+
+        Only entries predicted by model_version are matched, so a new model never reuses the old model's
+        predictions, and the entry of exclude_id (the image being looked up) never matches itself.
+        """
+        if context is None:
+            return None
+        best, best_distance = None, self.max_distance + 1
+        seen = set()
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for entry in table.get((phash >> shift) & mask, ()):
+                if id(entry) in seen or entry['context'] != context:
+                    continue
+                seen.add(id(entry))
+                if entry.get('model_version') != model_version or (exclude_id and entry.get('id') == exclude_id):
+                    continue
+                distance = bin(phash ^ int(entry['hash'], 16)).count('1')
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+        return (best, best_distance) if best is not None else None
+
+    def to_json(self):
+        return json.dumps(self.entries)
+
+    @classmethod
+    def from_json(cls, data, max_distance=4):
+        index = cls(max_distance)
+        for entry in json.loads(data):
+            index.add(int(entry.pop('hash'), 16), entry.pop('context'), entry)
+        index.added = 0
+        return index
+
+def index_path(field_id):
+    return f"userdata/{field_id}/dedup_index.json"
+
+def load_index(storage, field_id, max_distance):
+    """Load a field's index with the generation it was read at (0 when the field has none yet)."""
+    data, generation = storage.read_with_generation(index_path(field_id))
+    if data is None:
+        return DuplicateIndex(max_distance), 0
+    return DuplicateIndex.from_json(data, max_distance), generation
+
+def save_index(storage, field_id, index, generation, attempts=3):
+    """
+    Append the entries added to the index to the stored one.
+
+    The write is conditional on the generation that was read; if another batch of the same field saved in
+    the meantime, its entries are reloaded and the new ones merged in before trying again.
+    """
+    new_entries = index.entries[len(index.entries) - index.added:]
+    for _ in range(attempts):
+        try:
+            storage.write(index_path(field_id), index.to_json().encode('utf-8'), content_type='application/json',
+                          if_generation_match=generation)
+            return True
+        except GenerationMismatch:
+            index, generation = load_index(storage, field_id, index.max_distance)
+            for entry in new_entries:
+                entry = dict(entry)
+                index.add(int(entry.pop('hash'), 16), entry.pop('context'), entry)
+    print(f"Could not save the duplicate index of field {field_id} after {attempts} attempts.")
+    return False
@@ -1,15 +1,14 @@
-from flask import Flask, render_template, flash, redirect, url_for
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
-from .config import Config
+from .startup_profiler import startup_profiler
 import logging
-from google.cloud import storage
-import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
-from google.cloud.sql.connector import Connector, IPTypes
-import pymysql
-import google.cloud.logging
+
+with startup_profiler.section('import flask'):
+    from flask import Flask, render_template, flash, redirect, url_for
+    from flask_sqlalchemy import SQLAlchemy
+    from flask_login import LoginManager
+    import sqlalchemy
+
+with startup_profiler.section('config'):
+    from .config import Config
 
 db = SQLAlchemy() 
 
@@ -18,9 +17,13 @@ login_manager = LoginManager()
 
 # Set up Google Cloud Logging
 def setup_logging():
-    client = google.cloud.logging.Client()
-    client.setup_logging()
-    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
+    if Config.ENV_MODE == 'production':
+        # App Engine collects structured logs written to stdout, so no Cloud Logging API client is needed
+        from google.cloud.logging.handlers import StructuredLogHandler
+        logging.getLogger().addHandler(StructuredLogHandler())
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s: %(message)s')
 
 def connect_with_connector() -> sqlalchemy.engine.base.Engine:
     """
@@ -28,6 +31,9 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     Uses the Cloud SQL Python Connector package.
     """
+    from google.cloud.sql.connector import Connector, IPTypes
+    import pymysql
+
     connector = Connector(IPTypes.PUBLIC)
 
     def getconn() -> pymysql.connections.Connection:
@@ -51,7 +57,8 @@ def create_app():
     app.config.from_object(Config)
 
     # Configure logging
-    setup_logging()
+    with startup_profiler.section('logging'):
+        setup_logging()
 
     # Use the Cloud SQL Connector to establish a connection engine
     #engine = connect_with_connector()
@@ -69,7 +76,7 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = Config.SQLALCHEMY_DATABASE_URI
 
     # Import models to ensure they are known to SQLAlchemy
-    from .models import User, Field, Batch, Image
+    from .models import User, Field, Batch, Image, BatchStage, FieldCellSummary, OutboxMessage
 
     # User loader callback for Flask-Login
     @login_manager.user_loader
@@ -91,16 +98,50 @@ def create_app():
         db.session.rollback()
         return render_template('500.html'), 500
 
+    # Relay batch status events across instances when a shared backend is configured
+    if Config.EVENTS_REDIS_URL:
+        from .events import broker, RedisBackend
+        broker.configure(RedisBackend(Config.EVENTS_REDIS_URL))
+
+    # Size the response cache, sharing it across instances when a shared backend is configured
+    from .cache import response_cache, InProcessCacheBackend, RedisCacheBackend
+    if Config.RESPONSE_CACHE_REDIS_URL:
+        response_cache.configure(RedisCacheBackend(Config.RESPONSE_CACHE_REDIS_URL, ttl=Config.RESPONSE_CACHE_TTL))
+    else:
+        if Config.ENV_MODE == 'production':
+            logging.warning("RESPONSE_CACHE_REDIS_URL is not set; the response cache is per worker and invalidations "
+                            "do not reach the other workers or instances")
+        response_cache.configure(InProcessCacheBackend(max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+                                                       ttl=Config.RESPONSE_CACHE_TTL))
+
+    # Publish queued Pub/Sub messages in the background once their transaction has committed (started by the
+    # first request served, so CLI commands and tests never run it)
+    from .outbox import init_dispatcher, InMemoryPublisher
+    if Config.OUTBOX_PUBLISHER == 'memory':
+        memory_publisher = InMemoryPublisher()
+        publisher_factory = lambda: memory_publisher
+    else:
+        from .clients import get_publisher
+        publisher_factory = get_publisher
+    init_dispatcher(app, publisher_factory, Config.PROJECT, Config.OUTBOX_BATCH_SIZE, Config.OUTBOX_POLL_SECONDS)
+
     # Register blueprints for different parts of the app
-    from .auth import auth as auth_blueprint
-    app.register_blueprint(auth_blueprint, url_prefix='/auth')
+    with startup_profiler.section('blueprints'):
+        from .auth import auth as auth_blueprint
+        app.register_blueprint(auth_blueprint, url_prefix='/auth')
+
+        from .main import main as main_blueprint
+        app.register_blueprint(main_blueprint, url_prefix='/main')
 
-    from .main import main as main_blueprint
-    app.register_blueprint(main_blueprint, url_prefix='/main')
+    # Command line tools (flask --app app benchmark)
+    from .benchmark import benchmark_command
+    app.cli.add_command(benchmark_command)
 
     return app
 
-app = create_app()
+with startup_profiler.section('create_app'):
+    app = create_app()
+startup_profiler.log()
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,169 @@
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+# Response cache for the field timeline and grid endpoints of the main blueprint.
+# Entries are grouped by field so that an upload or a prediction update can drop everything cached
+# for the field at once. The in-process LRU serves a single instance; with several instances a shared
+# backend (e.g. RedisCacheBackend) makes an invalidation on one instance visible to all of them.
+# Every invalidation also bumps the field's generation, and a computed value is only stored if the generation
+# it was computed under is still current, so a response built from rows read before an invalidation is dropped.
+
+class InProcessCacheBackend:
+    """Bounded LRU of entries kept in this process."""
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._field_keys = {}
+        self._generations = {}
+
+    def generation(self, field_id):
+        with self._lock:
+            return self._generations.get(field_id, 0)
+
+    def get(self, field_id, key):
+        with self._lock:
+            entry = self._entries.get((field_id, key))
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                self._remove((field_id, key))
+                return None
+            self._entries.move_to_end((field_id, key))
+            return value
+
+    def set(self, field_id, key, value, generation):
+        with self._lock:
+            if self._generations.get(field_id, 0) != generation:
+                return
+            self._entries[(field_id, key)] = (value, time.time() + self.ttl)
+            self._entries.move_to_end((field_id, key))
+            self._field_keys.setdefault(field_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, field_id):
+        with self._lock:
+            self._generations[field_id] = self._generations.get(field_id, 0) + 1
+            for key in self._field_keys.pop(field_id, set()):
+                self._entries.pop((field_id, key), None)
+
+    def _remove(self, entry_key):
+        self._entries.pop(entry_key, None)
+        field_id, key = entry_key
+        keys = self._field_keys.get(field_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._field_keys[field_id]
+
+class RedisCacheBackend:
+    """Keeps each field's entries in one Redis hash next to a generation counter, so invalidating is one INCR and DEL."""
+
+    PREFIX = 'response-cache'
+
+    def __init__(self, url, ttl=300):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._watch_error = redis.WatchError
+        self.ttl = ttl
+
+    def _hash(self, field_id):
+        return f"{self.PREFIX}:{field_id}"
+
+    def _generation_key(self, field_id):
+        return f"{self.PREFIX}-generation:{field_id}"
+
+    def generation(self, field_id):
+        return int(self._redis.get(self._generation_key(field_id)) or 0)
+
+    def get(self, field_id, key):
+        value = self._redis.hget(self._hash(field_id), key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, field_id, key, value, generation):
+        # Watching the generation key aborts the write if an invalidation lands between the check and the write
+        with self._redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(self._generation_key(field_id))
+                if int(pipeline.get(self._generation_key(field_id)) or 0) != generation:
+                    return
+                pipeline.multi()
+                pipeline.hset(self._hash(field_id), key, json.dumps(value))
+                pipeline.expire(self._hash(field_id), self.ttl)
+                pipeline.execute()
+            except self._watch_error:
+                pass
+
+    def invalidate(self, field_id):
+        pipeline = self._redis.pipeline()
+        pipeline.incr(self._generation_key(field_id))
+        pipeline.delete(self._hash(field_id))
+        pipeline.execute()
+
+class ResponseCache:
+    """Entry point used by the views; counts hits and misses and never lets a backend error fail a request."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessCacheBackend()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Turned off, every lookup computes its value without reading or storing entries (benchmarks)
+        self.enabled = True
+
+    def configure(self, backend):
+        self.backend = backend
+
+    def get_or_compute(self, field_id, key, compute):
+        """Return the cached value for a field's key, computing and storing it on a miss."""
+        if not self.enabled:
+            return compute()
+        try:
+            # The generation is read before the rows, so an invalidation while computing keeps the value out
+            generation = self.backend.generation(int(field_id))
+            value = self.backend.get(int(field_id), key)
+        except Exception as e:
+            logging.error(f"Response cache read failed for field {field_id}: {e}")
+            generation, value = None, None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is not None:
+            return value
+
+        value = compute()
+        if value is not None and generation is not None:
+            try:
+                self.backend.set(int(field_id), key, value, generation)
+            except Exception as e:
+                logging.error(f"Response cache write failed for field {field_id}: {e}")
+        return value
+
+    def invalidate(self, field_id):
+        """Drop every cached response of a field, after a change to its batches or images was committed."""
+        try:
+            self.backend.invalidate(int(field_id))
+        except Exception as e:
+            # Entries still expire after the backend's TTL
+            logging.error(f"Response cache invalidation failed for field {field_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
+
+response_cache = ResponseCache()
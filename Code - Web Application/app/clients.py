@@ -0,0 +1,57 @@
+import threading
+from .startup_profiler import startup_profiler
+
+# Google Cloud clients shared by the app. Each one is created on first use rather than at import time,
+# so a cold start only pays for the clients the first requests actually need.
+
+_lock = threading.RLock()
+_storage_client = None
+_publisher = None
+_buckets = {}
+_storage = None
+
+def get_storage_client():
+    """Return the process-wide storage client, creating it on first use."""
+    global _storage_client
+    if _storage_client is None:
+        with _lock:
+            if _storage_client is None:
+                with startup_profiler.section('client: storage'):
+                    from google.cloud import storage
+                    _storage_client = storage.Client()
+    return _storage_client
+
+def get_bucket(bucket_name):
+    """Return a cached bucket handle (no API call is made to build it)."""
+    if bucket_name not in _buckets:
+        _buckets[bucket_name] = get_storage_client().bucket(bucket_name)
+    return _buckets[bucket_name]
+
+def get_publisher():
+    """Return the process-wide Pub/Sub publisher, creating it on first use."""
+    global _publisher
+    if _publisher is None:
+        with _lock:
+            if _publisher is None:
+                with startup_profiler.section('client: pubsub publisher'):
+                    from google.cloud import pubsub_v1
+                    _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+def get_storage():
+    """Return the process-wide storage backend selected by STORAGE_BACKEND, creating it on first use."""
+    global _storage
+    if _storage is None:
+        with _lock:
+            if _storage is None:
+                # Shared with the cloud functions; deploy.sh stages it next to the app as cloud_functions/common
+                from cloud_functions.common.storage import LocalStorage, GCSStorage, MemoryStorage
+                from .config import Config
+                if Config.STORAGE_BACKEND == 'gcs':
+                    _storage = GCSStorage(Config.GCS_BUCKET_NAME, client=get_storage_client(),
+                                          listing_ttl=Config.STORAGE_LISTING_TTL)
+                elif Config.STORAGE_BACKEND == 'memory':
+                    _storage = MemoryStorage(listing_ttl=Config.STORAGE_LISTING_TTL)
+                else:
+                    _storage = LocalStorage(Config.STORAGE_LOCAL_ROOT, listing_ttl=Config.STORAGE_LISTING_TTL)
+    return _storage
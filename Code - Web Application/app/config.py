@@ -1,17 +1,101 @@
 import os
-from google.cloud import secretmanager, storage
-from google.oauth2 import service_account
 import json
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .startup_profiler import startup_profiler
+
+_secret_client = None
+_secret_client_lock = threading.Lock()
+
+# Optional local cache of the secrets, shared by the worker processes of an instance (0 disables it)
+SECRETS_CACHE_PATH = os.getenv('SECRETS_CACHE_PATH', '/tmp/app-secrets.json')
+SECRETS_CACHE_TTL = int(os.getenv('SECRETS_CACHE_TTL', 0))
+
+def get_secret_client():
+    """Return the process-wide Secret Manager client, creating it on first use."""
+    global _secret_client
+    if _secret_client is None:
+        with _secret_client_lock:
+            if _secret_client is None:
+                with startup_profiler.section('client: secret manager'):
+                    from google.cloud import secretmanager
+                    _secret_client = secretmanager.SecretManagerServiceClient()
+    return _secret_client
 
 def get_secret(secret_name):
     """Retrieve a secret value from Google Cloud Secret Manager."""
-    client = secretmanager.SecretManagerServiceClient()
     project_id = "tidy-nomad-415320"
     name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-    response = client.access_secret_version(name=name)
+    response = get_secret_client().access_secret_version(name=name)
     secret_string = response.payload.data.decode('UTF-8')
     return secret_string
 
+def load_cached_secrets(secret_names):
+    """
+    Return the secrets from the local cache if it holds all of them and is younger than the TTL.
+
+    A cache file that is not owned by the app's user, or that other users can read or write, is ignored.
+    """
+    if SECRETS_CACHE_TTL <= 0:
+        return None
+    try:
+        descriptor = os.open(SECRETS_CACHE_PATH, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        with os.fdopen(descriptor) as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+                return None
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached.get('fetched_at', 0) > SECRETS_CACHE_TTL:
+        return None
+    if not all(name in cached['values'] for name in secret_names):
+        return None
+    return cached['values']
+
+def save_cached_secrets(values):
+    """
+    Write the secrets to the local cache, readable by the app's user only.
+
+    The file is written under a new name and renamed over the cache, so an existing file's permissions or owner
+    never carry over to the secrets.
+    """
+    if SECRETS_CACHE_TTL <= 0:
+        return
+    directory, name = os.path.split(SECRETS_CACHE_PATH)
+    try:
+        descriptor, temporary_path = tempfile.mkstemp(prefix=f".{name}.", dir=directory or '.')
+    except OSError:
+        return
+    try:
+        with os.fdopen(descriptor, 'w') as f:
+            os.fchmod(f.fileno(), 0o600)
+            json.dump({'fetched_at': time.time(), 'values': values}, f)
+        os.replace(temporary_path, SECRETS_CACHE_PATH)
+    except OSError:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+
+def get_secrets(secret_names):
+    """
+    Retrieve several secrets concurrently over one Secret Manager client.
+
+    The requests are independent, so fetching them in parallel makes start-up wait for the slowest one
+    instead of the sum of all of them.
+    """
+    with startup_profiler.section('secrets'):
+        values = load_cached_secrets(secret_names)
+        if values is None:
+            get_secret_client()
+            with ThreadPoolExecutor(max_workers=len(secret_names)) as pool:
+                values = dict(zip(secret_names, pool.map(get_secret, secret_names)))
+            save_cached_secrets(values)
+        return values
+
 def setup_google_credentials():
     """
     Fetches service account credentials from Google Cloud Secret Manager and returns
@@ -20,6 +104,7 @@ def setup_google_credentials():
     project_id = 'tidy-nomad-415320'
     secret_id = 'main-service-acc-key'
     service_account_info = get_secret(secret_id)
+    from google.oauth2 import service_account
 
     # Load the service account into a dictionary, which can then be used to create a credentials object
     service_account_info_json = json.loads(service_account_info)
@@ -47,23 +132,54 @@ class Config:
     # Database and secrets
     if ENV_MODE == 'production':
         # Production environment using Secret Manager
-        SECRET_KEY = get_secret('flask_secret_key')
-        DB_USER = get_secret('DB_USER')
-        DB_PASS = get_secret('DB_PASS')
-        DB_HOST = get_secret('DB_HOST')
-        DB_NAME = get_secret('DB_NAME')
-        DB_CONN_NAME = get_secret('DB_CONN_NAME')
+        _secrets = get_secrets(['flask_secret_key', 'DB_USER', 'DB_PASS', 'DB_HOST', 'DB_NAME', 'DB_CONN_NAME'])
+        SECRET_KEY = _secrets['flask_secret_key']
+        DB_USER = _secrets['DB_USER']
+        DB_PASS = _secrets['DB_PASS']
+        DB_HOST = _secrets['DB_HOST']
+        DB_NAME = _secrets['DB_NAME']
+        DB_CONN_NAME = _secrets['DB_CONN_NAME']
         SQLALCHEMY_DATABASE_URI = f"mysql+pymysql://{DB_USER}:{DB_PASS}@/{DB_NAME}?unix_socket=/cloudsql/{DB_CONN_NAME}"
- 
-        # Set up Google Cloud Storage client
-        storage_client = storage.Client()
-        gcs_bucket = storage_client.bucket(GCS_BUCKET_NAME)
 
     else:
         # Local development environment using environment variables
         SECRET_KEY = os.getenv('SECRET_KEY', 'your_default_secret_key')
         SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI', 'sqlite:///database.db')
 
+    # Storage of uploads and pipeline outputs: 'local' (files under STORAGE_LOCAL_ROOT), 'gcs' (GCS_BUCKET_NAME)
+    # or 'memory'; directory listings are cached for STORAGE_LISTING_TTL seconds
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'gcs' if ENV_MODE == 'production' else 'local')
+    STORAGE_LOCAL_ROOT = os.getenv('STORAGE_LOCAL_ROOT', '.')
+    STORAGE_LISTING_TTL = float(os.getenv('STORAGE_LISTING_TTL', 5))
+
+    # Shared backend for batch status events when running more than one instance (in-process otherwise)
+    EVENTS_REDIS_URL = os.getenv('EVENTS_REDIS_URL')
+    # Concurrent batch event streams per worker process, each holding a thread; 0 serves every client by polling
+    EVENT_STREAMS_MAX = int(os.getenv('EVENT_STREAMS_MAX', 2))
+
+    # Response cache of the field timeline and grid endpoints. Production should set RESPONSE_CACHE_REDIS_URL: the
+    # in-process LRU is per worker, so an invalidation in one worker or instance leaves the others serving stale
+    # entries until their TTL; it is meant for development and single-worker deployments
+    RESPONSE_CACHE_REDIS_URL = os.getenv('RESPONSE_CACHE_REDIS_URL')
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+
+    # Batch uploads: direct-to-bucket signed resumable uploads (production), and the size of the
+    # server-side upload pool used when images are posted to the app (local storage)
+    DIRECT_UPLOADS = os.getenv('DIRECT_UPLOADS', 'true' if ENV_MODE == 'production' else 'false') == 'true'
+    UPLOAD_URL_EXPIRATION_MINUTES = int(os.getenv('UPLOAD_URL_EXPIRATION_MINUTES', 15))
+    UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 8))
+    # Streaming uploads: bytes read from the request per step, and the GCS resumable chunk (a multiple of 256 KiB)
+    STREAM_READ_SIZE = 64 * 1024
+    STREAM_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+    # Outbox dispatcher: 'pubsub' publishes for real, 'memory' records messages in process (development, tests)
+    OUTBOX_PUBLISHER = os.getenv('OUTBOX_PUBLISHER', 'pubsub' if ENV_MODE == 'production' else 'memory')
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+    OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', 5))
+    # Run the background dispatcher once the app serves requests; off for a process that only drains by hand
+    OUTBOX_DISPATCHER = os.getenv('OUTBOX_DISPATCHER', 'true') == 'true'
+
     # Hybrid Model
     MODEL_DIR = 'ai'
     MODEL_SCRIPT = 'hybrid_model.py'
@@ -0,0 +1,91 @@
+import json
+import queue
+import threading
+import logging
+
+# Fan-out of batch status events to the Server-Sent Events streams of the main blueprint.
+# The in-process backend only reaches streams served by the same worker process, so it is enough for a
+# single instance with one gunicorn worker; otherwise a shared backend (e.g. RedisBackend) relays each event
+# to the subscribers of every process. Streams also need a host that does not buffer responses, which App
+# Engine standard does; there EVENT_STREAMS_MAX is 0 and the dashboard polls.
+
+class InProcessBackend:
+    """Delivers events to subscribers living in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, batch_id):
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(batch_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, batch_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(batch_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(batch_id, None)
+
+    def publish(self, batch_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(batch_id, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A stalled client only misses intermediate events; it re-reads the status when it reconnects
+                logging.warning(f"Dropping batch event for a slow subscriber of batch {batch_id}")
+
+class RedisBackend(InProcessBackend):
+    """Relays events through a Redis channel so every instance delivers them to its own subscribers."""
+
+    CHANNEL = 'batch-events'
+
+    def __init__(self, url):
+        super().__init__()
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        pubsub = self._redis.pubsub()
+        pubsub.subscribe(self.CHANNEL)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                payload = json.loads(message['data'])
+                super().publish(payload['batch_id'], payload['event'])
+
+    def publish(self, batch_id, event):
+        self._redis.publish(self.CHANNEL, json.dumps({'batch_id': batch_id, 'event': event}))
+
+class BatchEventBroker:
+    """Entry point used by the views; the backend can be swapped at app start-up."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or InProcessBackend()
+
+    def configure(self, backend):
+        self.backend = backend
+
+    def subscribe(self, batch_id):
+        return self.backend.subscribe(int(batch_id))
+
+    def unsubscribe(self, batch_id, subscriber):
+        self.backend.unsubscribe(int(batch_id), subscriber)
+
+    def publish(self, batch_id, event):
+        try:
+            self.backend.publish(int(batch_id), event)
+        except Exception as e:
+            # Streams fall back to polling, so a failed notification must never fail the caller
+            logging.error(f"Failed to publish batch event for batch {batch_id}: {e}")
+
+broker = BatchEventBroker()
+
+def format_sse(event, data):
+    """Serialize one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
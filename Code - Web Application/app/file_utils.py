@@ -1,91 +1,133 @@
 import os
+import shutil
 from flask import current_app
 from app.config import Config
-from google.cloud import storage
+from app.clients import get_bucket, get_storage
 import json
 from werkzeug.utils import secure_filename
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import logging
 
+# Files go through the storage backend selected by STORAGE_BACKEND (local directory, GCS bucket or memory),
+# so these helpers no longer branch on ENV_MODE; only the signed upload URLs are specific to GCS.
+
+# Bounded pool shared by all requests, so concurrent uploads never open more than this many transfers at once
+upload_pool = ThreadPoolExecutor(max_workers=Config.UPLOAD_WORKERS, thread_name_prefix='upload')
+
 def save_file(file, directory, filename):
-    """Save a file either to a local path or to Google Cloud Storage."""
+    """Stream an uploaded file into storage."""
+    sanitized_filename = secure_filename(filename)
+    path = f"{directory}/{sanitized_filename}"
     try:
-        sanitized_filename = secure_filename(filename)
-        if Config.ENV_MODE == 'development':
-            filepath = os.path.join(directory, sanitized_filename)
-            file.save(filepath)
-            logging.info(f"File saved locally at {filepath}")
-        else:
-            # Ensure the Google Cloud Storage bucket is initialized
-            if not hasattr(Config, 'gcs_bucket') or not Config.gcs_bucket:
-                storage_client = storage.Client()
-                Config.gcs_bucket = storage_client.bucket(Config.GCS_BUCKET_NAME)
-            
-            # Google Cloud Storage
-            bucket = Config.gcs_bucket
-            blob = bucket.blob(os.path.join(directory, sanitized_filename))
-            blob.upload_from_file(file, content_type=file.content_type)
-            logging.info(f"File uploaded to GCS at {blob.name}")
+        with get_storage().open_write(path, file.content_type) as writer:
+            shutil.copyfileobj(file.stream, writer, Config.STREAM_UPLOAD_CHUNK_SIZE)
+        logging.info(f"File saved to {path}")
     except Exception as e:
         logging.error(f"Failed to save file {sanitized_filename}: {e}", exc_info=True)
         raise RuntimeError(f"Failed to save file {sanitized_filename}: {e}")
 
-def create_directory(directory):
-    """Create a directory either locally or in Google Cloud Storage."""
-    if Config.ENV_MODE == 'development':
-        os.makedirs(directory, exist_ok=True)
-    else:
+def save_files(files, directory):
+    """
+    Save several (file, filename) pairs concurrently through the shared upload pool.
+
+    Waits for every transfer and raises the first failure, so the caller can roll back the batch.
+    """
+    futures = [upload_pool.submit(save_file, file, directory, filename) for file, filename in files]
+    errors = []
+    for future in futures:
         try:
-            # Ensure the storage client and bucket are correctly initialized
-            if not hasattr(Config, 'gcs_bucket') or not Config.gcs_bucket:
-                storage_client = storage.Client()
-                Config.gcs_bucket = storage_client.bucket(Config.GCS_BUCKET_NAME)
-            bucket = Config.gcs_bucket
-            blob = bucket.blob(os.path.join(directory, 'placeholder'))
-            blob.upload_from_string('', content_type='text/plain')
+            future.result()
         except Exception as e:
-            logging.error(f'Failed to create directory in GCS: {e}', exc_info=True)
-            raise e
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+def open_file_writer(directory, filename, content_type=None):
+    """
+    Open a writable binary stream to a file in storage.
+
+    On GCS the object is sent as a resumable upload in chunks, so only one chunk is held in memory.
+    Returns the writer and a callable that discards a partially written file.
+    """
+    writer = get_storage().open_write(f"{directory}/{secure_filename(filename)}", content_type)
+    return writer, writer.abort
+
+def read_file_if_exists(path):
+    """Read a file from storage, returning None if it does not exist."""
+    return get_storage().read_if_exists(path)
+
+def get_gcs_bucket():
+    """Return the upload bucket, creating the storage client on first use."""
+    return get_bucket(Config.GCS_BUCKET_NAME)
+
+def get_signing_kwargs():
+    """
+    Return the arguments generate_signed_url needs to sign with the runtime's credentials.
+
+    Service account key files sign locally; the App Engine default credentials have no private key,
+    so the URL is signed through the IAM API with the service account email and an access token.
+    """
+    import google.auth
+    from google.auth.transport import requests as google_auth_requests
+    credentials, _ = google.auth.default()
+    if hasattr(credentials, 'sign_bytes'):
+        return {'credentials': credentials}
+    credentials.refresh(google_auth_requests.Request())
+    return {'service_account_email': credentials.service_account_email, 'access_token': credentials.token}
+
+def generate_resumable_upload_urls(directory, files):
+    """
+    Create short-lived signed URLs that start a resumable upload of each (filename, content_type) pair.
+
+    The browser POSTs to the URL with 'x-goog-resumable: start' and the signed content type, then PUTs the
+    image bytes to the session URI returned in the Location header, so the bytes never pass through the app.
+    """
+    bucket = get_gcs_bucket()
+    signing_kwargs = get_signing_kwargs()
+    expiration = timedelta(minutes=Config.UPLOAD_URL_EXPIRATION_MINUTES)
+    return [bucket.blob(f"{directory}/{filename}").generate_signed_url(
+                version='v4', expiration=expiration, method='POST',
+                headers={'x-goog-resumable': 'start', 'Content-Type': content_type}, **signing_kwargs)
+            for filename, content_type in files]
+
+def create_directory(directory):
+    """
+    Create a directory in storage.
+
+    Object stores have no directories, so only the local backend creates one; GCS folders appear with their first file.
+    """
+    if Config.STORAGE_BACKEND == 'local':
+        os.makedirs(os.path.join(Config.STORAGE_LOCAL_ROOT, directory), exist_ok=True)
+
+def delete_files(paths):
+    """Delete files from storage, ignoring those already gone."""
+    get_storage().delete_many(paths)
 
 def list_files(directory):
-    """List files in a directory either locally or in Google Cloud Storage."""
-    if Config.ENV_MODE == 'development':
-        return os.listdir(directory)
-    else:
-        bucket = Config.gcs_bucket
-        blobs = bucket.list_blobs(prefix=directory)
-        return [blob.name for blob in blobs if '/' not in blob.name[len(directory):]]
+    """List the names of the files directly in a directory (a cached, delimiter-based listing)."""
+    entries, _ = get_storage().list(f"{directory.rstrip('/')}/", delimiter='/')
+    return [entry.name.rsplit('/', 1)[-1] for entry in entries]
 
 def read_file(directory, filename):
-    """Read a file either from a local path or from Google Cloud Storage."""
-    if Config.ENV_MODE == 'development':
-        with open(os.path.join(directory, filename), 'rb') as f:
-            return f.read()
-    else:
-        bucket = Config.gcs_bucket
-        blob = bucket.blob(os.path.join(directory, filename))
-        return blob.download_as_bytes()
+    """Read a whole file from storage."""
+    return get_storage().read(f"{directory}/{filename}")
 
 def get_file_path(field_id, batch_id, filename):
-    """Construct file path depending on the environment."""
-    if Config.ENV_MODE == 'development':
-        return os.path.join(Config.UPLOAD_FOLDER, str(field_id), str(batch_id), filename)
+    """Construct the storage path of a file of a batch."""
     return f"{Config.UPLOAD_FOLDER}/{field_id}/{batch_id}/{filename}"
 
 def open_file(field_id, batch_id, filename, mode='r'):
-    """Open a file with consideration for the environment."""
+    """Load a JSON file of a batch, or open it as a binary stream for any other mode ('rb' or 'wb')."""
     file_path = get_file_path(field_id, batch_id, filename)
     try:
-        if Config.ENV_MODE == 'development':
-                with open(file_path, mode) as file:
-                    return json.load(file)
-        else:
-            bucket = Config.gcs_bucket
-            blob = bucket.blob(file_path)
-            if mode == 'r':
-                return json.loads(blob.download_as_text())
-            else:
-                return blob.open(mode)
+        if mode == 'r':
+            # json.load parses straight from the stream instead of a downloaded copy of the file
+            with get_storage().open_read(file_path) as f:
+                return json.load(f)
+        if mode == 'wb':
+            return get_storage().open_write(file_path)
+        return get_storage().open_read(file_path)
     except Exception as e:
         current_app.logger.error(f"Failed to open file {file_path}: {e}")
         raise
-        
@@ -1,25 +1,52 @@
-from flask import Blueprint, jsonify, render_template, request, jsonify, flash, redirect, url_for
+from flask import Blueprint, jsonify, render_template, request, jsonify, flash, redirect, url_for, Response
 from flask_login import login_required, current_user
 from flask import current_app
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
 from . import db
-from .models import User, Field, Batch, Image
+from .models import User, Field, Batch, Image, BatchStage
 import os
-from google.cloud import pubsub_v1
 from .config import Config
-from .file_utils import create_directory, save_file
+from .file_utils import create_directory, save_file, save_files, generate_resumable_upload_urls, open_file_writer, read_file_if_exists, delete_files
+from .streaming import stream_multipart, HashingWriter
 import re
 from datetime import datetime
 import json
 import base64
-from .services import update_image_predictions_gcp, update_image_status_to_predicting
-from google.cloud import storage
+from .services import update_image_predictions_gcp, update_image_status_to_predicting, record_batch_trace, refresh_batch_summary
+from .queries import get_field_rows, get_batch_rows, get_image_rows, get_unique_batch_dates as query_unique_batch_dates, get_date_grid, get_batch_progress
+from .queries import get_field_list_version, get_batch_list_version, get_image_list_version
+from .queries import get_field_disease_timeseries, get_field_disease_heatmap, get_batch_duplicates
+from .events import broker, format_sse
+from .outbox import enqueue, wake_dispatcher
+from .startup_profiler import startup_profiler
+from .cache import response_cache
+from .tracing import new_trace, add_stage, summarize_stage_latency
 import logging
 from datetime import timedelta
+import time
+import queue
+import hashlib
+import threading
 
 main = Blueprint('main', __name__, url_prefix='/main')
 
-publisher = pubsub_v1.PublisherClient()
+# Batch event streams are closed after this many seconds and reopened by the browser,
+# so a worker thread is never held indefinitely; keep-alives keep proxies from timing them out.
+EVENT_STREAM_SECONDS = 55
+EVENT_KEEPALIVE_SECONDS = 15
+
+# Each open stream holds a worker thread, so only EVENT_STREAMS_MAX run at once; other clients are refused
+# and poll /check_batch_update instead
+event_stream_slots = threading.BoundedSemaphore(Config.EVENT_STREAMS_MAX) if Config.EVENT_STREAMS_MAX > 0 else None
+
+# Thumbnails and tiles are immutable under a manifest version, so versioned URLs are cached for a year
+DERIVATIVE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Page sizes of the list endpoints (?limit=); the next page is requested with ?after=<X-Next-Cursor>
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 2000
+
 project = Config.PROJECT
 bucket_name = Config.GCS_BUCKET_NAME
 
@@ -27,7 +54,7 @@ bucket_name = Config.GCS_BUCKET_NAME
 @login_required
 def index():
     fields = Field.query.all()
-    return render_template('index.html', fields=fields)
+    return render_template('index.html', fields=fields, direct_uploads=Config.DIRECT_UPLOADS)
 
 def allowed_file(filename):
     # Function to check for allowed file extensions
@@ -45,53 +72,52 @@ def parse_filename(filename):
         }
     return None
 
+def list_response(version, load_page, id_key):
+    """
+    Serve one keyset page of a list endpoint with ETag/Last-Modified validators.
+
+    version is the (tag, last_modified) validator of the whole list; when the client already holds
+    this page of that version, a 304 is returned without loading or serializing any rows.
+    """
+    tag, last_modified = version
+    after_id = request.args.get('after', 0, type=int)
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    etag = hashlib.md5(f"{tag}:{after_id}:{limit}".encode('utf-8')).hexdigest()
+    headers = {'Cache-Control': 'private, no-cache'}
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304, headers=headers)
+    else:
+        rows = load_page(after_id, limit)
+        response = jsonify(rows)
+        response.headers.update(headers)
+        # A full page may have a successor; the cursor is the last id returned
+        if len(rows) == limit:
+            response.headers['X-Next-Cursor'] = str(rows[-1][id_key])
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
 @main.route('/get_fields')
 @login_required
 def get_fields():
-    fields = Field.query.all()
-    fields_list = []
-    for field in fields:
-        fields_list.append({
-            'field_id': field.id,
-            'field_name': field.name,
-            'user_name': field.user.name,
-            'date_created': field.datetime.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(fields_list)
+    return list_response(get_field_list_version(),
+                         lambda after_id, limit: get_field_rows(after_id, limit), 'field_id')
 
 @main.route('/get_batches/<int:field_id>')
 @login_required
 def get_batches(field_id):
-    batches = Batch.query.filter_by(field_id=field_id).all()
-    batches_list = []
-    for batch in batches:
-        batches_list.append({
-            'batch_id': batch.id,
-            'x_grid': batch.x_grid,
-            'y_grid': batch.y_grid,
-            'img_qty': batch.img_qty,
-            'date_taken': batch.date_taken.strftime('%Y-%m-%d'),
-            'user_name': batch.user.name,
-            'date_uploaded': batch.datetime.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(batches_list)
+    return list_response(get_batch_list_version(field_id),
+                         lambda after_id, limit: get_batch_rows(field_id, after_id, limit), 'batch_id')
 
 @main.route('/get_images/<int:batch_id>')
 @login_required
 def get_images(batch_id):
-    images = Image.query.filter_by(batch_id=batch_id).all()
-    images_list = []
-    for image in images:
-        images_list.append({
-            'image_id': image.id,
-            'filename': image.filename,
-            'label': image.label,
-            'healthy': image.healthy,
-            'rice_blast': image.rice_blast,
-            'brown_spot': image.brown_spot,
-            'date_uploaded': image.datetime.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(images_list)
+    version = get_image_list_version(batch_id)
+    if version is None:
+        return jsonify(error="Batch not found."), 404
+    return list_response(version, lambda after_id, limit: get_image_rows(batch_id, after_id, limit), 'image_id')
 
 @main.route('/add_field', methods=['POST'])
 @login_required
@@ -117,6 +143,7 @@ def add_field():
 @main.route('/upload_batch', methods=['POST'])
 @login_required
 def upload_batch():
+    upload_start = time.time()
     field_id = request.form.get('field_id')
     files = request.files.getlist('images')
 
@@ -138,11 +165,13 @@ def upload_batch():
         batch_folder = os.path.join(Config.UPLOAD_FOLDER, str(field_id), str(new_batch.id))
         create_directory(batch_folder)
 
+        images_added = 0
+        uploads = []
         for file in files:
             if file and allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(batch_folder, filename)
-                save_file(file, batch_folder, filename)
+                uploads.append((file, filename))
 
                 image_metadata = parse_filename(filename)
                 
@@ -150,18 +179,24 @@ def upload_batch():
                                   batch_id=new_batch.id, order=image_metadata['order'],
                                   date_taken=image_metadata['date_taken'])
                 db.session.add(new_image)
+                images_added += 1
+
+        # Store the images concurrently through the bounded upload pool instead of one at a time
+        save_files(uploads, batch_folder)
+
+        # Every image starts out pending, so the batch counters are known without recounting
+        new_batch.pending_count = images_added
+        # The field summary counts the new images of the flight date
+        refresh_batch_summary(new_batch.id)
 
+        # Start the batch trace with the upload stage; each pipeline stage appends its own timings
+        trace = add_stage(new_trace(), 'upload', upload_start)
+        start_pipeline(field_id, new_batch.id, trace)
         db.session.commit()
-        if Config.ENV_MODE == 'development':
-            extract_metadata(field_id, new_batch.id)
-        else:            
-            # Publish a message to the topic metadata-extraction-trigger
-            topic_name = "metadata-extraction-trigger"
-            topic_path = publisher.topic_path(project, topic_name)
-            data = {"bucket": bucket_name, "field_id": str(field_id), "batch_id": str(new_batch.id)}
-            message = json.dumps(data).encode("utf-8")
-            future = publisher.publish(topic_path, data=message)
-            future.result()
+        wake_dispatcher()
+
+        response_cache.invalidate(field_id)
+        record_batch_trace(new_batch.id, trace)
 
         return jsonify({
             'success': True,
@@ -176,35 +211,196 @@ def upload_batch():
         logging.error(f'Error uploading batch: {e}', exc_info=True)
         return jsonify({'success': False, 'message': str(e)}), 500
     
+@main.route('/upload_batch_stream', methods=['POST'])
+@login_required
+def upload_batch_stream():
+    # Same as upload_batch, but the multipart body is parsed incrementally and each image is piped into
+    # storage as it arrives, so memory use is bounded by the read buffer instead of the batch size.
+    # No transaction is held while the body streams in: the batch is committed on its own when the first valid
+    # image arrives (its id names the folder, as in create_upload), the images are inserted once the body has been
+    # read, and a failed upload deletes the files it wrote along with the batch
+    upload_start = time.time()
+    field_id = request.args.get('field_id', type=int)
+    if not field_id:
+        return jsonify({'success': False, 'message': 'A field_id query parameter is required.'}), 400
+
+    state = {'batch': None, 'batch_id': None, 'folder': None, 'committed': False}
+    stored, rejected = [], []
+
+    def open_part(name, filename, content_type):
+        if name != 'images' or not filename:
+            return None
+        filename = secure_filename(filename)
+        image_metadata = parse_filename(filename)
+        if not image_metadata or not allowed_file(filename):
+            rejected.append(filename)
+            return None
+
+        # The batch is created from the first valid image, like upload_batch does
+        if state['batch'] is None:
+            state['batch'] = Batch(user_id=current_user.id, field_id=field_id,
+                                   x_grid=image_metadata['x_grid'], y_grid=image_metadata['y_grid'],
+                                   img_qty=0, date_taken=image_metadata['date_taken'])
+            db.session.add(state['batch'])
+            db.session.flush()
+            # Keeping the id, so reading it after the commit does not start a transaction for the rest of the stream
+            state['batch_id'] = state['batch'].id
+            db.session.commit()
+            state['folder'] = os.path.join(Config.UPLOAD_FOLDER, str(field_id), str(state['batch_id']))
+            create_directory(state['folder'])
+
+        writer, discard = open_file_writer(state['folder'], filename, content_type)
+        part = HashingWriter(writer, discard)
+        stored.append((filename, image_metadata, part))
+        return part
+
+    def discard_upload():
+        # Removing the files already written and the batch committed for them
+        db.session.rollback()
+        if state['batch'] is None or state['committed']:
+            return
+        try:
+            # The part being written when the upload failed was already aborted by stream_multipart
+            delete_files([os.path.join(state['folder'], filename) for filename, _, part in stored if part.closed])
+            Batch.query.filter_by(id=state['batch_id']).delete()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Could not clean up the failed upload of batch {state['batch_id']}: {e}", exc_info=True)
+
+    try:
+        stream_multipart(request.stream, request.content_type, open_part, read_size=Config.STREAM_READ_SIZE)
+        new_batch = state['batch']
+        if new_batch is None:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'No valid images provided.', 'rejected': rejected}), 400
+
+        for filename, image_metadata, _ in stored:
+            db.session.add(Image(filename=filename, path=os.path.join(state['folder'], filename), label='no',
+                                 batch_id=new_batch.id, order=image_metadata['order'],
+                                 date_taken=image_metadata['date_taken']))
+        new_batch.img_qty = len(stored)
+        new_batch.pending_count = len(stored)
+        refresh_batch_summary(new_batch.id)
+
+        trace = add_stage(new_trace(), 'upload', upload_start)
+        start_pipeline(field_id, new_batch.id, trace)
+        db.session.commit()
+        state['committed'] = True
+        wake_dispatcher()
+
+        response_cache.invalidate(field_id)
+        record_batch_trace(new_batch.id, trace)
+
+        return jsonify({
+            'success': True,
+            'message': 'Batch and images uploaded successfully.',
+            'newBatch': {
+                'batch_id': new_batch.id,
+                'field_id': field_id,
+            },
+            'files': [{'filename': filename, 'bytes': part.size, 'sha256': part.sha256.hexdigest()}
+                      for filename, _, part in stored],
+            'rejected': rejected
+        }), 200
+    except ValueError as e:
+        discard_upload()
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        discard_upload()
+        logging.error(f'Error streaming batch upload: {e}', exc_info=True)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+def start_pipeline(field_id, batch_id, trace):
+    # Queue the messages handing a stored batch to the prediction pipeline and to the thumbnail and tile
+    # generation; they are written with the caller's transaction and published after it commits
+    data = {"bucket": bucket_name, "field_id": str(field_id), "batch_id": str(batch_id), "trace": trace}
+    enqueue("metadata-extraction-trigger", data)
+    request_derivatives(field_id, batch_id)
+
+def request_derivatives(field_id, batch_id):
+    # Queue a request for a batch's thumbnails and tile pyramid (the generator skips batches already done)
+    enqueue("derivatives-trigger", {"bucket": bucket_name, "field_id": str(field_id), "batch_id": str(batch_id)})
+
+@main.route('/create_upload', methods=['POST'])
+@login_required
+def create_upload():
+    # Register a batch and hand the browser signed resumable-upload URLs, so the images go straight to the bucket
+    upload_start = time.time()
+    data = request.get_json()
+    field_id = data.get('field_id')
+    files = data.get('files', [])
+
+    if not field_id or not files:
+        return jsonify({'success': False, 'message': 'A field and at least one file are required.'}), 400
+
+    filenames = [secure_filename(file.get('filename', '')) for file in files]
+    if not all(allowed_file(filename) and parse_filename(filename) for filename in filenames):
+        return jsonify({'success': False, 'message': 'Invalid filename format.'}), 400
+    metadata = parse_filename(filenames[0])
+
+    try:
+        new_batch = Batch(user_id=current_user.id, field_id=field_id,
+                          x_grid=metadata['x_grid'], y_grid=metadata['y_grid'],
+                          img_qty=len(filenames), date_taken=metadata['date_taken'],
+                          pending_count=len(filenames))
+        db.session.add(new_batch)
+        db.session.flush()
+
+        batch_folder = f"{Config.UPLOAD_FOLDER}/{field_id}/{new_batch.id}"
+        create_directory(batch_folder)
+        for filename in filenames:
+            image_metadata = parse_filename(filename)
+            db.session.add(Image(filename=filename, path=f"{batch_folder}/{filename}", label='no',
+                                 batch_id=new_batch.id, order=image_metadata['order'],
+                                 date_taken=image_metadata['date_taken']))
+        refresh_batch_summary(new_batch.id)
+
+        content_types = [file.get('content_type') or 'application/octet-stream' for file in files]
+        upload_urls = generate_resumable_upload_urls(batch_folder, zip(filenames, content_types))
+        db.session.commit()
+
+        response_cache.invalidate(field_id)
+
+        return jsonify({
+            'success': True,
+            'batch_id': new_batch.id,
+            'field_id': field_id,
+            'upload_start': upload_start,
+            'uploads': [{'filename': filename, 'content_type': content_type, 'upload_url': url}
+                        for filename, content_type, url in zip(filenames, content_types, upload_urls)]
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f'Error creating upload: {e}', exc_info=True)
+        return jsonify({'success': False, 'message': str(e)}), 500
+
 @main.route('/upload_complete', methods=['POST'])
 @login_required
 def upload_complete():
     data = request.get_json()
     field_id = data.get('field_id')
     batch_id = data.get('batch_id')
+    # Direct uploads report when create_upload started them, so the upload stage covers the browser transfers
+    upload_start = data.get('upload_start') or time.time()
 
     try:
-        if Config.ENV_MODE == 'development':
-            extract_metadata(field_id, batch_id)
-            message = 'Metadata extracted successfully.'
-        else:
-            # Publish a message to the topic metadata-extraction-trigger
-            topic_name = "metadata-extraction-trigger"
-            topic_path = publisher.topic_path(Config.PROJECT, topic_name)
-            data = {"bucket": Config.GCS_BUCKET_NAME, "field_id": str(field_id), "batch_id": str(batch_id)}
-            message_data = json.dumps(data).encode("utf-8")
-            future = publisher.publish(topic_path, data=message_data)
-            future.result()
-            message = 'Images uploaded. Predicting...'
-
-        return jsonify({'success': True, 'message': message}), 200
+        trace = add_stage(new_trace(), 'upload', upload_start)
+        start_pipeline(field_id, batch_id, trace)
+        db.session.commit()
+        wake_dispatcher()
+
+        record_batch_trace(batch_id, trace)
+        return jsonify({'success': True, 'message': 'Images uploaded. Predicting...'}), 200
     except Exception as e:
+        db.session.rollback()
         logging.error(f'Error processing post-upload actions: {e}', exc_info=True)
         return jsonify({'success': False, 'message': str(e)}), 500
 
     
 @main.route('/update_predictions', methods=['POST'])
 def update_predictions():
+    ingest_start = time.time()
     # Extract the message data from the request
     message = request.get_json()
     data = message['message']['data']
@@ -216,6 +412,16 @@ def update_predictions():
     
     # Call the function to update image predictions
     success, message = update_image_predictions_gcp(field_id, batch_id)
+    if success:
+        response_cache.invalidate(field_id)
+        broker.publish(batch_id, get_batch_progress(batch_id))
+
+    # Close the batch trace with the ingestion stage and persist the assembled timeline
+    if success and decoded_data.get("trace"):
+        trace = add_stage(decoded_data["trace"], 'update_predictions', ingest_start)
+        trace_recorded, trace_message = record_batch_trace(int(batch_id), trace)
+        if not trace_recorded:
+            logging.warning(trace_message)
     
     if success:
         return jsonify({'status': 'success', 'message': message}), 200
@@ -234,6 +440,11 @@ def set_images_to_predicting():
     
     # Call the function to update image status
     success, message = update_image_status_to_predicting(batch_id)
+    if success:
+        field_id = db.session.query(Batch.field_id).filter(Batch.id == batch_id).scalar()
+        if field_id is not None:
+            response_cache.invalidate(field_id)
+        broker.publish(batch_id, get_batch_progress(batch_id))
     
     if success:
         return jsonify({'status': 'success', 'message': message}), 200
@@ -244,9 +455,10 @@ def set_images_to_predicting():
 @main.route('/get_unique_batch_dates/<int:field_id>', methods=['GET'])
 @login_required
 def get_unique_batch_dates(field_id):
-    batches = Batch.query.filter_by(field_id=field_id).order_by(Batch.date_taken).all()
-    unique_dates = sorted(list(set(batch.date_taken for batch in batches)))
-    return jsonify([date.strftime('%Y-%m-%d') for date in unique_dates])
+    unique_dates = response_cache.get_or_compute(
+        field_id, 'dates',
+        lambda: [date.strftime('%Y-%m-%d') for date in query_unique_batch_dates(field_id)])
+    return jsonify(unique_dates)
 
 @main.route('/get_images_by_date', methods=['GET'])
 @login_required
@@ -254,6 +466,8 @@ def get_images_by_date():
     field_id = request.args.get('field_id', type=int)
     date = request.args.get('date')
 
+    if field_id is None:
+        return jsonify({'error': 'Missing field_id parameter'}), 400
     if not date:
         return jsonify({'error': 'Missing date parameter'}), 400
     try:
@@ -261,45 +475,159 @@ def get_images_by_date():
     except ValueError:
         return jsonify({'error': 'Invalid date format'}), 400
     
-    batches = Batch.query.filter_by(field_id=field_id, date_taken=date_parsed).all()
-    if not batches:
+    # Collect the images of all batches flown on that date
+    grid = response_cache.get_or_compute(field_id, f"grid:{date_parsed:%Y-%m-%d}",
+                                         lambda: get_date_grid(field_id, date_parsed))
+    if grid is None:
         return jsonify({'error': 'No batches found for the given field_id and date'}), 404
 
-    images_data = []
-    xGrid = batches[0].x_grid
-    yGrid = batches[0].y_grid
-
-    # Iterate through all batches to collect images
-    for batch in batches:
-        images = Image.query.filter_by(batch_id=batch.id).all()
-        for image in images:
-            images_data.append({
-                'image_id': image.id,
-                'filename': image.filename,
-                'label': image.label,
-                'order': image.order,
-            })
+    return jsonify(grid)
 
-    return jsonify({
-        'images': images_data,
-        'xGrid': xGrid,
-        'yGrid': yGrid
-    })
+@main.route('/field_disease_timeseries/<int:field_id>')
+@login_required
+def field_disease_timeseries(field_id):
+    # Disease counts and mean confidences per flight date, from the precomputed field summary
+    return jsonify(response_cache.get_or_compute(field_id, 'disease_timeseries',
+                                                 lambda: get_field_disease_timeseries(field_id)))
+
+@main.route('/field_disease_heatmap/<int:field_id>')
+@login_required
+def field_disease_heatmap(field_id):
+    # Disease counts and mean confidences per flight date and grid cell, from the precomputed field summary
+    return jsonify(response_cache.get_or_compute(field_id, 'disease_heatmap',
+                                                 lambda: get_field_disease_heatmap(field_id)))
 
 @main.route('/check_batch_update/<int:batch_id>')
 def check_batch_update(batch_id):
-    # Retrieve the current batch, if exists
-    batch = Batch.query.get(batch_id)
-    if batch:
-        # Check if there are any images within the batch with the specified labels
-        if is_batch_updated(batch_id):
-            return jsonify(updated=True, xGrid=batch.x_grid, yGrid=batch.y_grid)
-        else:
-            return jsonify(updated=False)
+    # Read the batch's progress counters; clients re-fetch images only when the version changes
+    progress = get_batch_progress(batch_id)
+    if progress:
+        return jsonify(updated=is_batch_updated(progress), **progress)
     else:
         return jsonify(updated=False, error="Batch not found.")
 
-def is_batch_updated(batch_id):
-    labels_of_interest = ['predicting', 'Healthy', 'Brown Spot', 'Rice Blast']
-    images = Image.query.filter(Image.batch_id == batch_id, Image.label.in_(labels_of_interest)).all()
-    return len(images) > 0
\ No newline at end of file
+@main.route('/batch_duplicates/<int:batch_id>')
+@login_required
+def batch_duplicates(batch_id):
+    # Images of a batch that reused the prediction of a near-duplicate earlier image of the field
+    progress = get_batch_progress(batch_id)
+    if progress is None:
+        return jsonify(error="Batch not found."), 404
+    return jsonify(batch_id=batch_id, duplicates=progress['duplicates'], images=get_batch_duplicates(batch_id))
+
+@main.route('/batch_events/<int:batch_id>')
+@login_required
+def batch_events(batch_id):
+    # Stream batch status changes as Server-Sent Events instead of having the browser poll
+    # Without a free stream slot the browser's EventSource fails and the page falls back to polling
+    if event_stream_slots is None or not event_stream_slots.acquire(blocking=False):
+        return jsonify(error="Event streams are unavailable, poll /check_batch_update instead."), 503
+    # Subscribe before reading the current state so an update landing in between is not missed
+    subscriber = broker.subscribe(batch_id)
+
+    def close():
+        broker.unsubscribe(batch_id, subscriber)
+        event_stream_slots.release()
+
+    progress = get_batch_progress(batch_id)
+    if not progress:
+        close()
+        return jsonify(error="Batch not found."), 404
+
+    def stream():
+        yield "retry: 5000\n\n"
+        # Always start with the current state; the client skips it if it already has that version
+        yield format_sse('batch_updated', progress)
+        deadline = time.time() + EVENT_STREAM_SECONDS
+        while time.time() < deadline:
+            try:
+                event = subscriber.get(timeout=EVENT_KEEPALIVE_SECONDS)
+                yield format_sse('batch_updated', event)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called by the server once the response is closed, also when the client left before the stream started
+    response.call_on_close(close)
+    return response
+
+def is_batch_updated(progress):
+    # A batch counts as updated once it has left the upload state
+    return progress['state'] != 'uploaded'
+
+def derivative_folder(batch_id):
+    # Folder of a batch's originals, next to which its thumbnails and tiles are stored
+    batch = db.session.query(Batch.field_id).filter(Batch.id == batch_id).first()
+    if batch is None:
+        return None
+    return f"{Config.UPLOAD_FOLDER}/{batch.field_id}/{batch_id}"
+
+def derivative_response(path):
+    # Serve a thumbnail or tile; URLs carrying the manifest version may be cached for a year
+    data = read_file_if_exists(path)
+    if data is None:
+        return jsonify(error="Not generated yet."), 404
+    response = Response(data, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = DERIVATIVE_CACHE_CONTROL if request.args.get('v') else 'no-cache'
+    response.set_etag(hashlib.md5(data).hexdigest())
+    return response.make_conditional(request)
+
+@main.route('/derivatives/<int:batch_id>/manifest')
+@login_required
+def derivative_manifest(batch_id):
+    # Describe a batch's tile pyramid, requesting its generation on first use if it is missing
+    folder = derivative_folder(batch_id)
+    if folder is None:
+        return jsonify(error="Batch not found."), 404
+    manifest = read_file_if_exists(f"{folder}/tiles/manifest.json")
+    if manifest is None:
+        request_derivatives(folder.split('/')[-2], batch_id)
+        db.session.commit()
+        wake_dispatcher()
+        return jsonify(status='generating'), 202, {'Retry-After': '10', 'Cache-Control': 'no-store'}
+    response = jsonify(json.loads(manifest))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@main.route('/derivatives/<int:batch_id>/tiles/<int:level>/<int:column>/<int:row>')
+@login_required
+def derivative_tile(batch_id, level, column, row):
+    folder = derivative_folder(batch_id)
+    if folder is None:
+        return jsonify(error="Batch not found."), 404
+    return derivative_response(f"{folder}/tiles/{level}/{column}_{row}.jpg")
+
+@main.route('/derivatives/thumbnail/<int:image_id>')
+@login_required
+def derivative_thumbnail(image_id):
+    image = db.session.query(Image.filename, Image.batch_id).filter(Image.id == image_id).first()
+    if image is None:
+        return jsonify(error="Image not found."), 404
+    return derivative_response(f"{derivative_folder(image.batch_id)}/thumbnails/{image.filename}")
+
+@main.route('/startup_profile')
+@login_required
+def startup_profile():
+    # Time spent per start-up component (imports, secrets, lazily created clients) in this process
+    return jsonify(startup_profiler.report())
+
+@main.route('/cache_stats')
+@login_required
+def cache_stats():
+    # Hit rate of the response cache as seen by this instance
+    return jsonify(response_cache.stats())
+
+@main.route('/pipeline_latency')
+@login_required
+def pipeline_latency():
+    # Summarize per-stage p50/p95 latency across the most recently traced batches
+    limit = request.args.get('limit', 50, type=int)
+    recent_batch_ids = db.session.query(BatchStage.batch_id).distinct() \
+        .order_by(BatchStage.batch_id.desc()).limit(limit).subquery()
+    stage_rows = db.session.query(BatchStage.batch_id, BatchStage.stage, BatchStage.started_at, BatchStage.ended_at) \
+        .filter(BatchStage.batch_id.in_(db.select(recent_batch_ids))).all()
+    return jsonify({
+        'batches': len({row.batch_id for row in stage_rows}),
+        'stages': summarize_stage_latency(stage_rows)
+    })
@@ -1,6 +1,6 @@
 from . import db
 from flask_login import UserMixin
-from datetime import datetime
+import datetime as dt
 
 class User(UserMixin, db.Model):
     __tablename__ = 'User'
@@ -8,7 +8,7 @@ class User(UserMixin, db.Model):
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
-    datetime = db.Column(db.DateTime, default=datetime.utcnow)
+    datetime = db.Column(db.DateTime, default=dt.datetime.utcnow)
     fields = db.relationship('Field', backref='user', lazy=True)
     batches = db.relationship('Batch', backref='user', lazy=True)
 
@@ -17,24 +17,45 @@ class Field(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     code = db.Column(db.String(50))
-    datetime = db.Column(db.DateTime, default=datetime.utcnow)
+    datetime = db.Column(db.DateTime, default=dt.datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     batches = db.relationship('Batch', backref='field', lazy=True)
 
 class Batch(db.Model):
     __tablename__ = 'Batch'
+    __table_args__ = (
+        # Batches of a field by flight date (date lists, the date grid and the batch list)
+        db.Index('ix_batch_field_date', 'field_id', 'date_taken'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     img_qty = db.Column(db.Integer, nullable=False)
     x_grid = db.Column(db.Integer, nullable=False)
     y_grid = db.Column(db.Integer, nullable=False)
     date_taken = db.Column(db.Date)
-    datetime = db.Column(db.DateTime, default=datetime.utcnow)
+    datetime = db.Column(db.DateTime, default=dt.datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     field_id = db.Column(db.Integer, db.ForeignKey('Field.id'), nullable=False)
+    # Pipeline progress, kept in step with the image labels in the same transaction that changes them
+    state = db.Column(db.String(20), nullable=False, default='uploaded')
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+    predicting_count = db.Column(db.Integer, nullable=False, default=0)
+    healthy_count = db.Column(db.Integer, nullable=False, default=0)
+    brown_spot_count = db.Column(db.Integer, nullable=False, default=0)
+    rice_blast_count = db.Column(db.Integer, nullable=False, default=0)
+    # Images whose prediction was reused from a near-duplicate earlier image of the field
+    duplicate_count = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    last_updated = db.Column(db.DateTime, default=dt.datetime.utcnow)
     images = db.relationship('Image', backref='batch', lazy=True)
 
 class Image(db.Model):
     __tablename__ = 'Image'
+    __table_args__ = (
+        # Images of a batch and the filename lookup done when predictions are ingested
+        db.Index('ix_image_batch_filename', 'batch_id', 'filename'),
+        # Label counts of a batch when its progress counters are refreshed
+        db.Index('ix_image_batch_label', 'batch_id', 'label'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(100), nullable=False)
     path = db.Column(db.String(200), nullable=False)
@@ -44,5 +65,57 @@ class Image(db.Model):
     brown_spot = db.Column(db.Float, nullable=True)
     order = db.Column(db.Integer)
     date_taken = db.Column(db.Date)
-    datetime = db.Column(db.DateTime, default=datetime.utcnow)
-    batch_id = db.Column(db.Integer, db.ForeignKey('Batch.id'), nullable=False)
\ No newline at end of file
+    datetime = db.Column(db.DateTime, default=dt.datetime.utcnow)
+    batch_id = db.Column(db.Integer, db.ForeignKey('Batch.id'), nullable=False)
+    # 64-bit perceptual hash (hex) computed at prediction time, and the earlier image whose prediction was reused
+    phash = db.Column(db.String(16), nullable=True)
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey('Image.id'), nullable=True)
+    # Content hash of the model inputs the stored prediction was made from (image, numerical features, model)
+    input_hash = db.Column(db.String(64), nullable=True)
+
+class BatchStage(db.Model):
+    __tablename__ = 'BatchStage'
+    __table_args__ = (
+        db.Index('ix_batchstage_batch_stage', 'batch_id', 'stage'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    trace_id = db.Column(db.String(32), nullable=False)
+    stage = db.Column(db.String(100), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=False)
+    ended_at = db.Column(db.DateTime, nullable=False)
+    batch_id = db.Column(db.Integer, db.ForeignKey('Batch.id'), nullable=False)
+
+class FieldCellSummary(db.Model):
+    """Label counts and confidence sums per field, flight date and grid cell, rebuilt per date on ingestion."""
+    __tablename__ = 'FieldCellSummary'
+    __table_args__ = (
+        db.UniqueConstraint('field_id', 'date_taken', 'cell_order', name='ux_fieldcellsummary_field_date_cell'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    field_id = db.Column(db.Integer, db.ForeignKey('Field.id'), nullable=False)
+    date_taken = db.Column(db.Date, nullable=False)
+    cell_order = db.Column(db.Integer, nullable=False)
+    image_count = db.Column(db.Integer, nullable=False, default=0)
+    predicted_count = db.Column(db.Integer, nullable=False, default=0)
+    healthy_count = db.Column(db.Integer, nullable=False, default=0)
+    brown_spot_count = db.Column(db.Integer, nullable=False, default=0)
+    rice_blast_count = db.Column(db.Integer, nullable=False, default=0)
+    healthy_sum = db.Column(db.Float, nullable=False, default=0)
+    brown_spot_sum = db.Column(db.Float, nullable=False, default=0)
+    rice_blast_sum = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=dt.datetime.utcnow)
+
+class OutboxMessage(db.Model):
+    """A Pub/Sub message committed with the rows it describes and published afterwards by the outbox dispatcher."""
+    __tablename__ = 'OutboxMessage'
+    __table_args__ = (
+        db.Index('ix_outboxmessage_pending', 'published_at', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    published_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=dt.datetime.utcnow)
@@ -0,0 +1,130 @@
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from . import db
+from .models import OutboxMessage
+
+# Transactional outbox for Pub/Sub messages. Views add messages to the session together with the rows
+# they describe, so both are committed or rolled back as one; a background dispatcher publishes committed
+# messages in batches and retries failures with backoff, keeping publish latency out of the request.
+
+def enqueue(topic, data):
+    """Add a message to the outbox in the current transaction; it is published after the caller commits."""
+    db.session.add(OutboxMessage(topic=topic, payload=json.dumps(data)))
+
+class InMemoryPublisher:
+    """Stand-in for the Pub/Sub publisher that records messages instead of sending them (development and tests)."""
+
+    def __init__(self, fail_topics=()):
+        self.fail_topics = set(fail_topics)
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic_path, data):
+        future = Future()
+        if topic_path.rsplit('/', 1)[-1] in self.fail_topics:
+            future.set_exception(RuntimeError(f"Publishing to {topic_path} failed"))
+        else:
+            with self._lock:
+                self.messages.append((topic_path, json.loads(data)))
+            future.set_result(str(len(self.messages)))
+        return future
+
+class OutboxDispatcher:
+    """Background thread draining the outbox; wake() lets a request trigger a dispatch right after its commit."""
+
+    def __init__(self, app, publisher_factory, project, batch_size=100, poll_seconds=5.0, max_backoff_seconds=300):
+        self.app = app
+        self.publisher_factory = publisher_factory
+        self.project = project
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='outbox-dispatcher', daemon=True)
+                self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    # Keep draining while full batches come back
+                    while self.dispatch_once() == self.batch_size:
+                        pass
+            except Exception as e:
+                logging.error(f"Outbox dispatch failed: {e}", exc_info=True)
+
+    def dispatch_once(self):
+        """Publish one batch of due messages and record the outcome of each; returns how many were claimed."""
+        now = datetime.utcnow()
+        # SKIP LOCKED lets the dispatchers of several workers share the outbox without publishing a message twice
+        messages = OutboxMessage.query \
+            .filter(OutboxMessage.published_at.is_(None), OutboxMessage.next_attempt_at <= now) \
+            .order_by(OutboxMessage.id) \
+            .limit(self.batch_size) \
+            .with_for_update(skip_locked=True).all()
+        if not messages:
+            db.session.commit()
+            return 0
+
+        # Publish the whole batch before waiting, so the client can send the messages together
+        publisher = self.publisher_factory()
+        futures = [publisher.publish(publisher.topic_path(self.project, message.topic),
+                                     data=message.payload.encode('utf-8')) for message in messages]
+        for message, future in zip(messages, futures):
+            try:
+                future.result()
+                message.published_at = datetime.utcnow()
+            except Exception as e:
+                message.attempts += 1
+                backoff = min(2 ** message.attempts, self.max_backoff_seconds)
+                message.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+                message.last_error = str(e)[:500]
+                logging.warning(f"Publishing outbox message {message.id} to {message.topic} failed "
+                                f"(attempt {message.attempts}): {e}")
+        db.session.commit()
+        return len(messages)
+
+dispatcher = None
+
+def init_dispatcher(app, publisher_factory, project, batch_size, poll_seconds):
+    """
+    Create the process-wide dispatcher and start it with the first request the app serves, when the
+    OUTBOX_DISPATCHER setting is on and the app is not under test. CLI commands (flask db, benchmark)
+    never serve a request, so they never publish outbox rows in the background.
+    """
+    global dispatcher
+    dispatcher = OutboxDispatcher(app, publisher_factory, project, batch_size=batch_size, poll_seconds=poll_seconds)
+
+    @app.before_request
+    def start_outbox_dispatcher():
+        if not dispatcher.running and app.config.get('OUTBOX_DISPATCHER') and not app.testing:
+            dispatcher.start()
+
+    return dispatcher
+
+def wake_dispatcher():
+    """Ask the dispatcher to publish now instead of at its next poll."""
+    if dispatcher is not None:
+        dispatcher.wake()
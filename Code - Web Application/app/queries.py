@@ -0,0 +1,203 @@
+from . import db
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from .models import User, Field, Batch, Image, FieldCellSummary
+
+# Read-side queries for the main blueprint. Each one selects only the columns its endpoint serializes
+# and joins the owning user in the same statement, so a response costs a fixed number of queries
+# regardless of how many rows it contains. List queries page by primary key (keyset pagination): a page
+# is the rows with an id greater than the `after_id` cursor, so deep pages cost the same as the first.
+
+def get_field_rows(after_id=0, limit=None):
+    """A page of fields with the name of the user who created them, in one query."""
+    rows = db.session.query(Field.id, Field.name, Field.datetime, User.name.label('user_name')) \
+        .join(User, Field.user_id == User.id) \
+        .filter(Field.id > after_id) \
+        .order_by(Field.id).limit(limit).all()
+    return [{
+        'field_id': row.id,
+        'field_name': row.name,
+        'user_name': row.user_name,
+        'date_created': row.datetime.strftime('%Y-%m-%d %H:%M:%S')
+    } for row in rows]
+
+def get_batch_rows(field_id, after_id=0, limit=None):
+    """A page of the batches of a field with the name of the uploading user, in one query."""
+    rows = db.session.query(Batch.id, Batch.x_grid, Batch.y_grid, Batch.img_qty, Batch.date_taken,
+                            Batch.datetime, User.name.label('user_name')) \
+        .join(User, Batch.user_id == User.id) \
+        .filter(Batch.field_id == field_id, Batch.id > after_id) \
+        .order_by(Batch.id).limit(limit).all()
+    return [{
+        'batch_id': row.id,
+        'x_grid': row.x_grid,
+        'y_grid': row.y_grid,
+        'img_qty': row.img_qty,
+        'date_taken': row.date_taken.strftime('%Y-%m-%d'),
+        'user_name': row.user_name,
+        'date_uploaded': row.datetime.strftime('%Y-%m-%d %H:%M:%S')
+    } for row in rows]
+
+def get_image_rows(batch_id, after_id=0, limit=None):
+    """A page of the images of a batch with their predictions, in one query."""
+    rows = db.session.query(Image.id, Image.filename, Image.label, Image.healthy, Image.rice_blast,
+                            Image.brown_spot, Image.datetime) \
+        .filter(Image.batch_id == batch_id, Image.id > after_id) \
+        .order_by(Image.id).limit(limit).all()
+    return [{
+        'image_id': row.id,
+        'filename': row.filename,
+        'label': row.label,
+        'healthy': row.healthy,
+        'rice_blast': row.rice_blast,
+        'brown_spot': row.brown_spot,
+        'date_uploaded': row.datetime.strftime('%Y-%m-%d %H:%M:%S')
+    } for row in rows]
+
+def get_field_list_version():
+    """
+    The validator of the field list: its size, newest id and newest creation time, from one aggregate query.
+
+    Fields are only ever added, so these change whenever the list does.
+    """
+    row = db.session.query(func.count(Field.id), func.max(Field.id), func.max(Field.datetime)).one()
+    return f"fields:{row[0]}:{row[1]}", row[2]
+
+def get_batch_list_version(field_id):
+    """The validator of a field's batch list, from one aggregate query over the field's batches."""
+    row = db.session.query(func.count(Batch.id), func.max(Batch.id), func.max(Batch.last_updated)) \
+        .filter(Batch.field_id == field_id).one()
+    return f"batches:{field_id}:{row[0]}:{row[1]}:{row[2]}", row[2]
+
+def get_image_list_version(batch_id):
+    """
+    The validator of a batch's image list, from a primary-key read of the batch.
+
+    Image labels and predictions only change together with the batch progress counters, which bump its version.
+    Returns None when the batch does not exist.
+    """
+    row = db.session.query(Batch.version, Batch.last_updated).filter(Batch.id == batch_id).first()
+    if row is None:
+        return None
+    return f"images:{batch_id}:{row.version}", row.last_updated
+
+def get_unique_batch_dates(field_id):
+    """The distinct flight dates of a field, deduplicated by the database."""
+    rows = db.session.query(Batch.date_taken).filter(Batch.field_id == field_id) \
+        .distinct().order_by(Batch.date_taken).all()
+    return [row.date_taken for row in rows]
+
+def get_date_grid(field_id, date_taken):
+    """
+    The grid size and images of every batch of a field flown on a date, in two queries.
+
+    Returns None when the field has no batch on that date.
+    """
+    grid = db.session.query(Batch.x_grid, Batch.y_grid) \
+        .filter(Batch.field_id == field_id, Batch.date_taken == date_taken) \
+        .order_by(Batch.id).first()
+    if grid is None:
+        return None
+
+    rows = db.session.query(Image.id, Image.filename, Image.label, Image.order) \
+        .join(Batch, Image.batch_id == Batch.id) \
+        .filter(Batch.field_id == field_id, Batch.date_taken == date_taken) \
+        .order_by(Batch.id, Image.id).all()
+    return {
+        'images': [{
+            'image_id': row.id,
+            'filename': row.filename,
+            'label': row.label,
+            'order': row.order,
+        } for row in rows],
+        'xGrid': grid.x_grid,
+        'yGrid': grid.y_grid
+    }
+
+def get_batch_progress(batch_id):
+    """
+    The pipeline state, label counts and version of a batch from a single primary-key read.
+
+    Returns None when the batch does not exist.
+    """
+    row = db.session.query(Batch.id, Batch.x_grid, Batch.y_grid, Batch.state, Batch.version, Batch.last_updated,
+                           Batch.pending_count, Batch.predicting_count, Batch.healthy_count,
+                           Batch.brown_spot_count, Batch.rice_blast_count, Batch.duplicate_count) \
+        .filter(Batch.id == batch_id).first()
+    if row is None:
+        return None
+    return {
+        'batch_id': row.id,
+        'state': row.state,
+        'version': row.version,
+        'last_updated': row.last_updated.strftime('%Y-%m-%d %H:%M:%S') if row.last_updated else None,
+        'counts': {
+            'no': row.pending_count,
+            'predicting': row.predicting_count,
+            'Healthy': row.healthy_count,
+            'Brown Spot': row.brown_spot_count,
+            'Rice Blast': row.rice_blast_count
+        },
+        'duplicates': row.duplicate_count,
+        'xGrid': row.x_grid,
+        'yGrid': row.y_grid
+    }
+
+def get_batch_duplicates(batch_id):
+    """The images of a batch whose prediction was reused from a near-duplicate earlier image, with that image."""
+    source = aliased(Image)
+    rows = db.session.query(Image.id, Image.filename, Image.order, source.id.label('source_id'),
+                            source.filename.label('source_filename'), source.batch_id.label('source_batch_id')) \
+        .join(source, Image.duplicate_of_id == source.id) \
+        .filter(Image.batch_id == batch_id) \
+        .order_by(Image.id).all()
+    return [{
+        'image_id': row.id,
+        'filename': row.filename,
+        'order': row.order,
+        'duplicate_of': {'image_id': row.source_id, 'batch_id': row.source_batch_id, 'filename': row.source_filename}
+    } for row in rows]
+
+def summary_entry(row):
+    """Label counts and mean confidences of an aggregated FieldCellSummary row."""
+    predicted = row.predicted_count or 0
+    return {
+        'images': row.image_count,
+        'predicted': predicted,
+        'counts': {
+            'Healthy': row.healthy_count,
+            'Brown Spot': row.brown_spot_count,
+            'Rice Blast': row.rice_blast_count
+        },
+        'mean_confidence': {
+            'Healthy': round(row.healthy_sum / predicted, 4) if predicted else None,
+            'Brown Spot': round(row.brown_spot_sum / predicted, 4) if predicted else None,
+            'Rice Blast': round(row.rice_blast_sum / predicted, 4) if predicted else None
+        }
+    }
+
+def get_field_disease_timeseries(field_id):
+    """Per flight date label counts and mean confidences of a field, in one query on the summary table."""
+    summary = FieldCellSummary
+    rows = db.session.query(summary.date_taken,
+                            func.sum(summary.image_count).label('image_count'),
+                            func.sum(summary.predicted_count).label('predicted_count'),
+                            func.sum(summary.healthy_count).label('healthy_count'),
+                            func.sum(summary.brown_spot_count).label('brown_spot_count'),
+                            func.sum(summary.rice_blast_count).label('rice_blast_count'),
+                            func.sum(summary.healthy_sum).label('healthy_sum'),
+                            func.sum(summary.brown_spot_sum).label('brown_spot_sum'),
+                            func.sum(summary.rice_blast_sum).label('rice_blast_sum')) \
+        .filter(summary.field_id == field_id) \
+        .group_by(summary.date_taken) \
+        .order_by(summary.date_taken).all()
+    return [{'date': row.date_taken.strftime('%Y-%m-%d'), **summary_entry(row)} for row in rows]
+
+def get_field_disease_heatmap(field_id):
+    """Per flight date and grid cell label counts and mean confidences of a field, in one query on the summary table."""
+    rows = FieldCellSummary.query.filter(FieldCellSummary.field_id == field_id) \
+        .order_by(FieldCellSummary.date_taken, FieldCellSummary.cell_order).all()
+    dates = {}
+    for row in rows:
+        dates.setdefault(row.date_taken.strftime('%Y-%m-%d'), []).append({'order': row.cell_order, **summary_entry(row)})
+    return [{'date': date, 'cells': cells} for date, cells in dates.items()]
@@ -1,18 +1,135 @@
 import os
 from flask import current_app
-from .models import db, Image
+from .models import db, Batch, Image, BatchStage, FieldCellSummary
 from .config import Config
 from .file_utils import open_file
-from google.cloud import storage
+from .clients import get_bucket
 import json
+import ast
+from datetime import datetime
+from sqlalchemy import update, func, insert, select, case, literal
+
+# Batch progress counter column for each image label
+BATCH_LABEL_COUNTERS = {
+    'no': 'pending_count',
+    'predicting': 'predicting_count',
+    'Healthy': 'healthy_count',
+    'Brown Spot': 'brown_spot_count',
+    'Rice Blast': 'rice_blast_count'
+}
+
+def refresh_batch_progress(batch_id, state):
+    """
+    Recount a batch's image labels into its progress counters, set its pipeline state and bump its version.
+
+    Does not commit, so the counters are written in the same transaction as the label change itself.
+    """
+    rows = db.session.query(Image.label, func.count(Image.id), func.count(Image.duplicate_of_id)) \
+        .filter(Image.batch_id == batch_id).group_by(Image.label).all()
+    counts = {label: count for label, count, _ in rows}
+    values = {column: counts.get(label, 0) for label, column in BATCH_LABEL_COUNTERS.items()}
+    values.update(state=state, duplicate_count=sum(duplicates for _, _, duplicates in rows),
+                  version=Batch.version + 1, last_updated=datetime.utcnow())
+    Batch.query.filter_by(id=batch_id).update(values, synchronize_session=False)
+
+def refresh_field_summary(field_id, date_taken):
+    """
+    Rebuild a field's summary rows for one flight date from the images of every batch flown that day.
+
+    Only the (field, date) slice touched by an ingestion is rewritten, with one DELETE and one
+    INSERT ... SELECT grouped by grid cell. Does not commit.
+    """
+    FieldCellSummary.query.filter_by(field_id=field_id, date_taken=date_taken).delete(synchronize_session=False)
+
+    def label_count(label):
+        return func.sum(case((Image.label == label, 1), else_=0))
+
+    cells = select(
+        literal(field_id), literal(date_taken), Image.order, func.count(Image.id), func.count(Image.healthy),
+        label_count('Healthy'), label_count('Brown Spot'), label_count('Rice Blast'),
+        func.coalesce(func.sum(Image.healthy), 0), func.coalesce(func.sum(Image.brown_spot), 0),
+        func.coalesce(func.sum(Image.rice_blast), 0), literal(datetime.utcnow())
+    ).join(Batch, Image.batch_id == Batch.id) \
+        .where(Batch.field_id == field_id, Batch.date_taken == date_taken, Image.order.isnot(None)) \
+        .group_by(Image.order)
+    db.session.execute(insert(FieldCellSummary).from_select(
+        ['field_id', 'date_taken', 'cell_order', 'image_count', 'predicted_count', 'healthy_count',
+         'brown_spot_count', 'rice_blast_count', 'healthy_sum', 'brown_spot_sum', 'rice_blast_sum', 'updated_at'],
+        cells))
+
+def refresh_batch_summary(batch_id):
+    """Rebuild the summary rows of the field and flight date a batch belongs to. Does not commit."""
+    batch = db.session.query(Batch.field_id, Batch.date_taken).filter(Batch.id == batch_id).first()
+    if batch is not None and batch.date_taken is not None:
+        refresh_field_summary(batch.field_id, batch.date_taken)
+
+def resolve_duplicate_sources(predictions):
+    """
+    Map the storage paths in the predictions' 'Duplicate Of' column (.../{batch_id}/{filename}) to Image ids,
+    with one query over the batches they belong to.
+    """
+    sources = {}
+    for prediction in predictions:
+        path = prediction.get('Duplicate Of')
+        if path:
+            parts = path.split('/')
+            if len(parts) >= 2 and parts[-2].isdigit():
+                sources[path] = (int(parts[-2]), parts[-1])
+    if not sources:
+        return {}
+    rows = db.session.query(Image.batch_id, Image.filename, Image.id) \
+        .filter(Image.batch_id.in_({batch_id for batch_id, _ in sources.values()}),
+                Image.filename.in_({filename for _, filename in sources.values()})).all()
+    image_ids = {(row.batch_id, row.filename): row.id for row in rows}
+    return {path: image_ids.get(key) for path, key in sources.items()}
+
+def ingest_predictions(batch_id, predictions):
+    """
+    Apply a batch's predictions in bulk: one SELECT for the filename to id map, one executemany UPDATE
+    and a single commit, instead of a lookup and a commit per image. The caller handles rollback.
+
+    Images whose stored input hash matches the prediction's already hold it and are left untouched;
+    update_image_status_to_predicting does not relabel them either, so a re-run only writes changed rows.
+    An unchanged image still waiting for a prediction (relabelled before hashes were stored) gets its label back.
+    """
+    images = {row.filename: row for row in db.session.query(Image.filename, Image.id, Image.label, Image.input_hash)
+              .filter(Image.batch_id == batch_id).all()}
+    duplicate_sources = resolve_duplicate_sources(predictions)
+
+    rows = []
+    for prediction in predictions:
+        image = images.get(prediction['Id'].split('/')[-1])
+        if image is None:
+            continue
+        input_hash = prediction.get('Input Hash')
+        if input_hash and image.input_hash == input_hash and image.label != 'predicting':
+            continue
+        # The confidences are stored as a Python dict literal, so parse them without evaluating code
+        confidence_levels = ast.literal_eval(prediction['Class Confidence Levels'])
+        rows.append({
+            'id': image.id,
+            'label': prediction['Class Prediction'],
+            'healthy': confidence_levels.get('Healthy', 0),
+            'rice_blast': confidence_levels.get('Rice Blast', 0),
+            'brown_spot': confidence_levels.get('Brown Spot', 0),
+            'phash': prediction.get('Perceptual Hash'),
+            'duplicate_of_id': duplicate_sources.get(prediction.get('Duplicate Of')),
+            'input_hash': input_hash
+        })
+
+    if rows:
+        db.session.execute(update(Image), rows)
+    refresh_batch_progress(batch_id, 'predicted')
+    if rows:
+        refresh_batch_summary(batch_id)
+    db.session.commit()
+    return len(rows)
 
 def update_image_predictions_gcp(field_id, batch_id):
     """Fetch predictions from GCP bucket and update database."""
     try:
-        # Set up the Google Cloud Storage client and get the bucket
-        storage_client = storage.Client()
-        bucket_name = Config.GCS_BUCKET_NAME
-        bucket = storage_client.bucket(bucket_name)
+        # Get the bucket from the shared storage client
+        bucket = get_bucket(Config.GCS_BUCKET_NAME)
 
         # Construct the path to the predictions file
         predictions_file_path = f"userdata/{field_id}/{batch_id}/predictions_with_confidences.json"
@@ -21,18 +138,8 @@ def update_image_predictions_gcp(field_id, batch_id):
 
         # Parse predictions JSON
         predictions = json.loads(predictions_data)
-        
-        for prediction in predictions:
-            filename = prediction['Id'].split('/')[-1]
-            image = Image.query.filter_by(filename=filename, batch_id=batch_id).first()
-            if image:
-                confidence_levels = eval(prediction['Class Confidence Levels'])
-                image.healthy = confidence_levels.get('Healthy', 0)
-                image.rice_blast = confidence_levels.get('Rice Blast', 0)
-                image.brown_spot = confidence_levels.get('Brown Spot', 0)
-                image.label = prediction['Class Prediction']
-                db.session.commit()
-        return True, "Predictions updated successfully."
+        updated = ingest_predictions(batch_id, predictions)
+        return True, f"Predictions updated successfully for {updated} images."
     except FileNotFoundError:
         return False, f"The predictions file for field {field_id} and batch {batch_id} was not found."
     except Exception as e:
@@ -40,11 +147,17 @@ def update_image_predictions_gcp(field_id, batch_id):
         return False, f"An error occurred while updating image predictions: {str(e)}"
     
 def update_image_status_to_predicting(batch_id):
-    """Update the label of all images in a batch to 'predicting'."""
+    """
+    Update the label of a batch's images to 'predicting'. Images that already hold a prediction (with the
+    input hash it was made from) keep it: the prediction stage only re-runs those whose inputs changed,
+    and ingesting its results replaces their label then. The field summary drops the relabelled images' labels.
+    """
     try:
-        images = Image.query.filter_by(batch_id=batch_id).all()
-        for image in images:
-            image.label = 'predicting'
+        relabelled = Image.query.filter(Image.batch_id == batch_id, Image.input_hash.is_(None)) \
+            .update({'label': 'predicting'}, synchronize_session=False)
+        refresh_batch_progress(batch_id, 'predicting')
+        if relabelled:
+            refresh_batch_summary(batch_id)
         db.session.commit()
         return True, "Image status updated to predicting."
     except Exception as e:
@@ -54,24 +167,35 @@ def update_image_status_to_predicting(batch_id):
 def update_image_predictions(field_id, batch_id):
     try:
         predictions = open_file(field_id, batch_id, 'predictions_with_confidences.json', 'r')
-        for prediction in predictions:
-            filename = prediction['Id'].split('/')[-1]
-            image = Image.query.filter_by(filename=filename, batch_id=batch_id).first()
-            if image:
-                confidence_levels = eval(prediction['Class Confidence Levels'])
-                image.healthy = confidence_levels.get('Healthy', 0)
-                image.rice_blast = confidence_levels.get('Rice Blast', 0)
-                image.brown_spot = confidence_levels.get('Brown Spot', 0)
-
-                # Update label based on 'Class Prediction'
-                image.label = prediction['Class Prediction']
-
-                db.session.commit()
+        ingest_predictions(batch_id, predictions)
     except FileNotFoundError:
         current_app.logger.error(f"The predictions file for field {field_id} batch {batch_id} was not found.")
     except Exception as e:
+        db.session.rollback()
         current_app.logger.error(f"An error occurred while updating image predictions: {e}")
 
+def record_batch_trace(batch_id, trace):
+    """Persist the stage timeline carried by a pipeline trace context for a batch."""
+    try:
+        trace_id = trace.get('trace_id')
+        stages = trace.get('stages', [])
+        if not trace_id or not stages:
+            return False, "No trace context to record."
+
+        # Stages recorded again (e.g. on a Pub/Sub redelivery) replace the earlier entries
+        stage_names = {stage['stage'] for stage in stages}
+        BatchStage.query.filter(BatchStage.batch_id == batch_id,
+                                BatchStage.stage.in_(stage_names)).delete(synchronize_session=False)
+        for stage in stages:
+            db.session.add(BatchStage(batch_id=batch_id, trace_id=trace_id, stage=stage['stage'],
+                                      started_at=datetime.utcfromtimestamp(stage['start']),
+                                      ended_at=datetime.utcfromtimestamp(stage['end'])))
+        db.session.commit()
+        return True, "Batch trace recorded."
+    except Exception as e:
+        db.session.rollback()
+        return False, f"Error recording batch trace: {str(e)}"
+
 def run_model(field_id, batch_id):
     hybrid_model_path = os.path.join(Config.MODEL_DIR, Config.MODEL_SCRIPT)
     #subprocess.run(['python', hybrid_model_path, str(field_id), str(batch_id)], check=True)
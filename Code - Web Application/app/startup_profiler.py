@@ -0,0 +1,38 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Records how long each start-up component takes (imports, secrets, clients), so cold starts can be
+# attributed to a component. Lazily created clients are recorded on first use as well.
+
+class StartupProfiler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.sections = []
+
+    @contextmanager
+    def section(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.sections.append({'component': name, 'ms': round(seconds * 1000, 1)})
+
+    def report(self):
+        with self._lock:
+            return {
+                'since_process_start_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'components': list(self.sections)
+            }
+
+    def log(self):
+        for section in self.report()['components']:
+            logging.info(f"Startup: {section['component']} took {section['ms']} ms")
+
+startup_profiler = StartupProfiler()
@@ -0,0 +1,72 @@
+import hashlib
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Field, Data, Epilogue
+
+# Incremental multipart/form-data parsing for the streaming upload endpoint. The request body is read
+# in small pieces and each file part is handed to a writer as it arrives, so neither the batch nor a
+# single image is ever spooled to memory or a temporary file first.
+
+class HashingWriter:
+    """Forwards the bytes of one part to a storage writer while computing their SHA-256 and size."""
+
+    def __init__(self, writer, discard=None):
+        self.writer = writer
+        self.discard = discard
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        # Set once the part was fully written, so a failed upload knows which files it left behind
+        self.closed = False
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.close()
+        self.closed = True
+
+    def abort(self):
+        if self.discard:
+            self.discard()
+
+def stream_multipart(stream, content_type, open_part, read_size=64 * 1024):
+    """
+    Parse a multipart body from a stream and pipe every file part into the writer returned by open_part.
+
+    open_part(field_name, filename, content_type) returns a writer (with write, close and abort) or None
+    to skip the part. Plain form fields are skipped. Raises ValueError on a malformed or truncated body,
+    after aborting the part being written.
+    """
+    mimetype, options = parse_options_header(content_type)
+    if mimetype != 'multipart/form-data' or 'boundary' not in options:
+        raise ValueError("Expected a multipart/form-data body.")
+
+    decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+    part = None
+    end_of_stream = False
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                if end_of_stream:
+                    raise ValueError("The upload ended before the multipart body was complete.")
+                chunk = stream.read(read_size)
+                end_of_stream = not chunk
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, File):
+                part = open_part(event.name, event.filename, event.headers.get('Content-Type'))
+            elif isinstance(event, Field):
+                part = None
+            elif isinstance(event, Data):
+                if part is not None:
+                    part.write(event.data)
+                    if not event.more_data:
+                        part.close()
+                        part = None
+            elif isinstance(event, Epilogue):
+                return
+    except Exception:
+        if part is not None:
+            part.abort()
+        raise
@@ -0,0 +1,57 @@
+import time
+import uuid
+
+# Stage names in the order a batch passes through the pipeline
+PIPELINE_STAGES = ['upload', 'metadata_extractor', 'fetch_weather_data', 'fetch_remote_sensing_data',
+                   'consolidate_datasets', 'predict', 'update_predictions']
+
+def new_trace():
+    """Create an empty trace context for a new batch."""
+    return {'trace_id': uuid.uuid4().hex, 'stages': []}
+
+def add_stage(trace, stage, start, end=None):
+    """Append a stage with its start/end epoch timestamps to the trace context."""
+    trace.setdefault('stages', []).append({
+        'stage': stage,
+        'start': start,
+        'end': end if end is not None else time.time()
+    })
+    return trace
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a list of numbers (pct between 0 and 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def summarize_stage_latency(stage_rows):
+    """
+    Summarize p50/p95 latency per stage across batches.
+
+    stage_rows is an iterable of (batch_id, stage, started_at, ended_at) tuples with datetime values.
+    The 'total' entry covers the first start to the last end of each batch.
+    """
+    durations = {}
+    batch_bounds = {}
+    for batch_id, stage, started_at, ended_at in stage_rows:
+        durations.setdefault(stage, []).append((ended_at - started_at).total_seconds())
+        first, last = batch_bounds.get(batch_id, (started_at, ended_at))
+        batch_bounds[batch_id] = (min(first, started_at), max(last, ended_at))
+    if batch_bounds:
+        durations['total'] = [(last - first).total_seconds() for first, last in batch_bounds.values()]
+
+    order = PIPELINE_STAGES + sorted(s for s in durations if s not in PIPELINE_STAGES and s != 'total') + ['total']
+    summary = []
+    for stage in order:
+        if stage in durations:
+            summary.append({
+                'stage': stage,
+                'count': len(durations[stage]),
+                'p50_seconds': round(percentile(durations[stage], 50), 3),
+                'p95_seconds': round(percentile(durations[stage], 95), 3)
+            })
+    return summary
@@ -0,0 +1,143 @@
+"""
+Per-field cache of the daily weather records and MODIS composites used by the fetch stages.
+
+The cache is filled ahead of time by the feature_prefetcher function, so a freshly uploaded batch mostly
+reads precomputed values instead of waiting on Visual Crossing and Earth Engine. Each field has one JSON
+blob per source under feature_cache/{field_id}/.
+"""
+import json
+import os
+from datetime import datetime, timedelta
+from common.runtime import get_http_session
+from common.storage import GenerationMismatch
+
+# Number of days of weather preceding the image date that the model features are computed from
+WEATHER_WINDOW_DAYS = 14
+# Cached daily weather older than this is dropped when the cache is rewritten
+WEATHER_RETENTION_DAYS = 90
+# Number of MODIS composites preceding the image date used by the model features
+MODIS_COMPOSITES = 3
+# Cached MODIS composites are only trusted if the point was refreshed this recently (the prefetch runs daily)
+MODIS_MAX_CACHE_AGE_DAYS = 2
+# Cached MODIS points within this many degrees of an image location are treated as the same MODIS pixel
+MODIS_MATCH_TOLERANCE_DEG = 0.0005
+
+def cache_path(field_id, source):
+    return f"feature_cache/{field_id}/{source}.json"
+
+def load_cache(storage, field_id, source):
+    """Loading a field's cache blob, returning the data and the generation to write back against."""
+    data, generation = storage.read_with_generation(cache_path(field_id, source))
+    if data is None:
+        return {}, 0
+    return json.loads(data), generation
+
+def save_cache(storage, field_id, source, data, generation):
+    """
+    Writing a field's cache blob only if nobody else updated it since it was loaded.
+
+    Cache writes are best effort, so losing the race to a concurrent writer is not an error.
+    """
+    try:
+        storage.write(cache_path(field_id, source), json.dumps(data).encode('utf-8'), content_type="application/json",
+                      if_generation_match=generation)
+        return True
+    except GenerationMismatch:
+        print(f"The {source} cache for field {field_id} changed concurrently, skipping the write.")
+        return False
+
+def weather_key(latitude, longitude):
+    return f"{round(latitude, 2)},{round(longitude, 2)}"
+
+def fetch_daily_weather(latitude, longitude, start_date_str, end_date_str):
+    """Fetching daily weather records for a location and inclusive date range from Visual Crossing."""
+    response = get_http_session().get(
+        f"https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{latitude},{longitude}/{start_date_str}/{end_date_str}?unitGroup=metric&include=days&key={os.getenv('VC_API_KEY')}&contentType=json"
+    )
+    weather_data = response.json()
+    return {day['datetime']: {'temp': day['temp'], 'humidity': day['humidity'],
+                              'precip': day.get('precip', 0), 'windspeed': day['windspeed']}
+            for day in weather_data['days']}
+
+def get_weather_days(weather_cache, latitude, longitude, start_date, end_date):
+    """
+    Returning the daily weather records for an inclusive date range, fetching only the days missing from the cache.
+
+    Newly fetched days are merged into weather_cache; the return value tells whether it changed.
+    """
+    location_days = weather_cache.setdefault(weather_key(latitude, longitude), {})
+    wanted = [(start_date + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end_date - start_date).days + 1)]
+    missing = [day for day in wanted if day not in location_days]
+    if missing:
+        # One request covering the whole gap is cheaper than one request per missing day
+        location_days.update(fetch_daily_weather(round(latitude, 2), round(longitude, 2), missing[0], missing[-1]))
+    return [location_days[day] for day in wanted if day in location_days], bool(missing)
+
+def summarize_weather(days):
+    """Computing the 14-day averages and precipitation total used as model features."""
+    days_counted = len(days)
+    total_precipitation = sum(day.get('precip') or 0 for day in days)
+    avg_temp = sum(day['temp'] for day in days) / days_counted if days_counted else 0
+    avg_humidity = sum(day['humidity'] for day in days) / days_counted if days_counted else 0
+    avg_wind_speed = sum(day['windspeed'] for day in days) / days_counted if days_counted else 0
+    return avg_temp, avg_humidity, total_precipitation, avg_wind_speed
+
+def weather_window(date_str):
+    """Returning the first and last day of the weather window for an image date (the date itself is excluded)."""
+    end_date = datetime.strptime(date_str, '%Y-%m-%d')
+    return end_date - timedelta(days=WEATHER_WINDOW_DAYS), end_date - timedelta(days=1)
+
+def prune_weather_cache(weather_cache, today):
+    """Dropping cached days older than the retention period."""
+    oldest = (today - timedelta(days=WEATHER_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    for location_days in weather_cache.values():
+        for day in [day for day in location_days if day < oldest]:
+            del location_days[day]
+
+def modis_key(latitude, longitude):
+    return f"{round(latitude, 4)},{round(longitude, 4)}"
+
+def fetch_modis_composites(latitude, longitude, start_date_str, end_date_str):
+    """Fetching the NDVI/EVI values of every MODIS composite between two dates for a point in one Earth Engine call."""
+    import ee
+
+    point = ee.Geometry.Point([longitude, latitude])
+
+    def sample(image):
+        values = image.select(['NDVI', 'EVI']).multiply(0.0001).reduceRegion(ee.Reducer.first(), point, 250)
+        return ee.Feature(None, {'start': image.date().format('YYYY-MM-dd'), 'ndvi': values.get('NDVI'), 'evi': values.get('EVI')})
+
+    composites = ee.ImageCollection('MODIS/006/MOD13Q1')\
+        .filterBounds(point)\
+        .filterDate(start_date_str, end_date_str)\
+        .map(sample)\
+        .getInfo()
+    return [feature['properties'] for feature in composites['features']]
+
+def find_modis_point(modis_cache, latitude, longitude):
+    """Returning the cached composites of the point closest to a location, if one lies within the match tolerance."""
+    best, best_distance = None, MODIS_MATCH_TOLERANCE_DEG
+    for key, entry in modis_cache.get('points', {}).items():
+        cached_latitude, cached_longitude = map(float, key.split(','))
+        distance = max(abs(cached_latitude - latitude), abs(cached_longitude - longitude))
+        if distance <= best_distance:
+            best, best_distance = entry, distance
+    return best
+
+def cached_modis_values(modis_cache, latitude, longitude, date_str, today=None):
+    """
+    Returning the row written by the remote sensing stage from the cache, or None if the cache cannot answer.
+
+    A point's composites are complete from its 'since' date up to its last refresh, so the cache can only answer
+    for image dates within that span, and only while the refresh is recent enough to match a live query.
+    """
+    entry = find_modis_point(modis_cache, latitude, longitude)
+    if entry is None or not entry['since'] <= date_str <= entry['refreshed']:
+        return None
+    today = today or datetime.utcnow()
+    if entry['refreshed'] < (today - timedelta(days=MODIS_MAX_CACHE_AGE_DAYS)).strftime('%Y-%m-%d'):
+        return None
+    previous = sorted((c for c in entry['composites'] if c['start'] < date_str), key=lambda c: c['start'], reverse=True)[:MODIS_COMPOSITES]
+    if len(previous) < MODIS_COMPOSITES:
+        return None
+    return [latitude, longitude, date_str] + [c['ndvi'] for c in previous] + [c['evi'] for c in previous]
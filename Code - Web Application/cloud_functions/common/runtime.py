@@ -0,0 +1,104 @@
+"""
+Warm-runtime helpers shared by the pipeline cloud functions.
+
+Clients are created lazily on first use and kept at module level, so warm invocations of the same
+function instance reuse the authenticated channels instead of rebuilding them. The `common` package
+is copied next to each function's main.py by deploy.sh (./deploy.sh stage), which deploys every function
+from its staged directory.
+"""
+import base64
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import time
+import requests
+from contextlib import contextmanager
+from google.cloud import storage, pubsub_v1
+from .storage import GCSStorage
+
+PROJECT_ID = "tidy-nomad-415320"
+
+_lock = threading.Lock()
+_storage_client = None
+_publisher = None
+_http_session = None
+_buckets = {}
+_storages = {}
+
+def get_storage_client():
+    """Returning the instance-wide storage client, creating it on first use."""
+    global _storage_client
+    if _storage_client is None:
+        with _lock:
+            if _storage_client is None:
+                _storage_client = storage.Client()
+    return _storage_client
+
+def get_bucket(bucket_name):
+    """Returning a cached bucket handle (no API call is made to build it)."""
+    if bucket_name not in _buckets:
+        _buckets[bucket_name] = get_storage_client().bucket(bucket_name)
+    return _buckets[bucket_name]
+
+def get_storage(bucket_name):
+    """Returning a cached storage backend for a bucket, sharing the instance-wide client (and its listing cache)."""
+    if bucket_name not in _storages:
+        _storages[bucket_name] = GCSStorage(bucket_name, client=get_storage_client())
+    return _storages[bucket_name]
+
+def get_publisher():
+    """Returning the instance-wide batching publisher, creating it on first use."""
+    global _publisher
+    if _publisher is None:
+        with _lock:
+            if _publisher is None:
+                batch_settings = pubsub_v1.types.BatchSettings(max_messages=100, max_latency=0.01)
+                _publisher = pubsub_v1.PublisherClient(batch_settings=batch_settings)
+    return _publisher
+
+def get_http_session():
+    """Returning the instance-wide HTTP session so external API calls reuse their keep-alive connections."""
+    global _http_session
+    if _http_session is None:
+        with _lock:
+            if _http_session is None:
+                _http_session = requests.Session()
+    return _http_session
+
+def publish(topic_name, data_list):
+    """Publishing one or more JSON messages to a topic in a single batch and waiting for all of them."""
+    if isinstance(data_list, dict):
+        data_list = [data_list]
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(PROJECT_ID, topic_name)
+    futures = [publisher.publish(topic_path, data=json.dumps(data).encode("utf-8")) for data in data_list]
+    return [future.result() for future in futures]
+
+def decode_message(event):
+    """Decoding the base64 Pub/Sub envelope of a background function event into a dict."""
+    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
+    print("Decoded message:", pubsub_message)
+    return json.loads(pubsub_message)
+
+@contextmanager
+def scratch_dir(prefix="invocation-"):
+    """Yielding a private /tmp directory for one invocation and removing only that directory afterwards."""
+    path = tempfile.mkdtemp(prefix=prefix, dir="/tmp")
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def compute_fingerprint(stage_version, blobs):
+    """Fingerprinting the stage inputs from their names and generations (blobs or storage entries) plus the stage code version."""
+    digest = hashlib.sha256(stage_version.encode('utf-8'))
+    for blob in sorted(blobs, key=lambda b: b.name):
+        digest.update(f"{blob.name}:{blob.generation}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def add_trace_stage(trace, stage, start):
+    """Appending a stage's start/end timestamps to the batch trace context."""
+    trace.setdefault("stages", []).append({"stage": stage, "start": start, "end": time.time()})
+    return trace
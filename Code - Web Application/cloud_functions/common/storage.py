@@ -0,0 +1,465 @@
+"""
+Storage backends shared by the web app and the pipeline cloud functions.
+
+Every backend addresses objects by slash-separated paths (e.g. userdata/{field_id}/{batch_id}/image.JPG) and
+offers the same operations: whole, ranged and streaming reads, streaming writes, delimiter-based listing and
+bulk writes/deletes. Listings are cached for a few seconds and dropped when a write or delete touches the
+listed prefix, since the pipeline lists the same batch folder several times in a row.
+
+- LocalStorage keeps objects under a directory and reads them through mmap, so ranged reads only touch
+  the pages they need.
+- GCSStorage keeps them in a Cloud Storage bucket.
+- MemoryStorage keeps them in a dict, for tests and local experiments.
+
+Custom metadata (used for the stages' input fingerprints) is native on GCS; the other backends keep it in
+process, so after a restart a local stage simply recomputes its output. Writes can be made conditional on
+the generation an object was read at, which GCS enforces atomically and the other backends check just
+before writing.
+
+This module only depends on the standard library (and google-cloud-storage for GCSStorage), so the web app
+can import it from cloud_functions.common while the functions get it through the copied `common` package.
+"""
+import hashlib
+import io
+import mmap
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+# One listed object; `name` and `generation` are what compute_fingerprint uses, `checksum` is a content hash
+# when the backend has one (GCS MD5 or CRC32C, MemoryStorage MD5) and None otherwise
+StorageEntry = namedtuple('StorageEntry', ['name', 'size', 'generation', 'checksum'], defaults=[None])
+
+# Objects transferred at once by the bulk operations
+BULK_WORKERS = 8
+# Resumable upload/download chunk for GCS streams (a multiple of 256 KiB)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+class GenerationMismatch(Exception):
+    """Raised by a conditional write when the object changed since the generation it was read at."""
+
+class StorageBackend:
+    """Common behaviour: cached listings, bulk operations and the helpers built on the backend primitives."""
+
+    def __init__(self, listing_ttl=5.0):
+        self.listing_ttl = listing_ttl
+        self._listing_lock = threading.Lock()
+        self._listings = {}
+        self._object_metadata = {}
+
+    # Primitives implemented by each backend
+    def open_read(self, path):
+        raise NotImplementedError
+
+    def read_range(self, path, start, end):
+        """Return bytes [start, end) of an object."""
+        raise NotImplementedError
+
+    def open_write(self, path, content_type=None):
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def stat(self, path):
+        """Return the StorageEntry of one object, or None if it does not exist."""
+        raise NotImplementedError
+
+    def _delete(self, path):
+        raise NotImplementedError
+
+    def _list(self, prefix, delimiter):
+        raise NotImplementedError
+
+    # Operations built on the primitives
+    def read(self, path):
+        with self.open_read(path) as f:
+            return f.read()
+
+    def read_if_exists(self, path):
+        try:
+            return self.read(path)
+        except FileNotFoundError:
+            return None
+
+    def read_with_generation(self, path):
+        """Return an object's bytes and the generation they belong to, or (None, 0) if it does not exist."""
+        entry = self.stat(path)
+        if entry is None:
+            return None, 0
+        return self.read(path), entry.generation
+
+    def write(self, path, data, content_type=None, metadata=None, cache_control=None, if_generation_match=None):
+        """
+        Write a whole object. With if_generation_match the write only happens if the object is still at that
+        generation (0: if it does not exist yet), raising GenerationMismatch otherwise.
+        """
+        self._check_generation(path, if_generation_match)
+        with self.open_write(path, content_type) as f:
+            f.write(data)
+        self._object_metadata[path] = dict(metadata or {})
+
+    def _check_generation(self, path, generation):
+        if generation is None:
+            return
+        entry = self.stat(path)
+        if (entry.generation if entry else 0) != generation:
+            raise GenerationMismatch(path)
+
+    def get_metadata(self, path):
+        """Return an object's custom metadata, or None if the object does not exist."""
+        if not self.exists(path):
+            return None
+        return self._object_metadata.get(path, {})
+
+    def update_metadata(self, path, metadata):
+        """Merge keys into an existing object's custom metadata without rewriting its content."""
+        self._object_metadata[path] = {**self._object_metadata.get(path, {}), **metadata}
+
+    def delete(self, path):
+        self._delete(path)
+        self._object_metadata.pop(path, None)
+        self.invalidate_listings(path)
+
+    def list(self, prefix, delimiter='/'):
+        """
+        Return (entries, prefixes) directly under a prefix; with delimiter=None every object below it.
+
+        The result is served from the listing cache while it is younger than listing_ttl.
+        """
+        key = (prefix, delimiter)
+        now = time.monotonic()
+        with self._listing_lock:
+            cached = self._listings.get(key)
+            if cached and now - cached[0] < self.listing_ttl:
+                return cached[1]
+        result = self._list(prefix, delimiter)
+        with self._listing_lock:
+            self._listings[key] = (now, result)
+        return result
+
+    def invalidate_listings(self, path):
+        """Drop every cached listing whose prefix contains the changed path."""
+        with self._listing_lock:
+            for key in [key for key in self._listings if path.startswith(key[0])]:
+                del self._listings[key]
+
+    def write_many(self, items):
+        """Write (path, data[, content_type]) items concurrently, raising the first failure after all finished."""
+        self._run_many(lambda item: self.write(*item), items)
+
+    def delete_many(self, paths):
+        self._run_many(self.delete, paths)
+
+    def _run_many(self, operation, items):
+        with ThreadPoolExecutor(max_workers=BULK_WORKERS) as pool:
+            futures = [pool.submit(operation, item) for item in items]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            raise errors[0]
+
+class StorageWriter(io.RawIOBase):
+    """
+    Streaming writer returned by open_write. close() completes the object and drops the listings that contain it;
+    abort() throws away a partially written object instead.
+    """
+
+    def __init__(self, writer, on_close, on_abort):
+        self._writer = writer
+        self._on_close = on_close
+        self._on_abort = on_abort
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._writer.write(data)
+
+    def close(self):
+        if not self.closed:
+            self._writer.close()
+            self._on_close()
+        super().close()
+
+    def abort(self):
+        if not self.closed:
+            self._on_abort()
+        super().close()
+
+class LocalStorage(StorageBackend):
+    """Objects stored as files under a root directory."""
+
+    def __init__(self, root='.', listing_ttl=5.0):
+        super().__init__(listing_ttl)
+        self.root = root
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def open_read(self, path):
+        return open(self._path(path), 'rb')
+
+    def read(self, path):
+        # mmap avoids an extra copy through Python's file buffer; empty files cannot be mapped
+        with open(self._path(path), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+
+    def read_range(self, path, start, end):
+        with open(self._path(path), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0 or start >= size:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[start:min(end, size)]
+
+    def open_write(self, path, content_type=None):
+        full_path = self._path(path)
+        os.makedirs(os.path.dirname(full_path) or '.', exist_ok=True)
+        f = open(full_path, 'wb')
+
+        def discard():
+            f.close()
+            os.remove(full_path)
+        return StorageWriter(f, lambda: self.invalidate_listings(path), discard)
+
+    def exists(self, path):
+        return os.path.isfile(self._path(path))
+
+    def stat(self, path):
+        try:
+            stat = os.stat(self._path(path))
+        except FileNotFoundError:
+            return None
+        return StorageEntry(path, stat.st_size, stat.st_mtime_ns)
+
+    def _delete(self, path):
+        os.remove(self._path(path))
+
+    def _list(self, prefix, delimiter):
+        directory, _, name_prefix = prefix.rpartition('/')
+        base = self._path(directory) if directory else self.root
+        entries, prefixes = [], []
+        if not os.path.isdir(base):
+            return entries, prefixes
+        if delimiter is None:
+            for current, _, files in os.walk(base):
+                for filename in files:
+                    full_path = os.path.join(current, filename)
+                    name = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                    if name.startswith(prefix):
+                        stat = os.stat(full_path)
+                        entries.append(StorageEntry(name, stat.st_size, stat.st_mtime_ns))
+            return sorted(entries), prefixes
+        with os.scandir(base) as scan:
+            for item in scan:
+                if not item.name.startswith(name_prefix):
+                    continue
+                name = f"{directory}/{item.name}" if directory else item.name
+                if item.is_dir():
+                    prefixes.append(name + '/')
+                else:
+                    stat = item.stat()
+                    entries.append(StorageEntry(name, stat.st_size, stat.st_mtime_ns))
+        return sorted(entries), sorted(prefixes)
+
+class GCSStorage(StorageBackend):
+    """Objects stored in a Cloud Storage bucket; the client is created on first use unless one is given."""
+
+    def __init__(self, bucket_name, client=None, listing_ttl=5.0):
+        super().__init__(listing_ttl)
+        self.bucket_name = bucket_name
+        self._client = client
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            if self._client is None:
+                from google.cloud import storage
+                self._client = storage.Client()
+            self._bucket = self._client.bucket(self.bucket_name)
+        return self._bucket
+
+    def open_read(self, path):
+        from google.api_core.exceptions import NotFound
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(path)
+        try:
+            return blob.open('rb', chunk_size=STREAM_CHUNK_SIZE)
+        except NotFound:
+            raise FileNotFoundError(path)
+
+    def read(self, path):
+        from google.api_core.exceptions import NotFound
+        try:
+            return self.bucket.blob(path).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(path)
+
+    def read_range(self, path, start, end):
+        from google.api_core.exceptions import NotFound, RequestRangeNotSatisfiable
+        if end <= start:
+            return b''
+        try:
+            # GCS ranges are inclusive of the end byte
+            return self.bucket.blob(path).download_as_bytes(start=start, end=end - 1)
+        except NotFound:
+            raise FileNotFoundError(path)
+        except RequestRangeNotSatisfiable:
+            return b''
+
+    def open_write(self, path, content_type=None):
+        blob = self.bucket.blob(path)
+        blob.content_type = content_type or 'application/octet-stream'
+        writer = blob.open('wb', chunk_size=STREAM_CHUNK_SIZE, ignore_flush=True)
+
+        def discard():
+            # A blob writer finalizes the upload when closed, even when collected, so the partial object is removed
+            from google.api_core.exceptions import NotFound
+            writer.close()
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+        return StorageWriter(writer, lambda: self.invalidate_listings(path), discard)
+
+    def read_with_generation(self, path):
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            return None, 0
+        # The blob carries its generation, so the download cannot pick up a newer version
+        return blob.download_as_bytes(), blob.generation
+
+    def write(self, path, data, content_type=None, metadata=None, cache_control=None, if_generation_match=None):
+        # Small objects go up in a single request instead of a resumable session
+        from google.api_core.exceptions import PreconditionFailed
+        blob = self.bucket.blob(path)
+        blob.metadata = metadata
+        blob.cache_control = cache_control
+        try:
+            blob.upload_from_string(data, content_type=content_type or 'application/octet-stream',
+                                    if_generation_match=if_generation_match)
+        except PreconditionFailed:
+            raise GenerationMismatch(path)
+        self.invalidate_listings(path)
+
+    def get_metadata(self, path):
+        blob = self.bucket.get_blob(path)
+        return None if blob is None else (blob.metadata or {})
+
+    def update_metadata(self, path, metadata):
+        blob = self.bucket.get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(path)
+        blob.metadata = {**(blob.metadata or {}), **metadata}
+        blob.patch()
+
+    def exists(self, path):
+        return self.bucket.blob(path).exists()
+
+    def stat(self, path):
+        blob = self.bucket.get_blob(path)
+        return None if blob is None else self._entry(blob)
+
+    @staticmethod
+    def _entry(blob):
+        return StorageEntry(blob.name, blob.size, blob.generation, blob.md5_hash or blob.crc32c)
+
+    def _delete(self, path):
+        self.bucket.blob(path).delete()
+
+    def delete_many(self, paths):
+        # One batched HTTP request per 100 deletes instead of one request per object
+        paths = list(paths)
+        for start in range(0, len(paths), 100):
+            with self.bucket.client.batch():
+                for path in paths[start:start + 100]:
+                    self.bucket.blob(path).delete()
+        for path in paths:
+            self._object_metadata.pop(path, None)
+            self.invalidate_listings(path)
+
+    def _list(self, prefix, delimiter):
+        iterator = self.bucket.list_blobs(prefix=prefix, delimiter=delimiter)
+        entries = [self._entry(blob) for blob in iterator]
+        # The prefixes are only known once every page has been read
+        return entries, sorted(iterator.prefixes)
+
+class MemoryStorage(StorageBackend):
+    """Objects kept in a dict, for tests and local experiments."""
+
+    def __init__(self, listing_ttl=0.0):
+        super().__init__(listing_ttl)
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._generation = 0
+
+    def _store(self, path, data):
+        with self._lock:
+            self._generation += 1
+            self._objects[path] = (bytes(data), self._generation)
+        self.invalidate_listings(path)
+
+    def open_read(self, path):
+        return io.BytesIO(self.read(path))
+
+    def read(self, path):
+        with self._lock:
+            if path not in self._objects:
+                raise FileNotFoundError(path)
+            return self._objects[path][0]
+
+    def read_range(self, path, start, end):
+        return self.read(path)[start:end]
+
+    def open_write(self, path, content_type=None):
+        chunks = []
+
+        def write(data):
+            chunks.append(bytes(data))
+            return len(data)
+        # The object only appears once the writer is closed, so aborting just drops the chunks
+        writer = SimpleNamespace(write=write, close=lambda: None)
+        return StorageWriter(writer, lambda: self._store(path, b''.join(chunks)), chunks.clear)
+
+    def write(self, path, data, content_type=None, metadata=None, cache_control=None, if_generation_match=None):
+        self._check_generation(path, if_generation_match)
+        self._object_metadata[path] = dict(metadata or {})
+        self._store(path, data)
+
+    def exists(self, path):
+        with self._lock:
+            return path in self._objects
+
+    def stat(self, path):
+        with self._lock:
+            if path not in self._objects:
+                return None
+            data, generation = self._objects[path]
+        return StorageEntry(path, len(data), generation, hashlib.md5(data).hexdigest())
+
+    def _delete(self, path):
+        with self._lock:
+            if self._objects.pop(path, None) is None:
+                raise FileNotFoundError(path)
+
+    def _list(self, prefix, delimiter):
+        entries, prefixes = [], set()
+        with self._lock:
+            objects = list(self._objects.items())
+        for name, (data, generation) in objects:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter, 1)[0] + delimiter)
+            else:
+                entries.append(StorageEntry(name, len(data), generation, hashlib.md5(data).hexdigest()))
+        return sorted(entries), sorted(prefixes)
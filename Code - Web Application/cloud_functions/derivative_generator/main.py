@@ -0,0 +1,143 @@
+import io
+import json
+import math
+import re
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from common.runtime import get_storage, decode_message, compute_fingerprint
+
+# Bump whenever the derivative rendering changes so existing thumbnails and tiles are regenerated
+STAGE_VERSION = "derivative_generator-1"
+
+# Longest side of the per-image thumbnails
+THUMBNAIL_SIZE = 128
+# Side of a pyramid tile; at the deepest level each grid cell (one image) fills exactly one tile
+TILE_SIZE = 256
+JPEG_QUALITY = 80
+# Grid cells without an image, and the parts of edge tiles outside the grid
+EMPTY_COLOR = (128, 128, 128)
+# Derivatives never change under the same URL version, so browsers and CDNs may keep them for a year
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Originals decoded and derivatives uploaded at the same time
+WORKERS = 8
+
+FILENAME_PATTERN = re.compile(r"(\d+)_(\d+)_(\d+)_(\d+)_(\d{4}-\d{2}-\d{2})\.JPG", re.IGNORECASE)
+
+def encode_jpeg(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def render_image(storage, path):
+    """Decoding an original at reduced size and returning its thumbnail and its deepest-level tile as JPEG bytes."""
+    image = Image.open(io.BytesIO(storage.read(path)))
+    # JPEG decoding can scale by 1/2 to 1/8 on the fly, which is much cheaper than decoding at full size
+    image.draft("RGB", (TILE_SIZE, TILE_SIZE))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    tile = ImageOps.fit(image, (TILE_SIZE, TILE_SIZE))
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    return encode_jpeg(thumbnail), encode_jpeg(tile)
+
+def try_render_image(storage, path):
+    """Rendering an original, logging and skipping it if it cannot be decoded."""
+    try:
+        return render_image(storage, path)
+    except Exception:
+        print(f"Error rendering {path}: {traceback.format_exc()}")
+        return None
+
+def pyramid_depth(x_grid, y_grid):
+    """Returning the deepest level; level 0 shows the whole grid in one tile."""
+    return math.ceil(math.log2(max(x_grid, y_grid, 1)))
+
+def build_parent_level(tiles, columns, rows):
+    """Combining each 2x2 block of tiles into one tile of the level above, returning it with its size."""
+    half = TILE_SIZE // 2
+    parent_columns, parent_rows = math.ceil(columns / 2), math.ceil(rows / 2)
+    parents = {}
+    for parent_row in range(parent_rows):
+        for parent_column in range(parent_columns):
+            parent = Image.new("RGB", (TILE_SIZE, TILE_SIZE), EMPTY_COLOR)
+            for dy in range(2):
+                for dx in range(2):
+                    child = tiles.get((2 * parent_column + dx, 2 * parent_row + dy))
+                    if child is not None:
+                        child_image = Image.open(io.BytesIO(child)).resize((half, half), Image.LANCZOS)
+                        parent.paste(child_image, (dx * half, dy * half))
+            parents[(parent_column, parent_row)] = encode_jpeg(parent)
+    return parents, parent_columns, parent_rows
+
+def upload_jpeg(storage, path, data):
+    storage.write(path, data, content_type="image/jpeg", cache_control=CACHE_CONTROL)
+
+def generate_derivatives(event, context):
+    """
+    Triggered by a message on derivatives-trigger, published at upload time or when the app first asks for a
+    batch's tiles. Writes a thumbnail per image and a tile pyramid of the batch grid next to the originals:
+    thumbnails/{filename}, tiles/{level}/{column}_{row}.jpg and tiles/manifest.json.
+    """
+    message_data = decode_message(event)
+    bucket_name = message_data["bucket"]
+    field_id = message_data["field_id"]
+    batch_id = message_data["batch_id"]
+
+    storage = get_storage(bucket_name)
+    prefix = f"userdata/{field_id}/{batch_id}/"
+    # Only the originals directly in the batch folder, not the derivatives in its subfolders
+    entries, _ = storage.list(prefix, delimiter="/")
+    image_entries = [entry for entry in entries if FILENAME_PATTERN.match(entry.name[len(prefix):])]
+    if not image_entries:
+        print(f"No images found for batch {batch_id} in field {field_id}.")
+        return
+
+    fingerprint = compute_fingerprint(STAGE_VERSION, image_entries)
+    manifest_metadata = storage.get_metadata(f"{prefix}tiles/manifest.json")
+    if manifest_metadata and manifest_metadata.get("input_fingerprint") == fingerprint:
+        print(f"Derivatives of batch {batch_id} in field {field_id} are up to date.")
+        return
+
+    first = FILENAME_PATTERN.match(image_entries[0].name[len(prefix):])
+    x_grid, y_grid = int(first.group(2)), int(first.group(3))
+    depth = pyramid_depth(x_grid, y_grid)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        # Deepest level: one tile per grid cell, placed by the image order (row-major, y_grid cells per row)
+        tiles, uploads, failed = {}, [], []
+        rendered_images = pool.map(lambda entry: try_render_image(storage, entry.name), image_entries)
+        for entry, rendered in zip(image_entries, rendered_images):
+            if rendered is None:
+                failed.append(entry.name[len(prefix):])
+                continue
+            filename = entry.name[len(prefix):]
+            thumbnail, tile = rendered
+            order = int(FILENAME_PATTERN.match(filename).group(4))
+            column, row = (order - 1) % y_grid, (order - 1) // y_grid
+            tiles[(column, row)] = tile
+            uploads.append(pool.submit(upload_jpeg, storage, f"{prefix}thumbnails/{filename}", thumbnail))
+
+        # Each level above halves the resolution until the whole grid fits in a single tile
+        columns, rows = y_grid, x_grid
+        for level in range(depth, -1, -1):
+            for (column, row), tile in tiles.items():
+                uploads.append(pool.submit(upload_jpeg, storage, f"{prefix}tiles/{level}/{column}_{row}.jpg", tile))
+            if level > 0:
+                tiles, columns, rows = build_parent_level(tiles, columns, rows)
+
+        for upload in uploads:
+            upload.result()
+
+    # The manifest is written last, so its presence means every derivative is in place. When an original could not
+    # be rendered the manifest carries no fingerprint, so the next trigger renders the batch again instead of
+    # taking the gaps for up to date
+    # A partial pyramid gets its own version, so browsers do not keep its gaps once the batch renders in full
+    version = fingerprint[:16] + ("-partial" if failed else "")
+    manifest = {"version": version, "x_grid": x_grid, "y_grid": y_grid, "levels": depth + 1,
+                "tile_size": TILE_SIZE, "thumbnail_size": THUMBNAIL_SIZE, "failed": failed}
+    storage.write(f"{prefix}tiles/manifest.json", json.dumps(manifest).encode("utf-8"), content_type="application/json",
+                  metadata={} if failed else {"input_fingerprint": fingerprint}, cache_control="no-cache")
+    if failed:
+        print(f"Could not render {len(failed)} images of batch {batch_id}; they are retried on the next trigger.")
+    print(f"Generated {len(image_entries) - len(failed)} thumbnails and a {depth + 1}-level tile pyramid "
+          f"for batch {batch_id}.")
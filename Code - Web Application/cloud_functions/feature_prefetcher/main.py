@@ -0,0 +1,99 @@
+import io
+import pandas as pd
+import traceback
+import time
+from datetime import datetime, timedelta, timezone
+from common.runtime import get_bucket, get_storage, decode_message
+from common.feature_cache import (load_cache, save_cache, get_weather_days, prune_weather_cache, fetch_modis_composites,
+                                  modis_key, WEATHER_WINDOW_DAYS, MODIS_COMPOSITES)
+
+DEFAULT_BUCKET = "userdata-tidy-nomad-415320"
+# Fields with a batch uploaded within this many days are considered active
+ACTIVE_FIELD_DAYS = 180
+# How far back the first MODIS fetch for a new point goes (enough to cover the 3 composites before a flight)
+MODIS_INITIAL_LOOKBACK_DAYS = 16 * (MODIS_COMPOSITES + 1)
+
+_ee_initialized = False
+
+def initialize_earth_engine():
+    """Initializing Earth Engine once per function instance."""
+    global _ee_initialized
+    if not _ee_initialized:
+        import ee
+        ee.Initialize()
+        _ee_initialized = True
+
+def find_active_field_locations(bucket, active_days):
+    """Collecting the image coordinates of past batches for every field with a recent upload."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=active_days)
+    locations = {}
+    for blob in bucket.list_blobs(prefix="userdata/", match_glob="userdata/*/*/image_metadata.csv"):
+        if blob.updated < cutoff:
+            continue
+        field_id = blob.name.split('/')[1]
+        df = pd.read_csv(io.BytesIO(blob.download_as_bytes()), usecols=['Latitude', 'Longitude']).dropna()
+        locations.setdefault(field_id, set()).update(zip(df['Latitude'], df['Longitude']))
+    return locations
+
+def prefetch_weather(storage, field_id, coordinates, today):
+    """Filling the field's weather cache with every day a flight from today onwards could need."""
+    weather_cache, generation = load_cache(storage, field_id, "weather")
+    start_date = today - timedelta(days=WEATHER_WINDOW_DAYS)
+    end_date = today - timedelta(days=1)  # The last complete day
+    for latitude, longitude in {(round(lat, 2), round(lon, 2)) for lat, lon in coordinates}:
+        get_weather_days(weather_cache, latitude, longitude, start_date, end_date)
+    prune_weather_cache(weather_cache, today)
+    save_cache(storage, field_id, "weather", weather_cache, generation)
+
+def prefetch_modis(storage, field_id, coordinates, today):
+    """Adding any newly published MODIS composites for the field's points to its cache."""
+    modis_cache, generation = load_cache(storage, field_id, "modis")
+    points = modis_cache.setdefault('points', {})
+    today_str = today.strftime('%Y-%m-%d')
+    end_date_str = (today + timedelta(days=1)).strftime('%Y-%m-%d')  # Earth Engine's end date is exclusive
+
+    # Points closer than the cache key precision share a MODIS pixel, so one fetch serves them all
+    for key in {modis_key(lat, lon) for lat, lon in coordinates}:
+        latitude, longitude = map(float, key.split(','))
+        entry = points.get(key)
+        if entry is None:
+            since = (today - timedelta(days=MODIS_INITIAL_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+            entry = {'since': since, 'composites': []}
+            fetch_from = since
+        else:
+            latest = max((c['start'] for c in entry['composites']), default=entry['since'])
+            fetch_from = (datetime.strptime(latest, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+        try:
+            entry['composites'].extend(fetch_modis_composites(latitude, longitude, fetch_from, end_date_str))
+            entry['refreshed'] = today_str
+            points[key] = entry
+        except Exception:
+            print(f"Failed to fetch MODIS composites for {key} in field {field_id}: {traceback.format_exc()}")
+
+    save_cache(storage, field_id, "modis", modis_cache, generation)
+
+def prefetch_field_features(event, context):
+    """Triggered daily by Cloud Scheduler through the feature-prefetch-trigger topic."""
+    job_start = time.time()
+    message_data = decode_message(event) if event.get('data') else {}
+    bucket_name = message_data.get("bucket", DEFAULT_BUCKET)
+    # The caches go through the storage backend; the active-field scan needs the blob API's glob and update times
+    bucket = get_bucket(bucket_name)
+    storage = get_storage(bucket_name)
+    active_days = int(message_data.get("active_days", ACTIVE_FIELD_DAYS))
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    locations = find_active_field_locations(bucket, active_days)
+    print(f"Pre-fetching features for {len(locations)} active fields.")
+
+    initialize_earth_engine()
+    for field_id, coordinates in locations.items():
+        try:
+            prefetch_weather(storage, field_id, coordinates, today)
+            prefetch_modis(storage, field_id, coordinates, today)
+            print(f"Pre-fetched features for field {field_id} at {len(coordinates)} locations.")
+        except Exception:
+            print(f"Error pre-fetching features for field {field_id}: {traceback.format_exc()}")
+
+    print(f"Feature pre-fetch finished in {time.time() - job_start:.1f}s.")
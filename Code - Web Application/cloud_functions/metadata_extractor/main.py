@@ -1,17 +1,22 @@
+import io
 import os
-from google.cloud import storage, pubsub_v1
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
 import pandas as pd
 from datetime import datetime
 import traceback
-import shutil
-import base64
-import json
+import time
+from common.runtime import get_storage, publish, decode_message, compute_fingerprint, add_trace_stage
 
-def get_exif_data(image_path):
-    """Extracting EXIF data from an image."""
-    image = Image.open(image_path)
+# Bump whenever the extraction logic changes so existing outputs are recomputed
+STAGE_VERSION = "metadata_extractor-1"
+
+# The EXIF block sits in the first 64 KiB of a JPEG, so only the start of each image is fetched
+EXIF_READ_BYTES = 128 * 1024
+
+def get_exif_data(image_file):
+    """Extracting EXIF data from an image path or file object."""
+    image = Image.open(image_file)
     exif_data = {}
     if hasattr(image, '_getexif'):
         exif_info = image._getexif()
@@ -64,64 +69,70 @@ def extract_date_time(exif_data):
         return exif_data['DateTime']
     return None
 
+def read_exif_data(storage, path):
+    """Extracting EXIF data from the head of a stored image, falling back to the whole image if the head is not enough."""
+    try:
+        return get_exif_data(io.BytesIO(storage.read_range(path, 0, EXIF_READ_BYTES)))
+    except Exception:
+        with storage.open_read(path) as f:
+            return get_exif_data(f)
+
 def metadata_extractor(event, context):
     """Triggered by a message from Pub/Sub indicating batch upload completion."""
+    stage_start = time.time()
     print("Raw event data:", event['data'])
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    print("Decoded message:", pubsub_message)
-    message_data = json.loads(pubsub_message)
+    message_data = decode_message(event)
     print("Message data:", message_data)
 
     bucket_name = message_data["bucket"]
     field_id = message_data["field_id"]
     batch_id = message_data["batch_id"]
+    trace = message_data.get("trace", {})
+    downstream_message = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id, "trace": trace}
 
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    storage = get_storage(bucket_name)
     prefix = f'userdata/{field_id}/{batch_id}/'
-    blobs = bucket.list_blobs(prefix=prefix)
+    # Only the originals directly in the batch folder, not the thumbnails and tiles in its subfolders
+    entries, _ = storage.list(prefix, delimiter='/')
+    image_entries = [entry for entry in entries if entry.name.lower().endswith(('.jpg', '.jpeg'))]
+
+    # Skipping the extraction when the existing output was produced from exactly these images
+    fingerprint = compute_fingerprint(STAGE_VERSION, image_entries)
+    existing_metadata = storage.get_metadata(f'{prefix}image_metadata.csv')
+    if existing_metadata and existing_metadata.get("input_fingerprint") == fingerprint:
+        print(f"Inputs unchanged for batch {batch_id} in field {field_id}, republishing without re-extracting.")
+        add_trace_stage(trace, "metadata_extractor", stage_start)
+        publish("metadata-extracted", downstream_message)
+        return
+
     data_rows = []
 
-    for blob in blobs:
-        if blob.name.lower().endswith(('.jpg', '.jpeg')):
-            image_path = '/tmp/' + os.path.basename(blob.name)
-            blob.download_to_filename(image_path)
-
-            try:
-                exif_data = get_exif_data(image_path)
-                gps_info = get_gps_info(exif_data)
-                latitude, longitude = gps_info_to_decimal(gps_info) if gps_info else (None, None)
-                date_time = extract_date_time(exif_data)
-
-                # Prepare data for saving
-                data_rows.append({
-                    "Id": os.path.basename(blob.name),
-                    "Latitude": latitude,
-                    "Longitude": longitude,
-                    "Date and Time": date_time
-                })
-            except Exception as e:
-                print(f"Error processing {blob.name}: {traceback.format_exc()}")
-            finally:
-                os.remove(image_path)
+    # Images are read straight from storage, so nothing is staged in /tmp
+    for entry in image_entries:
+        try:
+            exif_data = read_exif_data(storage, entry.name)
+            gps_info = get_gps_info(exif_data)
+            latitude, longitude = gps_info_to_decimal(gps_info) if gps_info else (None, None)
+            date_time = extract_date_time(exif_data)
+
+            # Prepare data for saving
+            data_rows.append({
+                "Id": os.path.basename(entry.name),
+                "Latitude": latitude,
+                "Longitude": longitude,
+                "Date and Time": date_time
+            })
+        except Exception as e:
+            print(f"Error processing {entry.name}: {traceback.format_exc()}")
 
     # Convert all metadata to a DataFrame
     df = pd.DataFrame(data_rows)
     df['Date'] = pd.to_datetime(df['Date and Time'], format='%Y:%m:%d %H:%M:%S').dt.date.astype(str)
-    csv_path = f'/tmp/{field_id}_{batch_id}_metadata.csv'
-    df.to_csv(csv_path, index=False)
-    metadata_blob = bucket.blob(f'userdata/{field_id}/{batch_id}/image_metadata.csv')
-    metadata_blob.upload_from_filename(csv_path)
+    storage.write(f'{prefix}image_metadata.csv', df.to_csv(index=False).encode('utf-8'), content_type='text/csv',
+                  metadata={"input_fingerprint": fingerprint})
+
+    # Append this stage's timings to the batch trace
+    add_trace_stage(trace, "metadata_extractor", stage_start)
 
     # Publish message to Pub/Sub
-    publisher = pubsub_v1.PublisherClient()
-    project_id = "tidy-nomad-415320"
-    topic_name = "metadata-extracted"
-    topic_path = publisher.topic_path(project_id, topic_name)
-    data = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id}
-    message = json.dumps(data).encode("utf-8")
-    future = publisher.publish(topic_path, data=message)
-    future.result()
-
-    # Safely remove all temporary files after processing and uploading CSV
-    shutil.rmtree('/tmp/', ignore_errors=True)
\ No newline at end of file
+    publish("metadata-extracted", downstream_message)
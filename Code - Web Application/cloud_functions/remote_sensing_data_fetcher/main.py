@@ -1,13 +1,25 @@
 import ee
 import pandas as pd
-import os
+import io
 import json
 import csv
-from google.cloud import storage, pubsub_v1
 import traceback
-import shutil
-import base64
+import time
 from collections import OrderedDict
+from common.runtime import get_storage, publish, decode_message, compute_fingerprint, add_trace_stage
+from common.feature_cache import load_cache, cached_modis_values
+
+# Bump whenever the fetching logic changes so existing outputs are recomputed
+STAGE_VERSION = "fetch_remote_sensing_data-2"
+
+_ee_initialized = False
+
+def initialize_earth_engine():
+    """Initializing Earth Engine once per function instance."""
+    global _ee_initialized
+    if not _ee_initialized:
+        ee.Initialize()
+        _ee_initialized = True
 
 def get_modis_values(latitude, longitude, date_str):
     point = ee.Geometry.Point([longitude, latitude])
@@ -45,44 +57,48 @@ def get_modis_values(latitude, longitude, date_str):
 
     return values_list
 
-def write_to_csv(filename, data):
+def write_to_csv(data):
     headers = ["Latitude", "Longitude", "Date",
                "NDVI MODIS", "NDVI - 1 MODIS", "NDVI - 2 MODIS",
                "EVI MODIS", "EVI - 1 MODIS", "EVI - 2 MODIS"]
 
-    with open(filename, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(headers)
-        for row in data:
-            writer.writerow(row)
+    file = io.StringIO(newline='')
+    writer = csv.writer(file)
+    writer.writerow(headers)
+    for row in data:
+        writer.writerow(row)
+    return file.getvalue().encode('utf-8')
 
 def fetch_remote_sensing_data(event, context):
     """Triggered by the message from metadata_extractor cloud function"""
+    stage_start = time.time()
     print("Raw event data:", event['data'])
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    print("Decoded message:", pubsub_message)
-    message_data = json.loads(pubsub_message)
+    message_data = decode_message(event)
     print("Message data:", message_data)
 
     bucket_name = message_data["bucket"]
     field_id = message_data["field_id"]
     batch_id = message_data["batch_id"]
+    trace = message_data.get("trace", {})
+    downstream_message = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id, "trace": trace}
 
     try:
-        # Initialize Earth Engine and Storage Client
-        ee.Initialize()
-        storage_client = storage.Client()
-
-        # Setup paths and download the metadata CSV to /tmp directory
-        bucket = storage_client.bucket(bucket_name)
-        local_dir = f"/tmp/{field_id}/{batch_id}/"
-        os.makedirs(local_dir, exist_ok=True)
-        local_path = os.path.join(local_dir, "image_metadata.csv")
-        blob = bucket.blob(f"userdata/{field_id}/{batch_id}/image_metadata.csv")
-        blob.download_to_filename(local_path)
-
-        # Read the CSV and process data
-        df = pd.read_csv(local_path)
+        storage = get_storage(bucket_name)
+        input_path = f"userdata/{field_id}/{batch_id}/image_metadata.csv"
+        output_path = f"userdata/{field_id}/{batch_id}/remote_sensing_data.csv"
+
+        # Skipping the fetch when the existing output was produced from this exact metadata file
+        fingerprint = compute_fingerprint(STAGE_VERSION, [storage.stat(input_path)])
+        existing_metadata = storage.get_metadata(output_path)
+        if existing_metadata is not None and existing_metadata.get("input_fingerprint") == fingerprint:
+            print(f"Inputs unchanged for batch {batch_id} in field {field_id}, republishing without re-fetching.")
+            add_trace_stage(trace, "fetch_remote_sensing_data", stage_start)
+            storage.update_metadata(output_path, {"trace": json.dumps(trace)})
+            publish("remote-sensing-data-fetched", downstream_message)
+            return
+
+        # Read the metadata CSV straight from storage and process data
+        df = pd.read_csv(io.BytesIO(storage.read(input_path)))
 
         # List which contains tuples which contain the Latitude, Longitude, and Date for each row in the dataframe
         coordinates_and_dates = []
@@ -96,38 +112,32 @@ def fetch_remote_sensing_data(event, context):
         # Getting rid of duplicate tuples
         # Using an OrderedDict to remove duplicates while maintaining order.
         unique_coordinates_and_dates_ordered = list(OrderedDict.fromkeys(coordinates_and_dates))
-        
-        # Fetching MODIS values for each location and date
-        results = [get_modis_values(lat, lon, date) for lat, lon, date in unique_coordinates_and_dates_ordered]
-        
-        # Save the remote sensing data to CSV in /tmp directory
-        output_csv_path = os.path.join(local_dir, f"remote_sensing_data_{field_id}_{batch_id}.csv")
-        write_to_csv(output_csv_path, results)
-
-        # Upload the final CSV to the desired directory
-        output_blob = bucket.blob(f"userdata/{field_id}/{batch_id}/remote_sensing_data.csv")
-        output_blob.upload_from_filename(output_csv_path)
-
-        # Cleanup /tmp/ directory
-        os.remove(local_path)
-        os.remove(output_csv_path)
+
+        # Fetching MODIS values for each location and date, reading pre-fetched composites from the cache where possible
+        modis_cache, _ = load_cache(storage, field_id, "modis")
+        results = []
+        for lat, lon, date in unique_coordinates_and_dates_ordered:
+            values = cached_modis_values(modis_cache, lat, lon, date)
+            if values is None:
+                # Initialize Earth Engine only when the data actually has to be fetched
+                initialize_earth_engine()
+                values = get_modis_values(lat, lon, date)
+            results.append(values)
+        print(f"Fetched MODIS values for {len(results)} locations and dates.")
+
+        # Append this stage's timings to the batch trace
+        add_trace_stage(trace, "fetch_remote_sensing_data", stage_start)
+
+        # Upload the final CSV to the desired directory (the trace rides along so the consolidator can merge both branches)
+        storage.write(output_path, write_to_csv(results), content_type="text/csv",
+                      metadata={"input_fingerprint": fingerprint, "trace": json.dumps(trace)})
 
         print(f"Remote sensing data processed and saved for batch {batch_id} in field {field_id}.")
 
         # Publish a new message to the remote-sensing-data-fetched topic
-        publisher = pubsub_v1.PublisherClient()
-        project_id = "tidy-nomad-415320"
-        topic_name = "remote-sensing-data-fetched"
-        topic_path = publisher.topic_path(project_id, topic_name)
-        data = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id}
-        message = json.dumps(data).encode("utf-8")
-        future = publisher.publish(topic_path, data=message)
-        future.result()
+        publish("remote-sensing-data-fetched", downstream_message)
 
         print("Published message to remote-sensing-data-fetched topic.")
 
     except Exception as e:
         print(f"Failed to process remote sensing data: {traceback.format_exc()}")
-
-    # Safely remove all temporary files after processing and uploading CSV
-    shutil.rmtree(local_dir, ignore_errors=True)
\ No newline at end of file
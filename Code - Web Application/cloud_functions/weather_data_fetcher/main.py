@@ -1,41 +1,48 @@
-import os
+import io
 import pandas as pd
-import requests
-from google.cloud import storage, pubsub_v1
 import csv
-from datetime import datetime, timedelta
 import traceback
 import json
-import shutil
-import base64
+import time
 from collections import OrderedDict
+from common.runtime import get_storage, publish, decode_message, compute_fingerprint, add_trace_stage
+from common.feature_cache import load_cache, save_cache, get_weather_days, summarize_weather, weather_window
+
+# Bump whenever the fetching logic changes so existing outputs are recomputed
+STAGE_VERSION = "fetch_weather_data-2"
 
 def fetch_weather_data(event, context):
     """Cloud Function triggered by the message from metadata_extractor function."""
+    stage_start = time.time()
     print("Raw event data:", event)
 
     # Decode and process the pub/sub message
-    pubsub_message = base64.b64decode(event['data']).decode('utf-8')
-    print("Decoded message:", pubsub_message)
-    message_data = json.loads(pubsub_message)
+    message_data = decode_message(event)
     print("Message data:", message_data)
 
     bucket_name = message_data["bucket"]
     field_id = message_data["field_id"]
     batch_id = message_data["batch_id"]
+    trace = message_data.get("trace", {})
+    downstream_message = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id, "trace": trace}
 
     try:
-        # Setup paths and download the metadata CSV to /tmp directory
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        local_dir = f"/tmp/{field_id}/{batch_id}/"
-        os.makedirs(local_dir, exist_ok=True)
-        local_path = os.path.join(local_dir, "image_metadata.csv")
-        blob = bucket.blob(f"userdata/{field_id}/{batch_id}/image_metadata.csv")
-        blob.download_to_filename(local_path)
-
-        df = pd.read_csv(local_path)
-        weather_csv_path = f"/tmp/weather_data_{field_id}_{batch_id}.csv"
+        storage = get_storage(bucket_name)
+        input_path = f"userdata/{field_id}/{batch_id}/image_metadata.csv"
+        output_path = f"userdata/{field_id}/{batch_id}/weather_data.csv"
+
+        # Skipping the fetch when the existing output was produced from this exact metadata file
+        fingerprint = compute_fingerprint(STAGE_VERSION, [storage.stat(input_path)])
+        existing_metadata = storage.get_metadata(output_path)
+        if existing_metadata is not None and existing_metadata.get("input_fingerprint") == fingerprint:
+            print(f"Inputs unchanged for batch {batch_id} in field {field_id}, republishing without re-fetching.")
+            add_trace_stage(trace, "fetch_weather_data", stage_start)
+            storage.update_metadata(output_path, {"trace": json.dumps(trace)})
+            publish("weather-data-fetched", downstream_message)
+            return
+
+        # Read the metadata CSV straight from storage
+        df = pd.read_csv(io.BytesIO(storage.read(input_path)))
 
         coordinates_and_dates = []
 
@@ -44,76 +51,45 @@ def fetch_weather_data(event, context):
             lon = round(row['Longitude'], 2)
             date_created = row['Date']
             coordinates_and_dates.append((lat, lon, date_created))
-        
+    
         # Getting rid of duplicate tuples
         # Using an OrderedDict to remove duplicates while maintaining order. Keys are the tuples.
         unique_coordinates_and_dates_ordered = list(OrderedDict.fromkeys(coordinates_and_dates))
-        
-        # Preparing the CSV file at the specified file path
-        with open(weather_csv_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Latitude", "Longitude", "Date", "Avg Temp 14d", "Avg Humidity 14d", "Total Precipitation 14d", "Avg Wind Speed 14d"])
-
-            for latitude, longitude, date_str in unique_coordinates_and_dates_ordered:
-                # Calculating the date range to obtain the data
-                end_date = datetime.strptime(date_str, '%Y-%m-%d')
-                start_date = end_date - timedelta(days=14)
-
-                # Formatting the dates for the API request
-                start_date_str = start_date.strftime('%Y-%m-%d')
-                end_date_str = (end_date - timedelta(days=1)).strftime('%Y-%m-%d')  # Excluding the given date itself
-
-                # Making the API request
-                response = requests.get(
-                    f"https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/{latitude},{longitude}/{start_date_str}/{end_date_str}?unitGroup=metric&include=days&key={os.getenv('VC_API_KEY')}&contentType=json"
-                )
-                weather_data = response.json()
-
-                # Initializing variables for the calculations
-                total_temp = 0
-                total_humidity = 0
-                total_precipitation = 0
-                total_wind_speed = 0
-                days_counted = 0
-
-                # Accumulating the weather data
-                for day in weather_data['days']:
-                    total_temp += day['temp']
-                    total_humidity += day['humidity']
-                    total_precipitation += day.get('precip', 0)
-                    total_wind_speed += day['windspeed']
-                    days_counted += 1
-
-                # Calculating the averages
-                avg_temp = total_temp / days_counted if days_counted else 0
-                avg_humidity = total_humidity / days_counted if days_counted else 0
-                avg_wind_speed = total_wind_speed / days_counted if days_counted else 0
-
-                writer.writerow([latitude, longitude, date_str, avg_temp, avg_humidity, total_precipitation, avg_wind_speed])
-
-        # Upload the CSV back to Cloud Storage
-        output_blob = bucket.blob(f"userdata/{field_id}/{batch_id}/weather_data.csv")
-        output_blob.upload_from_filename(weather_csv_path)
-
-        # Cleanup temporary files
-        os.remove(local_path)
-        os.remove(weather_csv_path)
+    
+        # Daily weather already pre-fetched for this field is read from the cache; only missing days hit the API
+        weather_cache, cache_generation = load_cache(storage, field_id, "weather")
+        cache_updated = False
+
+        # Preparing the CSV in memory
+        output = io.StringIO(newline='')
+        writer = csv.writer(output)
+        writer.writerow(["Latitude", "Longitude", "Date", "Avg Temp 14d", "Avg Humidity 14d", "Total Precipitation 14d", "Avg Wind Speed 14d"])
+
+        for latitude, longitude, date_str in unique_coordinates_and_dates_ordered:
+            # Calculating the date range to obtain the data (excluding the given date itself)
+            start_date, end_date = weather_window(date_str)
+            days, fetched = get_weather_days(weather_cache, latitude, longitude, start_date, end_date)
+            cache_updated = cache_updated or fetched
+
+            avg_temp, avg_humidity, total_precipitation, avg_wind_speed = summarize_weather(days)
+            writer.writerow([latitude, longitude, date_str, avg_temp, avg_humidity, total_precipitation, avg_wind_speed])
+
+        if cache_updated:
+            save_cache(storage, field_id, "weather", weather_cache, cache_generation)
+
+        # Append this stage's timings to the batch trace
+        add_trace_stage(trace, "fetch_weather_data", stage_start)
+
+        # Upload the CSV back to Cloud Storage (the trace rides along so the consolidator can merge both branches)
+        storage.write(output_path, output.getvalue().encode('utf-8'), content_type="text/csv",
+                      metadata={"input_fingerprint": fingerprint, "trace": json.dumps(trace)})
+
         print(f"Weather data processed and saved for batch {batch_id} in field {field_id}.")
 
         # Publish a message to the weather-data-fetched topic
-        publisher = pubsub_v1.PublisherClient()
-        project_id = "tidy-nomad-415320"
-        topic_name = "weather-data-fetched"
-        topic_path = publisher.topic_path(project_id, topic_name)
-        data = {"bucket": bucket_name, "field_id": field_id, "batch_id": batch_id}
-        message = json.dumps(data).encode("utf-8")
-        future = publisher.publish(topic_path, data=message)
-        future.result()
+        publish("weather-data-fetched", downstream_message)
 
         print("Published message to weather-data-fetched topic.")
 
     except Exception as e:
         print(f"Error processing weather data: {traceback.format_exc()}")
-
-    # Safely remove all temporary files after processing and uploading CSV
-    shutil.rmtree(local_dir, ignore_errors=True)
\ No newline at end of file
@@ -0,0 +1,101 @@
+#!/usr/bin/env bash
+# Packaging and deployment of the pipeline cloud functions and the web app.
+#
+# The functions import the shared `common` package (cloud_functions/common) and the web app imports
+# `cloud_functions.common.storage`, so nothing is deployed straight from the source tree: each target is
+# staged under build/ with its own files plus a copy of common/, and deployed from there.
+#
+#   ./deploy.sh stage [target...]    only build the staging directories (default: every target)
+#   ./deploy.sh deploy [target...]   stage and deploy (default: every target)
+#
+# Targets: the function directories under cloud_functions/ and `webapp`.
+set -euo pipefail
+
+ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+BUILD="${BUILD:-$ROOT/build}"
+REGION="${REGION:-us-west1}"
+PROJECT="${PROJECT:-tidy-nomad-415320}"
+RUNTIME="${RUNTIME:-python311}"
+
+# Deployed function name, source directory, entry point and trigger topic. The consolidator waits for both
+# data fetchers, so it is deployed once per topic.
+FUNCTIONS=(
+  "metadata-extractor metadata_extractor metadata_extractor metadata-extraction-trigger"
+  "fetch-weather-data weather_data_fetcher fetch_weather_data metadata-extracted"
+  "fetch-remote-sensing-data remote_sensing_data_fetcher fetch_remote_sensing_data metadata-extracted"
+  "consolidate-datasets-weather dataset_consolidator consolidate_datasets weather-data-fetched"
+  "consolidate-datasets-remote-sensing dataset_consolidator consolidate_datasets remote-sensing-data-fetched"
+  "generate-derivatives derivative_generator generate_derivatives derivatives-trigger"
+  "prefetch-field-features feature_prefetcher prefetch_field_features feature-prefetch-trigger"
+)
+
+copy_common() {
+  # Copying the shared package without bytecode caches
+  mkdir -p "$(dirname "$1")"
+  cp -r "$ROOT/cloud_functions/common" "$1"
+  find "$1" -name '__pycache__' -prune -exec rm -rf {} \;
+}
+
+stage_function() {
+  local source="$1" target="$BUILD/$1"
+  rm -rf "$target"
+  mkdir -p "$target"
+  cp "$ROOT/cloud_functions/$source/main.py" "$ROOT/cloud_functions/$source/requirements.txt" "$target/"
+  copy_common "$target/common"
+  echo "Staged $source in $target"
+}
+
+stage_webapp() {
+  local target="$BUILD/webapp"
+  rm -rf "$target"
+  mkdir -p "$target"
+  cp -r "$ROOT/app" "$ROOT/app.yaml" "$ROOT/requirements.txt" "$target/"
+  find "$target" -name '__pycache__' -prune -exec rm -rf {} \;
+  copy_common "$target/cloud_functions/common"
+  echo "Staged the web app in $target"
+}
+
+deploy_function() {
+  local name="$1" source="$2" entry_point="$3" topic="$4"
+  gcloud functions deploy "$name" --no-gen2 --project "$PROJECT" --region "$REGION" --runtime "$RUNTIME" \
+    --source "$BUILD/$source" --entry-point "$entry_point" --trigger-topic "$topic"
+}
+
+run() {
+  local action="$1" target="$2" found=0
+  if [ "$target" = webapp ]; then
+    stage_webapp
+    [ "$action" = deploy ] && gcloud app deploy "$BUILD/webapp/app.yaml" --project "$PROJECT" --quiet
+    return 0
+  fi
+  for entry in "${FUNCTIONS[@]}"; do
+    read -r name source entry_point topic <<< "$entry"
+    if [ "$source" = "$target" ]; then
+      [ "$found" = 0 ] && stage_function "$source"
+      found=1
+      [ "$action" = deploy ] && deploy_function "$name" "$source" "$entry_point" "$topic"
+    fi
+  done
+  if [ "$found" = 0 ]; then
+    echo "Unknown target: $target" >&2
+    exit 1
+  fi
+}
+
+action="${1:-}"
+if [ "$action" != stage ] && [ "$action" != deploy ]; then
+  echo "Usage: $0 stage|deploy [target...]" >&2
+  exit 1
+fi
+shift
+targets=("$@")
+if [ ${#targets[@]} -eq 0 ]; then
+  for entry in "${FUNCTIONS[@]}"; do
+    read -r _ source _ _ <<< "$entry"
+    [[ " ${targets[*]-} " == *" $source "* ]] || targets+=("$source")
+  done
+  targets+=(webapp)
+fi
+for target in "${targets[@]}"; do
+  run "$action" "$target"
+done
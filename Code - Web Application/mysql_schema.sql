@@ -27,8 +27,18 @@ CREATE TABLE Batch
     y_grid     INT NOT NULL,
     datetime   DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
     date_taken DATE,
+    state            VARCHAR(20) DEFAULT 'uploaded' NOT NULL,
+    pending_count    INT DEFAULT 0 NOT NULL,
+    predicting_count INT DEFAULT 0 NOT NULL,
+    healthy_count    INT DEFAULT 0 NOT NULL,
+    brown_spot_count INT DEFAULT 0 NOT NULL,
+    rice_blast_count INT DEFAULT 0 NOT NULL,
+    duplicate_count  INT DEFAULT 0 NOT NULL,
+    version          INT DEFAULT 0 NOT NULL,
+    last_updated     DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
     FOREIGN KEY (user_id) REFERENCES User(id),
-    FOREIGN KEY (field_id) REFERENCES Field(id)
+    FOREIGN KEY (field_id) REFERENCES Field(id),
+    INDEX ix_batch_field_date (field_id, date_taken)
 );
 
 CREATE TABLE Image
@@ -44,5 +54,68 @@ CREATE TABLE Image
     brown_spot FLOAT,
     `order`    INT DEFAULT 0 NOT NULL,
     date_taken DATE,
-    FOREIGN KEY (batch_id) REFERENCES Batch(id)
+    phash      CHAR(16),
+    duplicate_of_id INT,
+    input_hash CHAR(64),
+    FOREIGN KEY (batch_id) REFERENCES Batch(id),
+    FOREIGN KEY (duplicate_of_id) REFERENCES Image(id),
+    INDEX ix_image_batch_filename (batch_id, filename),
+    INDEX ix_image_batch_label (batch_id, label)
 );
+
+CREATE TABLE BatchStage
+(
+    id         INT AUTO_INCREMENT PRIMARY KEY,
+    batch_id   INT NOT NULL,
+    trace_id   VARCHAR(32) NOT NULL,
+    stage      VARCHAR(100) NOT NULL,
+    started_at DATETIME(3) NOT NULL,
+    ended_at   DATETIME(3) NOT NULL,
+    FOREIGN KEY (batch_id) REFERENCES Batch(id),
+    INDEX ix_batchstage_batch_stage (batch_id, stage)
+);
+
+CREATE TABLE FieldCellSummary
+(
+    id               INT AUTO_INCREMENT PRIMARY KEY,
+    field_id         INT NOT NULL,
+    date_taken       DATE NOT NULL,
+    cell_order       INT NOT NULL,
+    image_count      INT DEFAULT 0 NOT NULL,
+    predicted_count  INT DEFAULT 0 NOT NULL,
+    healthy_count    INT DEFAULT 0 NOT NULL,
+    brown_spot_count INT DEFAULT 0 NOT NULL,
+    rice_blast_count INT DEFAULT 0 NOT NULL,
+    healthy_sum      DOUBLE DEFAULT 0 NOT NULL,
+    brown_spot_sum   DOUBLE DEFAULT 0 NOT NULL,
+    rice_blast_sum   DOUBLE DEFAULT 0 NOT NULL,
+    updated_at       DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    FOREIGN KEY (field_id) REFERENCES Field(id),
+    UNIQUE INDEX ux_fieldcellsummary_field_date_cell (field_id, date_taken, cell_order)
+);
+
+CREATE TABLE OutboxMessage
+(
+    id              INT AUTO_INCREMENT PRIMARY KEY,
+    topic           VARCHAR(100) NOT NULL,
+    payload         TEXT NOT NULL,
+    attempts        INT DEFAULT 0 NOT NULL,
+    next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    published_at    DATETIME,
+    last_error      VARCHAR(500),
+    created_at      DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    INDEX ix_outboxmessage_pending (published_at, next_attempt_at)
+);
+
+-- Adding the read-path indexes to an existing database
+-- CREATE INDEX ix_batch_field_date ON Batch (field_id, date_taken);
+-- CREATE INDEX ix_image_batch_filename ON Image (batch_id, filename);
+-- CREATE INDEX ix_image_batch_label ON Image (batch_id, label);
+-- CREATE INDEX ix_batchstage_batch_stage ON BatchStage (batch_id, stage);
+
+-- Adding the duplicate tracking columns to an existing database
+-- ALTER TABLE Batch ADD COLUMN duplicate_count INT DEFAULT 0 NOT NULL;
+-- ALTER TABLE Image ADD COLUMN phash CHAR(16), ADD COLUMN duplicate_of_id INT, ADD FOREIGN KEY (duplicate_of_id) REFERENCES Image(id);
+
+-- Adding the prediction input hash to an existing database
+-- ALTER TABLE Image ADD COLUMN input_hash CHAR(64);
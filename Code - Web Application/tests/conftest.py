@@ -0,0 +1,57 @@
+import os
+import sys
+
+# The app reads its configuration from the environment when it is imported, so the test settings go first
+os.environ['ENV_MODE'] = 'development'
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+os.environ['STORAGE_BACKEND'] = 'memory'
+os.environ['OUTBOX_PUBLISHER'] = 'memory'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from app import create_app, db
+
+@pytest.fixture
+def app():
+    """A fresh app on an empty in-memory database, with the login requirement turned off."""
+    app = create_app()
+    app.config.update(TESTING=True, LOGIN_DISABLED=True)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def make_batch(app):
+    """Creating a user, a field and a batch of images named like drone uploads; returns the batch id."""
+    from datetime import date
+    from app.models import User, Field, Batch, Image
+
+    def make(images=4, field=None, date_taken=date(2024, 5, 1)):
+        user = User.query.first()
+        if user is None:
+            user = User(name='user', email='user@example.com', password='x')
+            db.session.add(user)
+            db.session.flush()
+        if field is None:
+            field = Field(name='field', code='1', user_id=user.id)
+            db.session.add(field)
+            db.session.flush()
+        side = max(1, int(images ** 0.5))
+        batch = Batch(img_qty=images, x_grid=side, y_grid=side, date_taken=date_taken, user_id=user.id,
+                      field_id=field.id, pending_count=images)
+        db.session.add(batch)
+        db.session.flush()
+        for order in range(1, images + 1):
+            filename = f"1_{side}_{side}_{order}_{date_taken:%Y-%m-%d}.JPG"
+            db.session.add(Image(filename=filename, path=f"userdata/{field.id}/{batch.id}/{filename}", label='no',
+                                 order=order, date_taken=date_taken, batch_id=batch.id))
+        db.session.commit()
+        return batch.id
+
+    return make
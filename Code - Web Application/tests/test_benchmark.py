@@ -0,0 +1,17 @@
+from app.benchmark import benchmark_command
+from app.cache import response_cache
+
+def test_benchmark_times_every_endpoint_past_the_cache(app):
+    hits = response_cache.hits
+    result = app.test_cli_runner().invoke(benchmark_command, ['--users', '2', '--fields', '2', '--batches-per-field', '2',
+                                                              '--images-per-batch', '4', '--predicted-ratio', '1',
+                                                              '--repeat', '2'])
+    assert result.exit_code == 0, result.output
+    for endpoint in ['get_fields', 'get_images_by_date', 'check_batch_update', 'field_disease_timeseries',
+                     'field_disease_heatmap', 'batch_duplicates', 'derivatives/manifest', 'derivatives/tiles',
+                     'derivatives/thumbnail']:
+        assert endpoint in result.output
+    assert 'answered' not in result.output
+    # The cached endpoints were timed on their queries, not on cache hits
+    assert response_cache.hits == hits
+    assert response_cache.enabled
@@ -0,0 +1,14 @@
+from app.cache import ResponseCache, InProcessCacheBackend
+
+def test_a_value_computed_across_an_invalidation_is_not_stored():
+    cache = ResponseCache(InProcessCacheBackend())
+
+    def compute_then_invalidate():
+        # The rows were read, then an upload committed and invalidated the field before the value was stored
+        cache.invalidate(1)
+        return ['stale']
+
+    assert cache.get_or_compute(1, 'dates', compute_then_invalidate) == ['stale']
+    assert cache.get_or_compute(1, 'dates', lambda: ['fresh']) == ['fresh']
+    assert cache.get_or_compute(1, 'dates', lambda: ['unused']) == ['fresh']
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,18 @@
+import os
+import stat
+from app import config
+
+def test_secrets_cache_is_private_even_over_an_existing_file(tmp_path, monkeypatch):
+    path = tmp_path / 'app-secrets.json'
+    path.write_text('{}')
+    path.chmod(0o644)
+    monkeypatch.setattr(config, 'SECRETS_CACHE_PATH', str(path))
+    monkeypatch.setattr(config, 'SECRETS_CACHE_TTL', 60)
+
+    config.save_cached_secrets({'db-password': 'secret'})
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert config.load_cached_secrets(['db-password']) == {'db-password': 'secret'}
+
+    # A cache that other users could have written is not trusted
+    path.chmod(0o666)
+    assert config.load_cached_secrets(['db-password']) is None
@@ -0,0 +1,59 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The model server imports the shared package as `common`, as it is copied into its image
+sys.path[:0] = [os.path.join(ROOT, 'ai_gcp'), os.path.join(ROOT, 'cloud_functions')]
+
+from common.storage import MemoryStorage
+from dedup import DuplicateIndex, load_index, save_index
+
+CONTEXT = '2024-05-01|23.4561|120.1234'
+
+def predict_batch(index, images, model_version):
+    """Running a batch through the index like the model server: a match reuses, a miss is predicted and added."""
+    results = {}
+    for image_id, phash in images:
+        match = index.find(phash, CONTEXT, model_version, exclude_id=image_id)
+        if match is not None:
+            results[image_id] = ('duplicate', match[0]['id'], match[0]['prediction'])
+            continue
+        prediction = f'{model_version}:{image_id}'
+        index.add(phash, CONTEXT, {'id': image_id, 'prediction': prediction, 'confidences': '{}',
+                                   'model_version': model_version})
+        results[image_id] = ('predicted', None, prediction)
+    return results
+
+def test_rerun_after_a_model_change_repredicts_instead_of_matching_itself():
+    index = DuplicateIndex(max_distance=4)
+    images = [('a.jpg', 0xF0F0F0F0F0F0F0F0), ('b.jpg', 0xF0F0F0F0F0F0F0F1), ('c.jpg', 0x0F0F0F0F0F0F0F0F)]
+    first = predict_batch(index, images, 'v1')
+    assert first['b.jpg'] == ('duplicate', 'a.jpg', 'v1:a.jpg')
+
+    # The stored index survives the round trip with the model version of each entry
+    index = DuplicateIndex.from_json(index.to_json(), max_distance=4)
+    second = predict_batch(index, images, 'v2')
+    assert second['a.jpg'] == ('predicted', None, 'v2:a.jpg')
+    assert second['b.jpg'] == ('duplicate', 'a.jpg', 'v2:a.jpg')
+    assert second['c.jpg'] == ('predicted', None, 'v2:c.jpg')
+    # Re-predicted images replaced their entries instead of adding copies
+    assert sorted((entry['id'], entry['model_version']) for entry in index.entries) == [('a.jpg', 'v2'), ('c.jpg', 'v2')]
+    assert index.added == 2
+
+def test_an_image_never_matches_its_own_entry():
+    index = DuplicateIndex(max_distance=4)
+    index.add(0xABCD, CONTEXT, {'id': 'a.jpg', 'prediction': 'x', 'confidences': '{}', 'model_version': 'v1'})
+    assert index.find(0xABCD, CONTEXT, 'v1', exclude_id='a.jpg') is None
+    assert index.find(0xABCD, CONTEXT, 'v1', exclude_id='other.jpg')[1] == 0
+
+def test_save_merges_the_entries_of_a_concurrent_save():
+    storage = MemoryStorage()
+    index, generation = load_index(storage, 1, max_distance=4)
+    other, other_generation = load_index(storage, 1, max_distance=4)
+    other.add(0x1, CONTEXT, {'id': 'x.jpg', 'prediction': 'x', 'confidences': '{}', 'model_version': 'v1'})
+    assert save_index(storage, 1, other, other_generation)
+
+    index.add(0xFFFF, CONTEXT, {'id': 'y.jpg', 'prediction': 'y', 'confidences': '{}', 'model_version': 'v1'})
+    assert save_index(storage, 1, index, generation)
+    stored, _ = load_index(storage, 1, max_distance=4)
+    assert sorted(entry['id'] for entry in stored.entries) == ['x.jpg', 'y.jpg']
@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNCTIONS = ['metadata_extractor', 'weather_data_fetcher', 'remote_sensing_data_fetcher', 'dataset_consolidator',
+             'derivative_generator', 'feature_prefetcher']
+
+def test_stage_copies_common_into_every_target(tmp_path):
+    subprocess.run([os.path.join(ROOT, 'deploy.sh'), 'stage'], check=True, env={**os.environ, 'BUILD': str(tmp_path)})
+
+    for function in FUNCTIONS:
+        assert (tmp_path / function / 'main.py').exists()
+        assert (tmp_path / function / 'requirements.txt').exists()
+        assert (tmp_path / function / 'common' / 'runtime.py').exists()
+        assert not (tmp_path / function / 'common' / '__pycache__').exists()
+    assert (tmp_path / 'webapp' / 'app.yaml').exists()
+    assert (tmp_path / 'webapp' / 'cloud_functions' / 'common' / 'storage.py').exists()
+
+    # The staged packages import from their own directories, as they do once deployed
+    subprocess.run([sys.executable, '-c', 'import common.storage, common.features'],
+                   cwd=tmp_path / 'dataset_consolidator', check=True)
+    subprocess.run([sys.executable, '-c', 'from cloud_functions.common.storage import MemoryStorage'],
+                   cwd=tmp_path / 'webapp', check=True)
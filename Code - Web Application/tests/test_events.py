@@ -0,0 +1,21 @@
+import sys
+import threading
+
+def test_streams_beyond_the_limit_are_refused(client, make_batch, monkeypatch):
+    views = sys.modules['app.main']
+    monkeypatch.setattr(views, 'event_stream_slots', threading.BoundedSemaphore(1))
+    batch_id = make_batch()
+
+    first = client.get(f'/main/batch_events/{batch_id}', buffered=False)
+    assert first.status_code == 200
+    assert next(first.response).startswith(b'retry:')
+    # The only slot is held by the open stream, so the next client is told to poll
+    assert client.get(f'/main/batch_events/{batch_id}').status_code == 503
+    first.close()
+    second = client.get(f'/main/batch_events/{batch_id}', buffered=False)
+    assert second.status_code == 200
+    second.close()
+
+def test_streams_are_off_without_slots(client, make_batch, monkeypatch):
+    monkeypatch.setattr(sys.modules['app.main'], 'event_stream_slots', None)
+    assert client.get(f'/main/batch_events/{make_batch()}').status_code == 503
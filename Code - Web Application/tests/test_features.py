@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from cloud_functions.common.features import (ALL_NUMERICAL_FEATURES, FEATURES_TO_STANDARDIZE, REMOTE_SENSING_FEATURES,
+                                             add_decrease_indicators, build_feature_matrix, consolidate,
+                                             fill_augmented_info)
+
+def test_consolidate_joins_weather_on_rounded_coordinates():
+    metadata_df = pd.DataFrame({'Id': ['a.jpg'], 'Latitude': [23.4561], 'Longitude': [120.1234], 'Date': ['2024/05/01']})
+    weather_df = pd.DataFrame({'Latitude': [23.46], 'Longitude': [120.12], 'Date': ['2024-05-01'],
+                               **{feature: [1.0] for feature in FEATURES_TO_STANDARDIZE}})
+    modis_df = pd.DataFrame({'Latitude': [23.4561], 'Longitude': [120.1234], 'Date': ['2024-05-01'],
+                             **{feature: [0.5] for feature in REMOTE_SENSING_FEATURES}})
+    modis_df['NDVI - 1 MODIS'] = 0.6
+
+    df = consolidate(metadata_df, weather_df, modis_df)
+    assert df.loc[0, 'Avg Temp 14d'] == 1.0
+    assert df.loc[0, 'NDVI 1 Decrease'] == 1 and df.loc[0, 'EVI 1 Decrease'] == 0
+    assert 'NDVI 1 Decrease' not in consolidate(metadata_df, weather_df, modis_df, indicators=False).columns
+
+def test_fill_augmented_info_copies_the_original_rows():
+    base_df = pd.DataFrame({'Id': ['img.jpg'], 'Latitude': [1.0], 'Date': ['2024-05-01']})
+    augmented_df = pd.DataFrame({'Id': ['img_1.jpg', 'other_1.jpg']})
+    filled = fill_augmented_info(augmented_df, base_df)
+    assert filled.loc[0, 'Latitude'] == 1.0 and filled.loc[0, 'Date'] == '2024-05-01'
+    assert pd.isna(filled.loc[1, 'Latitude'])
+
+def test_build_feature_matrix_matches_row_by_row_standardization():
+    rng = np.random.default_rng(0)
+    df = add_decrease_indicators(pd.DataFrame(rng.random((5, 10)), columns=FEATURES_TO_STANDARDIZE + REMOTE_SENSING_FEATURES))
+
+    class Scaler:
+        mean_ = np.full(4, 0.5)
+        scale_ = np.full(4, 2.0)
+
+    matrix = build_feature_matrix(df, Scaler())
+    expected = df[ALL_NUMERICAL_FEATURES].to_numpy(dtype=np.float64)
+    expected[:, :4] = (expected[:, :4] - 0.5) / 2.0
+    assert matrix.dtype == np.float32 and np.allclose(matrix, expected)
+
+    with pytest.raises(ValueError):
+        build_feature_matrix(df.drop(columns=['Avg Temp 14d']))
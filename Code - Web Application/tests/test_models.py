@@ -0,0 +1,20 @@
+from datetime import date
+from app import db
+from app.models import User, Field, Batch
+
+def test_create_batch(app):
+    user = User(name='user', email='user@example.com', password='x')
+    db.session.add(user)
+    db.session.flush()
+    field = Field(name='field', code='1', user_id=user.id)
+    db.session.add(field)
+    db.session.flush()
+    batch = Batch(img_qty=4, x_grid=2, y_grid=2, date_taken=date(2024, 5, 1), user_id=user.id, field_id=field.id)
+    db.session.add(batch)
+    db.session.commit()
+
+    batch = db.session.get(Batch, batch.id)
+    assert batch.state == 'uploaded'
+    assert batch.version == 0
+    assert batch.datetime is not None
+    assert batch.last_updated is not None
@@ -0,0 +1,24 @@
+from app.outbox import enqueue
+from app.models import OutboxMessage
+from app import db
+import app.outbox as outbox
+
+def test_dispatcher_not_started_by_create_app_or_test_requests(app, client):
+    assert not outbox.dispatcher.running
+    client.get('/main/pipeline_latency')
+    assert not outbox.dispatcher.running
+
+def test_dispatcher_starts_with_first_served_request(app, client):
+    app.config['TESTING'] = False
+    outbox.dispatcher.poll_seconds = 3600
+    client.get('/main/pipeline_latency')
+    assert outbox.dispatcher.running
+
+def test_dispatch_once_publishes_committed_messages(app):
+    enqueue('datasets-consolidated', {'batch_id': 1})
+    db.session.commit()
+    publisher = outbox.InMemoryPublisher()
+    outbox.dispatcher.publisher_factory = lambda: publisher
+    assert outbox.dispatcher.dispatch_once() == 1
+    assert publisher.messages[0][1] == {'batch_id': 1}
+    assert OutboxMessage.query.one().published_at is not None
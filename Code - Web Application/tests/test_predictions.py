@@ -0,0 +1,74 @@
+import base64
+import json
+from sqlalchemy import event
+from app import db
+from app.models import Image, Batch
+from app.services import ingest_predictions
+
+def pubsub_push(data):
+    return {'message': {'data': base64.b64encode(json.dumps(data).encode('utf-8')).decode('utf-8')}}
+
+def predictions_for(batch_id, hashes, label='Healthy'):
+    images = Image.query.filter_by(batch_id=batch_id).order_by(Image.order).all()
+    return [{'Id': f"gs://bucket/{image.path}", 'Class Prediction': label,
+             'Class Confidence Levels': str({label: 0.9}), 'Input Hash': input_hash}
+            for image, input_hash in zip(images, hashes)]
+
+def updated_image_rows(call):
+    """Running a call and returning how many Image rows its UPDATE statements were given."""
+    counted = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE "Image"'):
+            counted.append(len(parameters) if executemany else 1)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        call()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return sum(counted)
+
+def test_rerun_touches_only_changed_images(client, make_batch):
+    batch_id = make_batch(images=4)
+    first_run = predictions_for(batch_id, ['a', 'b', 'c', 'd'])
+
+    # First run: every image goes to predicting and gets its prediction
+    client.post('/main/set_images_to_predicting', json=pubsub_push({'batch_id': batch_id}))
+    assert Image.query.filter_by(batch_id=batch_id, label='predicting').count() == 4
+    assert ingest_predictions(batch_id, first_run) == 4
+
+    # Re-run with unchanged inputs: the images keep their predictions and nothing is rewritten
+    client.post('/main/set_images_to_predicting', json=pubsub_push({'batch_id': batch_id}))
+    assert Image.query.filter_by(batch_id=batch_id, label='predicting').count() == 0
+    assert updated_image_rows(lambda: ingest_predictions(batch_id, first_run)) == 0
+
+    # Re-run after one image changed: only that row is updated
+    client.post('/main/set_images_to_predicting', json=pubsub_push({'batch_id': batch_id}))
+    second_run = predictions_for(batch_id, ['a', 'b', 'c', 'e'], label='Rice Blast')
+    assert updated_image_rows(lambda: ingest_predictions(batch_id, second_run)) == 1
+    labels = [image.label for image in Image.query.filter_by(batch_id=batch_id).order_by(Image.order)]
+    assert labels == ['Healthy', 'Healthy', 'Healthy', 'Rice Blast']
+
+def test_unchanged_image_left_predicting_gets_its_label_back(app, make_batch):
+    batch_id = make_batch(images=2)
+    run = predictions_for(batch_id, ['a', 'b'])
+    ingest_predictions(batch_id, run)
+    Image.query.filter_by(batch_id=batch_id).update({'label': 'predicting'})
+    db.session.commit()
+
+    assert ingest_predictions(batch_id, run) == 2
+    assert Image.query.filter_by(batch_id=batch_id, label='Healthy').count() == 2
+
+def test_field_summary_drops_the_labels_of_images_sent_back_to_predicting(client, make_batch):
+    batch_id = make_batch(images=4)
+    field_id = db.session.get(Batch, batch_id).field_id
+
+    def summary():
+        (day,) = client.get(f'/main/field_disease_timeseries/{field_id}').get_json()
+        return day['images'], day['counts']['Healthy']
+
+    ingest_predictions(batch_id, predictions_for(batch_id, [None] * 4))
+    assert summary() == (4, 4)
+    client.post('/main/set_images_to_predicting', json=pubsub_push({'batch_id': batch_id}))
+    assert summary() == (4, 0)
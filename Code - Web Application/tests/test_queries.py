@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import event
+from app import db
+from app.models import Field
+from app.cache import response_cache
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+def seed(make_batch, fields, batches, images):
+    """Seeding fields with batches of images; returns the first field and its newest batch."""
+    batch_id = None
+    for _ in range(fields):
+        field = None
+        for i in range(batches):
+            batch_id = make_batch(images=images, field=field, date_taken=date(2024, 5, 1) + timedelta(days=7 * i))
+            field = field or Field.query.order_by(Field.id.desc()).first()
+    return Field.query.order_by(Field.id).first().id, batch_id
+
+def endpoint_query_counts(client, field_id, batch_id):
+    counts = {}
+    for name, url in [('fields', '/main/get_fields'), ('batches', f'/main/get_batches/{field_id}'),
+                      ('images', f'/main/get_images/{batch_id}'),
+                      ('grid', f'/main/get_images_by_date?field_id={field_id}&date=2024-05-01')]:
+        # Timing the query path, not the response cache
+        response_cache.invalidate(field_id)
+        db.session.remove()
+        with count_queries() as statements:
+            response = client.get(url)
+        assert response.status_code == 200, name
+        counts[name] = len(statements)
+    return counts
+
+@pytest.mark.parametrize('fields,batches,images', [(1, 1, 4), (3, 5, 25)])
+def test_list_endpoints_use_constant_queries(client, make_batch, fields, batches, images):
+    field_id, batch_id = seed(make_batch, fields, batches, images)
+    counts = endpoint_query_counts(client, field_id, batch_id)
+    # One validator query and one page query per list; the date grid reads the batches and then their images
+    assert counts == {'fields': 2, 'batches': 2, 'images': 2, 'grid': 2}
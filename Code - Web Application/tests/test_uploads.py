@@ -0,0 +1,35 @@
+from app import db
+from app.clients import get_storage
+from app.models import User, Field, Batch, Image
+
+def multipart(boundary, parts, truncate=0):
+    body = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="images"; filename="{filename}"\r\n'
+                    f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b'\r\n' for filename, data in parts)
+    body += f'--{boundary}--\r\n'.encode()
+    return body[:len(body) - truncate] if truncate else body
+
+def test_a_truncated_streamed_upload_leaves_no_batch_or_files(app, client):
+    user = User(name='user', email='user@example.com', password='x')
+    db.session.add(user)
+    db.session.flush()
+    field = Field(name='field', code='1', user_id=user.id)
+    db.session.add(field)
+    db.session.commit()
+    field_id = field.id
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+
+    parts = [('1_2_2_1_2024-05-01.JPG', b'a' * 1000), ('1_2_2_2_2024-05-01.JPG', b'b' * 1000)]
+    response = client.post(f'/main/upload_batch_stream?field_id={field_id}', data=multipart('xyz', parts, truncate=600),
+                           content_type='multipart/form-data; boundary=xyz')
+    assert response.status_code == 400
+    assert Batch.query.count() == 0 and Image.query.count() == 0
+    assert get_storage().list(f'userdata/{field_id}/', delimiter=None) == ([], [])
+
+    response = client.post(f'/main/upload_batch_stream?field_id={field_id}', data=multipart('xyz', parts),
+                           content_type='multipart/form-data; boundary=xyz')
+    assert response.status_code == 200, response.get_json()
+    assert Image.query.count() == 2
+    # The field summary counts the uploaded images before any prediction arrives
+    (day,) = client.get(f'/main/field_disease_timeseries/{field_id}').get_json()
+    assert (day['date'], day['images'], day['predicted']) == ('2024-05-01', 2, 0)